@@ -7,10 +7,11 @@ import asyncio
 import logging
 from http.server import BaseHTTPRequestHandler
 
-from telegram import Bot
+from telegram.ext import ExtBot
 
 import config
 import database as db
+import ratelimit
 from scheduler import deliver_scheduled
 
 logger = logging.getLogger(__name__)
@@ -20,7 +21,7 @@ logging.basicConfig(level=logging.INFO)
 async def _run_cron():
     """Run scheduled valentine delivery"""
     await db.init_db()
-    bot = Bot(token=config.BOT_TOKEN)
+    bot = ExtBot(token=config.BOT_TOKEN, rate_limiter=ratelimit.get_limiter())
     await deliver_scheduled(bot)
     return {"ok": True, "message": "Cron job completed"}
 
@@ -2,81 +2,49 @@
 Vercel Serverless Webhook Endpoint for Valentine Bot
 Handles incoming Telegram updates via webhook (POST)
 Sets up webhook on GET request
+With WEBHOOK_ACK_FIRST updates are spooled to the DB, acknowledged at once
+and processed by a background drainer
 """
 import json
 import asyncio
 import logging
+import threading
 from http.server import BaseHTTPRequestHandler
 
-from telegram import Update, Bot
-from telegram.ext import Application
+from telegram import Bot
 
 import config
-import database as db
-from handlers import register_all_handlers
+import webhook_app
 
 logger = logging.getLogger(__name__)
 logging.basicConfig(level=logging.INFO)
 
-# Global application instance (reused across warm invocations)
-_app = None
+# One event loop for the life of the instance, so the Application, its HTTP
+# keep-alive connections and the DB pool survive between warm invocations
+_loop = None
+_loop_lock = threading.Lock()
 
 
-async def _get_app() -> Application:
-    """Get or create the Application instance"""
-    global _app
-    if _app is None:
-        # Initialize database tables
-        await db.init_db()
-
-        # Build application
-        _app = (
-            Application.builder()
-            .token(config.BOT_TOKEN)
-            .updater(None)  # No updater needed for webhook mode
-            .build()
-        )
-
-        # Register all handlers
-        register_all_handlers(_app)
-
-        # Initialize the application
-        await _app.initialize()
+def _get_loop() -> asyncio.AbstractEventLoop:
+    """Start the background event loop thread on first use"""
+    global _loop
+    with _loop_lock:
+        if _loop is None:
+            loop = asyncio.new_event_loop()
+            threading.Thread(target=loop.run_forever, name="webhook-loop", daemon=True).start()
+            _loop = loop
+    return _loop
 
-        # Get bot info
-        bot_info = await _app.bot.get_me()
-        config.BOT_USERNAME = bot_info.username
-        logger.info(f"Bot initialized: @{config.BOT_USERNAME}")
 
-    return _app
+def _run(coro):
+    """Run a coroutine on the background loop and wait for its result"""
+    return asyncio.run_coroutine_threadsafe(coro, _get_loop()).result()
 
 
 async def _setup_webhook():
     """Set the Telegram webhook URL"""
     bot = Bot(token=config.BOT_TOKEN)
-
-    # Determine webhook URL
-    webhook_url = config.WEBHOOK_URL
-    if not webhook_url and config.VERCEL_URL:
-        webhook_url = f"https://{config.VERCEL_URL}/api/webhook"
-
-    if not webhook_url:
-        return {"error": "WEBHOOK_URL or VERCEL_URL not set"}
-
-    await bot.set_webhook(url=webhook_url)
-    info = await bot.get_webhook_info()
-    return {
-        "ok": True,
-        "webhook_url": info.url,
-        "pending_update_count": info.pending_update_count,
-    }
-
-
-async def _process_update(body: bytes):
-    """Process a single Telegram update"""
-    app = await _get_app()
-    update = Update.de_json(json.loads(body), app.bot)
-    await app.process_update(update)
+    return await webhook_app.setup_webhook(bot)
 
 
 class handler(BaseHTTPRequestHandler):
@@ -85,9 +53,7 @@ class handler(BaseHTTPRequestHandler):
     def do_GET(self):
         """GET /api/webhook — setup webhook"""
         try:
-            loop = asyncio.new_event_loop()
-            result = loop.run_until_complete(_setup_webhook())
-            loop.close()
+            result = _run(_setup_webhook())
 
             self.send_response(200)
             self.send_header("Content-Type", "application/json")
@@ -102,18 +68,33 @@ class handler(BaseHTTPRequestHandler):
 
     def do_POST(self):
         """POST /api/webhook — process Telegram update"""
+        if not webhook_app.secret_ok(self.headers.get("X-Telegram-Bot-Api-Secret-Token")):
+            self.send_response(403)
+            self.end_headers()
+            return
         try:
             content_length = int(self.headers.get("Content-Length", 0))
             body = self.rfile.read(content_length)
 
-            loop = asyncio.new_event_loop()
-            loop.run_until_complete(_process_update(body))
-            loop.close()
+            if config.WEBHOOK_ACK_FIRST:
+                try:
+                    _run(webhook_app.spool_update(body))
+                except ValueError:
+                    raise  # malformed update, nothing to redeliver
+                except Exception as e:
+                    # Not persisted: a non-200 makes Telegram deliver it again
+                    logger.error(f"Update spool error: {e}")
+                    self.send_response(500)
+                    self.end_headers()
+                    return
+                reply = None
+            else:
+                reply = _run(webhook_app.process_update(body))
 
             self.send_response(200)
             self.send_header("Content-Type", "application/json")
             self.end_headers()
-            self.wfile.write(json.dumps({"ok": True}).encode())
+            self.wfile.write(json.dumps(reply or {"ok": True}).encode())
         except Exception as e:
             logger.error(f"Update processing error: {e}")
             self.send_response(200)  # Always return 200 to Telegram
@@ -0,0 +1,132 @@
+"""
+Concurrent-update throughput of the database layer
+Simulates N updates in flight at once, each doing the DB calls of a typical
+handler plus a Telegram round trip, against the Postgres backend
+
+    POSTGRES_URL=postgresql://... python benchmarks/db_concurrency.py
+    python benchmarks/db_concurrency.py --repo /path/to/other/checkout
+
+--repo imports database.py from another checkout (e.g. a `git worktree` of
+an older commit) to compare before and after. --db-latency routes the
+connections through a local proxy that delays each packet, to stand in for
+a database in another datacenter. Use a scratch database: the benchmark
+creates users and valentines with ids from 9_000_000_000 up.
+"""
+import argparse
+import asyncio
+import os
+import sys
+import threading
+import time
+
+BASE_ID = 9_000_000_000
+
+
+async def _update(db, n: int, telegram_latency: float):
+    """DB work of one sent valentine: both users, inbox, stats, insert"""
+    sender, receiver = BASE_ID + 2 * n, BASE_ID + 2 * n + 1
+    await db.get_or_create_user(sender, f"bench{n}", "Bench")
+    await db.get_or_create_user(receiver)
+    await db.get_inbox(receiver)
+    await db.get_user_stats(sender)
+    await db.create_valentine(sender, receiver, "benchmark")
+    await asyncio.sleep(telegram_latency)  # reply to the user
+
+
+async def _run(db, updates: int, concurrency: int, telegram_latency: float) -> float:
+    semaphore = asyncio.Semaphore(concurrency)
+
+    async def one(n):
+        async with semaphore:
+            await _update(db, n, telegram_latency)
+
+    started = time.perf_counter()
+    await asyncio.gather(*(one(n) for n in range(updates)))
+    return updates / (time.perf_counter() - started)
+
+
+async def _pipe(reader, writer, delay: float):
+    """Forward one direction of a connection, each chunk `delay` seconds late"""
+    loop = asyncio.get_running_loop()
+    queue = asyncio.Queue()
+
+    async def deliver():
+        while True:
+            due, data = await queue.get()
+            await asyncio.sleep(due - loop.time())
+            if not data:
+                writer.close()
+                return
+            writer.write(data)
+            await writer.drain()
+
+    sender = asyncio.create_task(deliver())
+    while True:
+        data = await reader.read(65536)
+        queue.put_nowait((loop.time() + delay, data))
+        if not data:
+            break
+    await sender
+
+
+def _start_latency_proxy(url: str, latency: float) -> str:
+    """Serve a delaying proxy to the database on its own thread; returns its URL"""
+    from psycopg2.extensions import make_dsn, parse_dsn
+    params = parse_dsn(url)
+    host, port = params.get("host", "localhost"), int(params.get("port", 5432))
+    ready = threading.Event()
+    bound = []
+
+    async def handle(client_reader, client_writer):
+        if host.startswith("/"):
+            server_reader, server_writer = await asyncio.open_unix_connection(f"{host}/.s.PGSQL.{port}")
+        else:
+            server_reader, server_writer = await asyncio.open_connection(host, port)
+        await asyncio.gather(
+            _pipe(client_reader, server_writer, latency / 2),
+            _pipe(server_reader, client_writer, latency / 2),
+            return_exceptions=True,
+        )
+
+    async def serve():
+        server = await asyncio.start_server(handle, "127.0.0.1", 0)
+        bound.append(server.sockets[0].getsockname()[1])
+        ready.set()
+        await server.serve_forever()
+
+    threading.Thread(target=asyncio.run, args=(serve(),), daemon=True).start()
+    ready.wait()
+    params.update(host="127.0.0.1", port=bound[0])
+    return make_dsn(**params)
+
+
+async def main(args):
+    import database as db
+    if hasattr(db, "migrate"):
+        await db.migrate()
+    await db.init_db()
+    await _run(db, 20, 1, 0)  # warm up the pool
+    for concurrency in args.concurrency:
+        rate = await _run(db, args.updates, concurrency, args.telegram_latency)
+        print(f"concurrency {concurrency:>3}: {rate:7.1f} updates/s")
+    if hasattr(db, "close_db"):
+        await db.close_db()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument("--repo", default=os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+    parser.add_argument("--updates", type=int, default=500)
+    parser.add_argument("--concurrency", type=int, nargs="+", default=[1, 10, 50])
+    parser.add_argument("--telegram-latency", type=float, default=0.05,
+                        help="seconds each update spends waiting on the Bot API")
+    parser.add_argument("--db-latency", type=float, default=0,
+                        help="extra round-trip seconds to the database")
+    args = parser.parse_args()
+    if not os.getenv("POSTGRES_URL"):
+        sys.exit("Set POSTGRES_URL: the benchmark measures the Postgres backend")
+    if args.db_latency:
+        # Before `import database`: config reads POSTGRES_URL at import time
+        os.environ["POSTGRES_URL"] = _start_latency_proxy(os.environ["POSTGRES_URL"], args.db_latency)
+    sys.path.insert(0, args.repo)
+    asyncio.run(main(args))
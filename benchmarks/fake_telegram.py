@@ -0,0 +1,141 @@
+"""
+Local stand-in for the Telegram Bot API, shared by the benchmarks
+Answers every method after a fixed latency, records when each message went
+out and can answer one send with a 429 flood wait. Point the bot at it with
+BOT_API_URL (or base_url=f"{url}/bot"):
+
+    python benchmarks/fake_telegram.py --port 8081 --latency 0.05
+"""
+import argparse
+import asyncio
+import itertools
+import json
+import threading
+import time
+from urllib.parse import parse_qs
+
+# Methods that put a message in a chat, i.e. count against the ~30/s limit
+SEND_METHODS = {"sendMessage", "sendVoice", "sendPhoto", "sendAudio", "sendDocument",
+                "sendSticker", "sendAnimation", "sendVideo", "copyMessage", "forwardMessage"}
+
+_REASONS = {200: b"OK", 429: b"Too Many Requests"}
+
+
+class FakeTelegram:
+    """Bot API stand-in; every request waits `latency` seconds
+
+    With `flood_at` the n-th send (1-based) is answered with RetryAfter of
+    `flood_seconds`, like Telegram's flood control.
+    """
+
+    def __init__(self, latency: float = 0.05, flood_at: int = None, flood_seconds: int = 1):
+        self.latency = latency
+        self.flood_at = flood_at
+        self.flood_seconds = flood_seconds
+        self.url = None
+        self.requests = 0
+        self.floods = 0
+        self.sent = []  # (monotonic time, method, chat_id) of every accepted send
+        self._message_ids = itertools.count(1)
+
+    def start(self, port: int = 0) -> str:
+        """Serve on its own thread; returns the base URL"""
+        ready = threading.Event()
+
+        async def serve():
+            server = await self._listen(port)
+            ready.set()
+            await server.serve_forever()
+
+        threading.Thread(target=asyncio.run, args=(serve(),), daemon=True).start()
+        ready.wait()
+        return self.url
+
+    async def _listen(self, port: int):
+        server = await asyncio.start_server(self._connection, "127.0.0.1", port, backlog=1024)
+        self.url = f"http://127.0.0.1:{server.sockets[0].getsockname()[1]}"
+        return server
+
+    async def _connection(self, reader, writer):
+        """Serve one keep-alive connection"""
+        try:
+            while True:
+                request_line = await reader.readline()
+                if not request_line:
+                    return
+                path = request_line.decode().split()[1]
+                headers = {}
+                while (line := await reader.readline()) not in (b"\r\n", b""):
+                    name, _, value = line.decode().partition(":")
+                    headers[name.strip().lower()] = value.strip()
+                length = int(headers.get("content-length", 0))
+                body = await reader.readexactly(length) if length else b""
+                await asyncio.sleep(self.latency)
+                status, payload = self._answer(path.rsplit("/", 1)[-1], _params(headers, body))
+                out = json.dumps(payload).encode()
+                writer.write(b"HTTP/1.1 %d %s\r\nContent-Type: application/json\r\n"
+                             b"Content-Length: %d\r\n\r\n%s" % (status, _REASONS[status], len(out), out))
+                await writer.drain()
+        except (ConnectionError, asyncio.IncompleteReadError):
+            pass
+        finally:
+            writer.close()
+
+    def _answer(self, method: str, params: dict):
+        """(HTTP status, response JSON) for one Bot API call"""
+        self.requests += 1
+        if method == "getMe":
+            return 200, {"ok": True, "result": {"id": 1, "is_bot": True,
+                                                "first_name": "Bench", "username": "bench_bot"}}
+        if method not in SEND_METHODS:
+            return 200, {"ok": True, "result": True}
+        if self.flood_at is not None and len(self.sent) + 1 == self.flood_at and not self.floods:
+            self.floods += 1
+            return 429, {"ok": False, "error_code": 429,
+                         "description": f"Too Many Requests: retry after {self.flood_seconds}",
+                         "parameters": {"retry_after": self.flood_seconds}}
+        chat_id = int(params.get("chat_id", 0))
+        self.sent.append((time.monotonic(), method, chat_id))
+        return 200, {"ok": True, "result": {"message_id": next(self._message_ids), "date": int(time.time()),
+                                            "chat": {"id": chat_id, "type": "private"}}}
+
+    def busiest_second(self) -> int:
+        """Most sends within any one-second window"""
+        times = sorted(sent for sent, _, _ in self.sent)
+        busiest, first = 0, 0
+        for last, at in enumerate(times):
+            while at - times[first] >= 1:
+                first += 1
+            busiest = max(busiest, last - first + 1)
+        return busiest
+
+
+def _params(headers: dict, body: bytes) -> dict:
+    """Request parameters; PTB posts JSON, form-encoded or multipart bodies"""
+    content_type = headers.get("content-type", "")
+    if content_type.startswith("application/json"):
+        return json.loads(body or b"{}")
+    if content_type.startswith("application/x-www-form-urlencoded"):
+        return {key: values[0] for key, values in parse_qs(body.decode()).items()}
+    if content_type.startswith("multipart/form-data"):
+        # Only chat_id matters here
+        marker = b'name="chat_id"\r\n\r\n'
+        start = body.find(marker)
+        if start != -1:
+            start += len(marker)
+            return {"chat_id": body[start:body.index(b"\r\n", start)].decode()}
+    return {}
+
+
+async def _main(args):
+    telegram = FakeTelegram(args.latency)
+    server = await telegram._listen(args.port)
+    print(f"Fake Bot API on {telegram.url}")
+    await server.serve_forever()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument("--port", type=int, default=8081)
+    parser.add_argument("--latency", type=float, default=0.05)
+    asyncio.run(_main(parser.parse_args()))
@@ -0,0 +1,92 @@
+"""
+Scheduled delivery throughput
+Schedules N valentines due now, runs scheduler.deliver_scheduled against the
+fake Bot API and reports deliveries/s, messages/s and the busiest second,
+which must stay within SEND_RATE_PER_SECOND
+
+    python benchmarks/scheduled_delivery.py --valentines 300
+    python benchmarks/scheduled_delivery.py --flood-at 100
+    python benchmarks/scheduled_delivery.py --repo /path/to/other/checkout
+
+Runs on a throwaway SQLite file unless POSTGRES_URL is set (then use a
+scratch database: valentines and users are created with ids from
+9_000_000_000 up). --flood-at answers that send with a 1s RetryAfter;
+--repo compares another checkout as in db_concurrency.py.
+"""
+import argparse
+import asyncio
+import os
+import sys
+import tempfile
+import time
+from datetime import datetime
+
+from fake_telegram import FakeTelegram
+
+BASE_ID = 9_000_000_000
+
+
+async def _schedule(db, valentines: int, voice_every: int):
+    """Due valentines, each from and to its own user, every n-th with a voice"""
+    due = datetime.now().isoformat()
+    for n in range(valentines):
+        sender, receiver = BASE_ID + 2 * n, BASE_ID + 2 * n + 1
+        await db.get_or_create_user(sender, f"bench{n}", "Bench")
+        await db.get_or_create_user(receiver)
+        voice = "bench-voice" if voice_every and n % voice_every == 0 else None
+        await db.create_valentine(sender, receiver, "benchmark", voice_file_id=voice, scheduled_for=due)
+
+
+def _bot(url: str):
+    """Bot built like /api/cron builds it, pointed at the fake API"""
+    from telegram.ext import ExtBot
+    try:
+        import ratelimit
+    except ImportError:  # checkout from before the rate limiter
+        return ExtBot(token="1:bench", base_url=f"{url}/bot")
+    return ExtBot(token="1:bench", base_url=f"{url}/bot", rate_limiter=ratelimit.get_limiter())
+
+
+async def main(args):
+    import database as db
+    import scheduler
+    if hasattr(db, "migrate"):
+        await db.migrate()
+    await db.init_db()
+
+    telegram = FakeTelegram(args.telegram_latency, args.flood_at)
+    bot = _bot(telegram.start())
+    await _schedule(db, args.valentines, args.voice_every)
+    await bot.initialize()
+
+    started = time.perf_counter()
+    await scheduler.deliver_scheduled(bot)
+    elapsed = time.perf_counter() - started
+    await bot.shutdown()
+
+    delivered = sum(1 for _, method, chat_id in telegram.sent
+                    if method == "sendMessage" and (chat_id - BASE_ID) % 2 == 1)
+    print(f"{delivered}/{args.valentines} valentines, {len(telegram.sent)} messages in {elapsed:.2f}s: "
+          f"{delivered / elapsed:.1f} deliveries/s, {len(telegram.sent) / elapsed:.1f} messages/s")
+    print(f"busiest second: {telegram.busiest_second()} messages; flood waits answered: {telegram.floods}")
+    if hasattr(db, "close_db"):
+        await db.close_db()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument("--repo", default=os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+    parser.add_argument("--valentines", type=int, default=300)
+    parser.add_argument("--voice-every", type=int, default=3,
+                        help="every n-th valentine also carries a voice message (0: none)")
+    parser.add_argument("--telegram-latency", type=float, default=0.05,
+                        help="seconds the fake Bot API takes per call")
+    parser.add_argument("--flood-at", type=int, default=None,
+                        help="answer the n-th send with RetryAfter(1)")
+    args = parser.parse_args()
+    if not os.getenv("POSTGRES_URL"):
+        # Before `import database`: config reads DATABASE_PATH at import time
+        os.environ["POSTGRES_URL"] = ""
+        os.environ["DATABASE_PATH"] = os.path.join(tempfile.mkdtemp(), "bench.db")
+    sys.path.insert(0, args.repo)
+    asyncio.run(main(args))
@@ -0,0 +1,149 @@
+"""
+Webhook cold-start vs warm-request latency
+Serves api/webhook.py's handler on a local port, with the Bot API replaced
+by the fake one, and posts /start updates one after another: the first
+request pays for building the Application, the rest show the warm path
+
+    python benchmarks/webhook_latency.py --updates 50
+    python benchmarks/webhook_latency.py --repo /path/to/other/checkout
+
+Runs on a throwaway SQLite file unless POSTGRES_URL is set (then use a
+scratch database: users are created with ids from 9_000_000_000 up).
+--repo compares another checkout as in db_concurrency.py; a request that
+gets no answer within --timeout is reported as hung.
+"""
+import argparse
+import asyncio
+import http.client
+import importlib.util
+import json
+import logging
+import os
+import statistics
+import sys
+import tempfile
+import threading
+import time
+from http.server import HTTPServer
+
+from fake_telegram import FakeTelegram
+
+BASE_ID = 9_000_000_000
+
+
+def _update(n: int) -> bytes:
+    user = {"id": BASE_ID + n, "is_bot": False, "first_name": "Bench"}
+    return json.dumps({
+        "update_id": BASE_ID + n,
+        "message": {
+            "message_id": n + 1, "date": int(time.time()), "text": "/start",
+            "entities": [{"type": "bot_command", "offset": 0, "length": 6}],
+            "chat": {"id": user["id"], "type": "private"}, "from": user,
+        },
+    }).encode()
+
+
+class _ErrorCount(logging.Handler):
+    """Counts errors logged while updates run, e.g. by PTB for a failed handler"""
+
+    def __init__(self):
+        super().__init__(logging.ERROR)
+        self.count = 0
+
+    def emit(self, record):
+        self.count += 1
+
+
+_errors = _ErrorCount()
+
+
+async def _migrate(db):
+    await db.migrate()
+    await db.close_db()
+
+
+def _serve_webhook(repo: str) -> int:
+    """Serve the Vercel handler from `repo` on its own thread; returns the port"""
+    import config
+    import database as db
+    if hasattr(db, "migrate"):
+        # As a deploy runs migrate.py, so the cold start doesn't include it
+        asyncio.run(_migrate(db))
+    if not hasattr(config, "BOT_API_URL"):
+        # Checkout from before BOT_API_URL: point every Application at the fake API
+        from telegram.ext import ApplicationBuilder
+        token = ApplicationBuilder.token
+        ApplicationBuilder.token = lambda self, value: token(self, value).base_url(
+            f"{os.environ['BOT_API_URL']}/bot")
+    spec = importlib.util.spec_from_file_location("webhook", os.path.join(repo, "api", "webhook.py"))
+    webhook = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(webhook)
+    logging.getLogger().setLevel(logging.WARNING)
+    logging.getLogger().addHandler(_errors)
+
+    class Handler(webhook.handler):
+        def log_message(self, format, *args):
+            pass
+
+    server = HTTPServer(("127.0.0.1", 0), Handler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server.server_address[1]
+
+
+def _post(port: int, body: bytes, timeout: float):
+    """(seconds until the webhook answered, error it reported); None if it didn't answer"""
+    conn = http.client.HTTPConnection("127.0.0.1", port, timeout=timeout)
+    started = time.perf_counter()
+    try:
+        conn.request("POST", "/api/webhook", body, {"Content-Type": "application/json"})
+        answer = conn.getresponse().read()
+    except TimeoutError:
+        return None
+    finally:
+        conn.close()
+    # The handler answers 200 even when processing failed, with the error in the body
+    return time.perf_counter() - started, json.loads(answer or b"{}").get("error")
+
+
+def main(args, telegram: FakeTelegram):
+    port = _serve_webhook(args.repo)
+    latencies, errors = [], []
+    for n in range(args.updates):
+        answer = _post(port, _update(n), args.timeout)
+        if answer is None:
+            print(f"update {n + 1} hung (no answer within {args.timeout}s)")
+            break
+        latencies.append(answer[0])
+        if answer[1]:
+            errors.append(answer[1])
+    if errors:
+        print(f"{len(errors)} updates failed, first: {errors[0]}")
+    if not latencies:
+        return
+    cold, warm = latencies[0], sorted(latencies[1:])
+    print(f"cold start: {cold * 1000:.0f} ms")
+    if warm:
+        p90 = warm[min(len(warm) - 1, int(len(warm) * 0.9))]
+        print(f"warm ({len(warm)} requests): median {statistics.median(warm) * 1000:.0f} ms, "
+              f"p90 {p90 * 1000:.0f} ms, max {warm[-1] * 1000:.0f} ms")
+    answered = {chat_id for _, _, chat_id in telegram.sent}
+    print(f"users who got a reply: {len(answered)}/{len(latencies)}; errors logged: {_errors.count}")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument("--repo", default=os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+    parser.add_argument("--updates", type=int, default=50)
+    parser.add_argument("--telegram-latency", type=float, default=0.05,
+                        help="seconds the fake Bot API takes per call")
+    parser.add_argument("--timeout", type=float, default=10)
+    args = parser.parse_args()
+    # Before `import config`, which reads the environment at import time
+    if not os.getenv("POSTGRES_URL"):
+        os.environ["POSTGRES_URL"] = ""
+        os.environ["DATABASE_PATH"] = os.path.join(tempfile.mkdtemp(), "bench.db")
+    telegram = FakeTelegram(args.telegram_latency)
+    os.environ.update(BOT_TOKEN="1:bench", WEBHOOK_SECRET="", WEBHOOK_ACK_FIRST="0",
+                      BOT_API_URL=telegram.start())
+    sys.path.insert(0, args.repo)
+    main(args, telegram)
@@ -0,0 +1,146 @@
+"""
+Load test of the self-hosted webhook server
+Starts `server.py --workers N` against the fake Bot API and posts /start
+updates over C keep-alive connections, as Telegram would with
+max_connections=C; reports updates/s and response latency per worker count
+
+    python benchmarks/webhook_server.py --workers 1 2 4
+    python benchmarks/webhook_server.py --updates 5000 --connections 100
+
+Runs on a throwaway SQLite file unless POSTGRES_URL is set (then use a
+scratch database: users are created with ids from 9_000_000_000 up). Each
+update comes from one of --users users. More than one worker is started
+with --allow-split-state; /start doesn't depend on conversation state.
+"""
+import argparse
+import asyncio
+import json
+import os
+import signal
+import subprocess
+import sys
+import tempfile
+import time
+
+from fake_telegram import FakeTelegram
+
+BASE_ID = 9_000_000_000
+REPO = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+SECRET = "bench-secret"
+
+
+def _update(update_id: int, user_id: int) -> bytes:
+    user = {"id": user_id, "is_bot": False, "first_name": "Bench"}
+    return json.dumps({
+        "update_id": update_id,
+        "message": {
+            "message_id": update_id, "date": int(time.time()), "text": "/start",
+            "entities": [{"type": "bot_command", "offset": 0, "length": 6}],
+            "chat": {"id": user_id, "type": "private"}, "from": user,
+        },
+    }).encode()
+
+
+async def _client(port: int, updates, latencies: list, failures: list):
+    """One keep-alive connection posting updates until none are left"""
+    reader, writer = await asyncio.open_connection("127.0.0.1", port)
+    try:
+        for body in updates:
+            started = time.perf_counter()
+            writer.write(
+                b"POST /api/webhook HTTP/1.1\r\nHost: bench\r\nContent-Type: application/json\r\n"
+                b"X-Telegram-Bot-Api-Secret-Token: %s\r\nContent-Length: %d\r\n\r\n%s"
+                % (SECRET.encode(), len(body), body)
+            )
+            await writer.drain()
+            status = (await reader.readline()).split()[1]
+            headers = {}
+            while (line := await reader.readline()) not in (b"\r\n", b""):
+                name, _, value = line.decode().partition(":")
+                headers[name.strip().lower()] = value.strip()
+            answer = await reader.readexactly(int(headers.get("content-length", 0)))
+            latencies.append(time.perf_counter() - started)
+            # The server answers 200 even when processing failed, with the error in the body
+            if status != b"200" or (answer and json.loads(answer).get("error")):
+                failures.append(status)
+    finally:
+        writer.close()
+
+
+async def _load(port: int, args) -> str:
+    first_id = int(time.time()) * 100_000  # fresh update_ids: dedup remembers old ones
+    updates = iter([_update(first_id + n, BASE_ID + n % args.users) for n in range(args.updates)])
+    latencies, failures = [], []
+    started = time.perf_counter()
+    await asyncio.gather(*(_client(port, updates, latencies, failures)
+                           for _ in range(args.connections)))
+    elapsed = time.perf_counter() - started
+    latencies.sort()
+    return (f"{len(latencies) / elapsed:6.1f} updates/s, p50 {latencies[len(latencies) // 2] * 1000:4.0f} ms, "
+            f"p99 {latencies[int(len(latencies) * 0.99)] * 1000:4.0f} ms, failed {len(failures)}")
+
+
+def _start_server(port: int, workers: int, log):
+    """server.py in its own process; returns once every worker is serving"""
+    command = [sys.executable, "server.py", "--port", str(port), "--workers", str(workers)]
+    if workers > 1:
+        command.append("--allow-split-state")
+    process = subprocess.Popen(command, cwd=REPO, stdout=log, stderr=subprocess.STDOUT)
+    deadline = time.monotonic() + 60
+    while time.monotonic() < deadline:
+        with open(log.name) as f:
+            if f.read().count(" serving ") >= workers:
+                return process
+        if process.poll() is not None:
+            break
+        time.sleep(0.2)
+    process.kill()
+    with open(log.name) as f:
+        sys.exit(f"server.py did not start:\n{f.read()[-2000:]}")
+
+
+async def _migrate():
+    import database as db
+    await db.migrate()
+    await db.close_db()
+
+
+def main(args):
+    telegram = FakeTelegram(args.telegram_latency)
+    os.environ.update(BOT_TOKEN="1:bench", BOT_API_URL=telegram.start(), WEBHOOK_SECRET=SECRET,
+                      WEBHOOK_ACK_FIRST="0", WEBHOOK_INLINE_REPLY="0",
+                      SEND_RATE_PER_SECOND=str(args.send_rate))
+    sys.path.insert(0, REPO)
+    # Once up front, so workers starting together don't race to migrate
+    asyncio.run(_migrate())
+    for workers in args.workers:
+        with tempfile.NamedTemporaryFile("w+", suffix=".log") as log:
+            process = _start_server(args.port, workers, log)
+            sent = len(telegram.sent)
+            try:
+                result = asyncio.run(_load(args.port, args))
+            finally:
+                process.send_signal(signal.SIGTERM)
+                process.wait(30)
+        print(f"{workers} worker(s): {result}, replies {len(telegram.sent) - sent}")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument("--workers", type=int, nargs="+", default=[1, 2])
+    parser.add_argument("--updates", type=int, default=2000)
+    parser.add_argument("--connections", type=int, default=40,
+                        help="concurrent keep-alive connections (Telegram's max_connections)")
+    parser.add_argument("--users", type=int, default=500)
+    parser.add_argument("--port", type=int, default=8089)
+    parser.add_argument("--telegram-latency", type=float, default=0.05,
+                        help="seconds the fake Bot API takes per call")
+    parser.add_argument("--send-rate", type=float, default=10000,
+                        help="SEND_RATE_PER_SECOND of each worker; raised by default so the "
+                             "server is measured, not the 30 msg/s outbound limit")
+    args = parser.parse_args()
+    # Before `import config`, here and in the server's processes
+    if not os.getenv("POSTGRES_URL"):
+        os.environ["POSTGRES_URL"] = ""
+        os.environ["DATABASE_PATH"] = os.path.join(tempfile.mkdtemp(), "bench.db")
+    main(args)
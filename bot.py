@@ -9,7 +9,10 @@ from telegram.ext import Application
 
 import config
 import database as db
-from handlers import register_all_handlers
+import matchmaker
+import ratelimit
+import update_processor
+from handlers import get_allowed_updates, register_all_handlers
 from scheduler import run_scheduler
 
 # Setup logging
@@ -35,6 +38,21 @@ async def post_init(application: Application):
     asyncio.create_task(run_scheduler(application.bot))
     logger.info("Scheduler started for delayed deliveries")
 
+    # Pair roulette players in memory as they arrive
+    await matchmaker.start(application.bot)
+    logger.info("Roulette matchmaker started")
+
+
+async def post_shutdown(application: Application):
+    """Stop background work and release database connections on shutdown"""
+    matchmaker.stop()
+    logger.info(f"Outbound requests: {ratelimit.get_stats()}")
+    logger.info(f"Updates: {update_processor.get_stats()}")
+    logger.info(f"Database pool: {db.get_pool_stats()}")
+    logger.info(f"Subscription cache: {db.get_subscription_cache_stats()}")
+    await db.close_db()
+    logger.info("Database connections closed")
+
 
 def main():
     """Main function to run the bot"""
@@ -46,7 +64,10 @@ def main():
     application = (
         Application.builder()
         .token(config.BOT_TOKEN)
+        .rate_limiter(ratelimit.get_limiter())
+        .concurrent_updates(update_processor.get_processor())
         .post_init(post_init)
+        .post_shutdown(post_shutdown)
         .build()
     )
 
@@ -55,7 +76,7 @@ def main():
 
     # Start polling
     logger.info("Starting Valentine Bot v2.0...")
-    application.run_polling(drop_pending_updates=True)
+    application.run_polling(drop_pending_updates=True, allowed_updates=get_allowed_updates())
 
 
 if __name__ == "__main__":
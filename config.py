@@ -15,12 +15,75 @@ OPENAI_API_KEY = os.getenv("OPENAI_API_KEY", "")
 # Database — Vercel Postgres
 POSTGRES_URL = os.getenv("POSTGRES_URL", "")
 
+# Postgres connection pool (per process)
+PG_POOL_MIN_SIZE = int(os.getenv("PG_POOL_MIN_SIZE", "1"))
+PG_POOL_MAX_SIZE = int(os.getenv("PG_POOL_MAX_SIZE", "10"))
+PG_POOL_MAX_IDLE = float(os.getenv("PG_POOL_MAX_IDLE", "300"))          # seconds
+PG_POOL_MAX_LIFETIME = float(os.getenv("PG_POOL_MAX_LIFETIME", "1800"))  # seconds
+PG_POOL_TIMEOUT = float(os.getenv("PG_POOL_TIMEOUT", "10"))             # wait for free conn
+
+# Apply pending schema migrations on the first start after a deploy (Vercel has
+# no release phase); 0 leaves them to `python migrate.py`
+AUTO_MIGRATE = os.getenv("AUTO_MIGRATE", "1") == "1"
+
 # Legacy local SQLite fallback (for local dev without Postgres)
 DATABASE_PATH = os.getenv("DATABASE_PATH", "valentine_bot.db")
+SQLITE_CACHE_SIZE_KB = int(os.getenv("SQLITE_CACHE_SIZE_KB", "65536"))   # page cache
+SQLITE_MMAP_SIZE = int(os.getenv("SQLITE_MMAP_SIZE", str(256 * 1024 * 1024)))
+
+# Scheduled delivery: rows leased per claim, and how long a lease hides a row
+# from other workers (failed deliveries are retried after it runs out)
+SCHEDULED_BATCH_SIZE = int(os.getenv("SCHEDULED_BATCH_SIZE", "100"))
+SCHEDULED_LEASE_SECONDS = float(os.getenv("SCHEDULED_LEASE_SECONDS", "300"))
+# The worker sleeps until the next delivery is due and re-reads the DB this often
+SCHEDULER_RESYNC_SECONDS = float(os.getenv("SCHEDULER_RESYNC_SECONDS", "600"))
+SCHEDULER_HEAP_SIZE = int(os.getenv("SCHEDULER_HEAP_SIZE", "1000"))   # upcoming rows kept in memory
+SCHEDULED_CONCURRENCY = int(os.getenv("SCHEDULED_CONCURRENCY", "20"))  # valentines in flight
+
+# Outgoing requests: Telegram allows ~30 messages/s per bot and ~1/s per chat
+SEND_RATE_PER_SECOND = float(os.getenv("SEND_RATE_PER_SECOND", "30"))
+SEND_CHAT_INTERVAL = float(os.getenv("SEND_CHAT_INTERVAL", "1.0"))   # notifications only
+SEND_MAX_RETRIES = int(os.getenv("SEND_MAX_RETRIES", "3"))           # retries after RetryAfter
+
+# Updates from different users processed at once (one user's updates stay in order)
+UPDATE_CONCURRENCY = int(os.getenv("UPDATE_CONCURRENCY", "32"))
+
+# Leaderboard results are cached per process for this many seconds
+LEADERBOARD_CACHE_TTL = float(os.getenv("LEADERBOARD_CACHE_TTL", "60"))
+
+# Active subscriptions are cached per process (entries also expire with the plan)
+SUBSCRIPTION_CACHE_TTL = float(os.getenv("SUBSCRIPTION_CACHE_TTL", "300"))
+SUBSCRIPTION_CACHE_SIZE = int(os.getenv("SUBSCRIPTION_CACHE_SIZE", "10000"))
+# "No subscription" only briefly: a purchase on another instance can't invalidate it
+SUBSCRIPTION_NEGATIVE_CACHE_TTL = float(os.getenv("SUBSCRIPTION_NEGATIVE_CACHE_TTL", "5"))
 
 # Webhook
 VERCEL_URL = os.getenv("VERCEL_URL", "")
 WEBHOOK_URL = os.getenv("WEBHOOK_URL", "")
+# Telegram sends it in X-Telegram-Bot-Api-Secret-Token; requests without it are refused
+WEBHOOK_SECRET = os.getenv("WEBHOOK_SECRET", "")
+WEBHOOK_MAX_CONNECTIONS = int(os.getenv("WEBHOOK_MAX_CONNECTIONS", "40"))  # Telegram allows 1-100
+# Return a handler's last reply in the webhook response body (saves a round trip)
+WEBHOOK_INLINE_REPLY = os.getenv("WEBHOOK_INLINE_REPLY", "0") == "1"
+# Seconds a reply may wait for the handler to return before it is sent anyway
+WEBHOOK_INLINE_REPLY_HOLD = float(os.getenv("WEBHOOK_INLINE_REPLY_HOLD", "0.2"))
+# Spool updates to the DB and answer Telegram before processing them
+# (needs an instance that keeps running after the response; no inline replies)
+WEBHOOK_ACK_FIRST = os.getenv("WEBHOOK_ACK_FIRST", "0") == "1"
+UPDATE_SPOOL_BATCH_SIZE = int(os.getenv("UPDATE_SPOOL_BATCH_SIZE", "50"))
+UPDATE_SPOOL_LEASE_SECONDS = float(os.getenv("UPDATE_SPOOL_LEASE_SECONDS", "300"))
+# Processed update_ids are remembered this long (Telegram gives up on an update after a day)
+UPDATE_DEDUP_TTL = float(os.getenv("UPDATE_DEDUP_TTL", "86400"))
+UPDATE_DEDUP_PRUNE_INTERVAL = float(os.getenv("UPDATE_DEDUP_PRUNE_INTERVAL", "600"))
+
+# Self-hosted webhook server (server.py)
+# Base URL of a local Bot API server, e.g. http://localhost:8081 (default: api.telegram.org)
+BOT_API_URL = os.getenv("BOT_API_URL", "")
+WEBHOOK_PATH = os.getenv("WEBHOOK_PATH", "/api/webhook")
+SERVER_HOST = os.getenv("SERVER_HOST", "0.0.0.0")
+SERVER_PORT = int(os.getenv("PORT", "8080"))
+# >1 needs --allow-split-state: conversations and user_data live in each process
+SERVER_WORKERS = int(os.getenv("SERVER_WORKERS", "1"))
 
 # Cron secret (to protect cron endpoint)
 CRON_SECRET = os.getenv("CRON_SECRET", "")
@@ -58,6 +121,7 @@ ROMANTIC_DAILY_LIMIT = 10  # Romantic subscribers daily limit
 MAX_MESSAGE_LENGTH = 500   # Max valentine text length
 CHAIN_TARGET = 3           # Send N valentines to unlock VIP
 ROULETTE_POOL_SIZE = 2     # Min users for roulette match
+ROULETTE_WAIT_TIMEOUT = float(os.getenv("ROULETTE_WAIT_TIMEOUT", "1800"))  # seconds before an unmatched entry expires
 
 # ====== Occasions ======
 OCCASIONS = {
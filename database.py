@@ -2,9 +2,16 @@
 Database operations for Valentine Bot v2.0
 Supports both Vercel Postgres (production) and SQLite (local dev)
 """
+import asyncio
+import contextvars
+import functools
 import json
 import secrets
 import logging
+import time
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import asynccontextmanager
 from datetime import date, datetime, timedelta
 from typing import Optional
 
@@ -19,346 +26,925 @@ logger = logging.getLogger(__name__)
 _use_postgres = bool(config.POSTGRES_URL)
 
 
+_pg_pool = None
+_pg_pool_lock = threading.Lock()  # first calls race on executor threads
+_pg_executor = None
+_pg_slots = None  # (event loop, Semaphore)
+
+
+def _get_pg_pool():
+    """Get the process-wide Postgres pool, creating it on first use"""
+    global _pg_pool
+    if _pg_pool is None:
+        with _pg_pool_lock:
+            if _pg_pool is None:
+                import psycopg2.extras
+                from pg_pool import PgPool
+                _pg_pool = PgPool(
+                    config.POSTGRES_URL,
+                    min_size=config.PG_POOL_MIN_SIZE,
+                    max_size=config.PG_POOL_MAX_SIZE,
+                    max_idle=config.PG_POOL_MAX_IDLE,
+                    max_lifetime=config.PG_POOL_MAX_LIFETIME,
+                    timeout=config.PG_POOL_TIMEOUT,
+                    autocommit=True,
+                    cursor_factory=psycopg2.extras.DictCursor,
+                )
+                _pg_pool.fill()
+    return _pg_pool
+
+
 def _get_pg_conn():
-    """Get a psycopg2 connection to Vercel Postgres"""
-    import psycopg2
-    import psycopg2.extras
-    conn = psycopg2.connect(config.POSTGRES_URL)
-    conn.autocommit = False
-    return conn
+    """Check out a pooled psycopg2 connection to Vercel Postgres"""
+    return _get_pg_pool().getconn()
+
+
+def _put_pg_conn(conn):
+    """Return a connection to the pool (any open transaction is rolled back)"""
+    _get_pg_pool().putconn(conn)
+
+
+async def _pg_call(fn, *args):
+    """Run a blocking psycopg2 call on the bounded DB executor"""
+    global _pg_executor
+    if _pg_executor is None:
+        _pg_executor = ThreadPoolExecutor(
+            max_workers=config.PG_POOL_MAX_SIZE, thread_name_prefix="pg"
+        )
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(_pg_executor, functools.partial(fn, *args))
+
+
+class _AsyncPgCursor:
+    """Executed psycopg2 cursor; rows are buffered client-side so fetches don't block"""
+
+    def __init__(self, cursor):
+        self._cursor = cursor
+
+    @property
+    def rowcount(self) -> int:
+        return self._cursor.rowcount
+
+    async def fetchone(self):
+        return self._cursor.fetchone()
+
+    async def fetchall(self) -> list:
+        return self._cursor.fetchall()
+
+
+class _AsyncPgConnection:
+    """aiosqlite-style facade over a pooled psycopg2 connection
+
+    Connections run in autocommit mode, so single statements need no COMMIT
+    round trip. `begin()` opens an explicit transaction for multi-statement
+    writes; `commit()` ends it and returns to autocommit.
+    """
+
+    def __init__(self, conn, pinned: bool = False):
+        self._conn = conn
+        self._pinned = pinned
+        self.active = True
+        self.after_commit = []
+        self.after_rollback = []
+
+    def _execute(self, sql: str, params):
+        cur = self._conn.cursor()
+        cur.execute(sql, params)
+        return cur
 
+    def _commit(self):
+        self._conn.commit()
+        self._conn.autocommit = True
 
-def _dict_row(cursor, row):
-    """Convert a row to a dict using cursor.description"""
-    if row is None:
-        return None
-    return {col.name: row[idx] for idx, col in enumerate(cursor.description)}
+    async def execute(self, sql: str, params=None) -> _AsyncPgCursor:
+        return _AsyncPgCursor(await _pg_call(self._execute, sql, params))
 
+    async def begin(self):
+        if not self._pinned:
+            self._conn.autocommit = False
 
-def _fetchone_dict(cursor):
-    row = cursor.fetchone()
-    return _dict_row(cursor, row)
+    async def commit(self):
+        if not self._pinned and not self._conn.autocommit:
+            await _pg_call(self._commit)
 
 
-def _fetchall_dict(cursor):
-    rows = cursor.fetchall()
-    return [_dict_row(cursor, r) for r in rows]
+# Connection pinned by db.transaction() for the current task, if any
+_session = contextvars.ContextVar("db_session", default=None)
+
+
+def _active_session():
+    session = _session.get()
+    if session is not None and session.active:
+        return session
+    return None
+
+
+def _after_commit(fn):
+    """Call fn now, and again when the current db.transaction() commits"""
+    fn()
+    session = _active_session()
+    if session is not None:
+        session.after_commit.append(fn)
+
+
+def after_rollback(fn):
+    """Call fn if the current db.transaction() rolls back (no-op outside one)
+
+    For in-memory state changed on the assumption that the unit of work
+    commits, e.g. an entry taken out of a waiting list.
+    """
+    session = _active_session()
+    if session is not None:
+        session.after_rollback.append(fn)
+
+
+@asynccontextmanager
+async def _pg():
+    """Pooled Postgres connection for the duration of one operation"""
+    session = _active_session()
+    if session is not None:
+        yield session
+        return
+    global _pg_slots
+    loop = asyncio.get_running_loop()
+    if _pg_slots is None or _pg_slots[0] is not loop:
+        # At most max_size tasks hold connections, so executor threads never
+        # block on an exhausted pool while holders wait for a thread.
+        # Per event loop: /api/cron runs each request on a fresh one.
+        _pg_slots = (loop, asyncio.Semaphore(config.PG_POOL_MAX_SIZE))
+    async with _pg_slots[1]:
+        conn = await _pg_call(_get_pg_conn)
+        try:
+            yield _AsyncPgConnection(conn)
+        finally:
+            if conn.autocommit:
+                _put_pg_conn(conn)
+            else:
+                await _pg_call(_put_pg_conn, conn)
+
+
+_sqlite_conn = None
+_sqlite_lock = asyncio.Lock()
+
+_SQLITE_PRAGMAS = (
+    "PRAGMA journal_mode=WAL",
+    "PRAGMA synchronous=NORMAL",
+    "PRAGMA busy_timeout=5000",
+    "PRAGMA temp_store=MEMORY",
+    f"PRAGMA cache_size=-{config.SQLITE_CACHE_SIZE_KB}",
+    f"PRAGMA mmap_size={config.SQLITE_MMAP_SIZE}",
+)
+
+
+async def _open_sqlite():
+    """Open the shared SQLite connection once per process"""
+    global _sqlite_conn
+    if _sqlite_conn is None:
+        import aiosqlite
+        conn = await aiosqlite.connect(config.DATABASE_PATH)
+        conn.row_factory = aiosqlite.Row
+        for pragma in _SQLITE_PRAGMAS:
+            await conn.execute(pragma)
+        _sqlite_conn = conn
+        logger.info(f"SQLite connection opened: {config.DATABASE_PATH}")
+    return _sqlite_conn
+
+
+@asynccontextmanager
+async def _sqlite():
+    """Shared SQLite connection, held exclusively for one operation
+
+    aiosqlite runs every statement on the connection's single thread anyway;
+    the lock keeps one operation's statements and commit together.
+    """
+    session = _active_session()
+    if session is not None:
+        yield session
+        return
+    async with _sqlite_lock:
+        db = await _open_sqlite()
+        try:
+            yield db
+        finally:
+            if db.in_transaction:
+                await db.rollback()
+
+
+class _SqliteSession:
+    """Shared SQLite connection pinned by db.transaction(); commits are deferred"""
+
+    def __init__(self, db):
+        self._db = db
+        self.active = True
+        self.after_commit = []
+        self.after_rollback = []
+
+    def __getattr__(self, name):
+        return getattr(self._db, name)
+
+    async def commit(self):
+        pass
+
+
+@asynccontextmanager
+async def transaction():
+    """Unit of work: run several operations on one connection and one transaction
+
+    Every database function awaited inside the block by the current task
+    reuses the same connection; their individual commits are folded into a
+    single COMMIT on exit, and an exception rolls the whole unit back.
+    Nested blocks join the outer one. Keep Telegram calls outside the block —
+    it holds a pooled connection (or, on SQLite, the shared one) until it ends.
+
+        async with db.transaction():
+            await db.use_send_slot(user.id)
+            valentine_id = await db.create_valentine(...)
+    """
+    if _active_session() is not None:
+        yield
+        return
+    session = None
+    try:
+        if _use_postgres:
+            async with _pg() as conn:
+                await conn.begin()
+                session = _AsyncPgConnection(conn._conn, pinned=True)
+                token = _session.set(session)
+                try:
+                    yield
+                finally:
+                    session.active = False
+                    _session.reset(token)
+                await conn.commit()
+        else:
+            async with _sqlite() as db:
+                # Take the write lock up front: a deferred BEGIN that reads
+                # first can't upgrade once another process has committed, and
+                # fails with SQLITE_BUSY instead of waiting out busy_timeout
+                await db.execute("BEGIN IMMEDIATE")
+                session = _SqliteSession(db)
+                token = _session.set(session)
+                try:
+                    yield
+                finally:
+                    session.active = False
+                    _session.reset(token)
+                await db.commit()
+    except BaseException:
+        # Rolled back (the connection is released without COMMIT)
+        if session is not None:
+            for fn in session.after_rollback:
+                fn()
+        raise
+    for fn in session.after_commit:
+        fn()
+
+
+def _maintain_pg_pool():
+    _pg_pool.recycle_idle()
+    _pg_pool.fill()
+
+
+async def maintain_pool():
+    """Close idle and worn-out pooled connections, then reopen up to min_size"""
+    if _use_postgres and _pg_pool is not None:
+        await _pg_call(_maintain_pg_pool)
+
+
+def get_pool_stats() -> dict:
+    """Postgres pool statistics (empty on SQLite)"""
+    if _use_postgres and _pg_pool is not None:
+        return _pg_pool.stats()
+    return {}
+
+
+async def close_db():
+    """Release database resources on shutdown"""
+    global _pg_pool, _pg_executor
+    if _pg_pool is not None:
+        _pg_pool.closeall()
+        _pg_pool = None
+    if _pg_executor is not None:
+        _pg_executor.shutdown(wait=False)
+        _pg_executor = None
+    await _close_sqlite()
+
+
+async def _close_sqlite():
+    global _sqlite_conn
+    async with _sqlite_lock:
+        if _sqlite_conn is not None:
+            await _sqlite_conn.execute("PRAGMA optimize")
+            await _sqlite_conn.close()
+            _sqlite_conn = None
+            logger.info("SQLite connection closed")
 
 
 # ---------------------------------------------------------------------------
 # Init
 # ---------------------------------------------------------------------------
 
-async def init_db():
-    """Initialize database and create tables"""
-    if _use_postgres:
-        _init_db_pg()
-    else:
-        await _init_db_sqlite()
-
+_schema_ready = False
 
-def _init_db_pg():
-    """Initialize Postgres tables"""
-    conn = _get_pg_conn()
-    try:
-        cur = conn.cursor()
 
-        cur.execute("""
-            CREATE TABLE IF NOT EXISTS users (
-                user_id BIGINT PRIMARY KEY,
-                username TEXT,
-                first_name TEXT,
-                registered_at TIMESTAMP DEFAULT NOW(),
-                free_sends_today INTEGER DEFAULT 0,
-                last_send_date DATE,
-                bonus_valentines INTEGER DEFAULT 0,
-                zodiac_sign TEXT,
-                chain_count INTEGER DEFAULT 0,
-                roulette_uses_today INTEGER DEFAULT 0,
-                last_roulette_date DATE,
-                roulette_free_until TIMESTAMP
+async def init_db():
+    """Make sure the schema is current — a cheap version check, cached per process
+
+    Only a deploy that is behind runs DDL: the first cold start applies the
+    pending migrations (on Postgres under an advisory lock, so concurrent
+    cold starts wait for one another and then find nothing to do). With
+    AUTO_MIGRATE=0 a stale schema is an error until `python migrate.py` runs.
+    """
+    global _schema_ready
+    if _schema_ready:
+        return
+    version = await get_schema_version()
+    if version < SCHEMA_VERSION:
+        if not config.AUTO_MIGRATE:
+            raise RuntimeError(
+                f"Database schema is at version {version}, code expects {SCHEMA_VERSION}. "
+                f"Run `python migrate.py`."
             )
-        """)
+        logger.info(f"Schema at version {version}, applying migrations up to {SCHEMA_VERSION}")
+        await migrate()
+    _schema_ready = True
 
-        cur.execute("""
-            CREATE TABLE IF NOT EXISTS valentines (
-                id SERIAL PRIMARY KEY,
-                sender_id BIGINT REFERENCES users(user_id),
-                receiver_id BIGINT REFERENCES users(user_id),
-                message TEXT NOT NULL,
-                is_premium BOOLEAN DEFAULT FALSE,
-                is_poem BOOLEAN DEFAULT FALSE,
-                is_revealed BOOLEAN DEFAULT FALSE,
-                is_delivered BOOLEAN DEFAULT FALSE,
-                reaction TEXT,
-                voice_file_id TEXT,
-                photo_file_id TEXT,
-                gift_emoji TEXT,
-                music_url TEXT,
-                scheduled_for TIMESTAMP,
-                is_scheduled_sent BOOLEAN DEFAULT FALSE,
-                created_at TIMESTAMP DEFAULT NOW()
-            )
-        """)
 
-        cur.execute("""
-            CREATE TABLE IF NOT EXISTS payments (
-                id SERIAL PRIMARY KEY,
-                user_id BIGINT REFERENCES users(user_id),
-                amount INTEGER,
-                type TEXT,
-                valentine_id INTEGER,
-                telegram_payment_charge_id TEXT,
-                created_at TIMESTAMP DEFAULT NOW()
-            )
-        """)
+async def migrate():
+    """Apply pending schema migrations"""
+    if _use_postgres:
+        await _pg_call(_migrate_pg)
+    else:
+        await _migrate_sqlite()
 
-        cur.execute("""
-            CREATE TABLE IF NOT EXISTS anon_chats (
-                id TEXT PRIMARY KEY,
-                valentine_id INTEGER,
-                created_at TIMESTAMP DEFAULT NOW()
-            )
-        """)
 
-        cur.execute("""
-            CREATE TABLE IF NOT EXISTS anon_messages (
-                id SERIAL PRIMARY KEY,
-                chat_id TEXT,
-                from_sender BOOLEAN,
-                text TEXT,
-                created_at TIMESTAMP DEFAULT NOW()
-            )
-        """)
+async def get_schema_version() -> int:
+    """Latest applied migration version (0 for an unmigrated database)"""
+    if _use_postgres:
+        import psycopg2.errors
+        try:
+            async with _pg() as conn:
+                cur = await conn.execute("SELECT MAX(version) FROM schema_version")
+                return (await cur.fetchone())[0] or 0
+        except psycopg2.errors.UndefinedTable:
+            return 0
+    else:
+        import aiosqlite
+        try:
+            async with _sqlite() as db:
+                cursor = await db.execute("SELECT MAX(version) FROM schema_version")
+                return (await cursor.fetchone())[0] or 0
+        except aiosqlite.OperationalError:
+            return 0
 
-        cur.execute("""
-            CREATE TABLE IF NOT EXISTS roulette_queue (
-                id SERIAL PRIMARY KEY,
-                user_id BIGINT REFERENCES users(user_id),
-                message TEXT NOT NULL,
-                created_at TIMESTAMP DEFAULT NOW(),
-                matched BOOLEAN DEFAULT FALSE
-            )
-        """)
 
-        cur.execute("""
-            CREATE TABLE IF NOT EXISTS compatibility_tests (
-                id TEXT PRIMARY KEY,
-                initiator_id BIGINT,
-                partner_id BIGINT,
-                initiator_answers TEXT,
-                partner_answers TEXT,
-                result_percent INTEGER,
-                is_paid BOOLEAN DEFAULT FALSE,
-                created_at TIMESTAMP DEFAULT NOW()
-            )
-        """)
+# ---------------------------------------------------------------------------
+# Schema migrations — (version, description, postgres DDL, sqlite DDL).
+# Append new versions at the end; never edit one that has shipped.
+# ---------------------------------------------------------------------------
 
+_SCHEMA_V1_PG = (
+    """
+        CREATE TABLE IF NOT EXISTS users (
+            user_id BIGINT PRIMARY KEY,
+            username TEXT,
+            first_name TEXT,
+            registered_at TIMESTAMP DEFAULT NOW(),
+            free_sends_today INTEGER DEFAULT 0,
+            last_send_date DATE,
+            bonus_valentines INTEGER DEFAULT 0,
+            zodiac_sign TEXT,
+            chain_count INTEGER DEFAULT 0,
+            roulette_uses_today INTEGER DEFAULT 0,
+            last_roulette_date DATE,
+            roulette_free_until TIMESTAMP
+        )
+    """,
+    """
+        CREATE TABLE IF NOT EXISTS valentines (
+            id SERIAL PRIMARY KEY,
+            sender_id BIGINT REFERENCES users(user_id),
+            receiver_id BIGINT REFERENCES users(user_id),
+            message TEXT NOT NULL,
+            is_premium BOOLEAN DEFAULT FALSE,
+            is_poem BOOLEAN DEFAULT FALSE,
+            is_revealed BOOLEAN DEFAULT FALSE,
+            is_delivered BOOLEAN DEFAULT FALSE,
+            reaction TEXT,
+            voice_file_id TEXT,
+            photo_file_id TEXT,
+            gift_emoji TEXT,
+            music_url TEXT,
+            scheduled_for TIMESTAMP,
+            is_scheduled_sent BOOLEAN DEFAULT FALSE,
+            created_at TIMESTAMP DEFAULT NOW()
+        )
+    """,
+    """
+        CREATE TABLE IF NOT EXISTS payments (
+            id SERIAL PRIMARY KEY,
+            user_id BIGINT REFERENCES users(user_id),
+            amount INTEGER,
+            type TEXT,
+            valentine_id INTEGER,
+            telegram_payment_charge_id TEXT,
+            created_at TIMESTAMP DEFAULT NOW()
+        )
+    """,
+    """
+        CREATE TABLE IF NOT EXISTS anon_chats (
+            id TEXT PRIMARY KEY,
+            valentine_id INTEGER,
+            created_at TIMESTAMP DEFAULT NOW()
+        )
+    """,
+    """
+        CREATE TABLE IF NOT EXISTS anon_messages (
+            id SERIAL PRIMARY KEY,
+            chat_id TEXT,
+            from_sender BOOLEAN,
+            text TEXT,
+            created_at TIMESTAMP DEFAULT NOW()
+        )
+    """,
+    """
+        CREATE TABLE IF NOT EXISTS roulette_queue (
+            id SERIAL PRIMARY KEY,
+            user_id BIGINT REFERENCES users(user_id),
+            message TEXT NOT NULL,
+            created_at TIMESTAMP DEFAULT NOW(),
+            matched BOOLEAN DEFAULT FALSE
+        )
+    """,
+    """
+        CREATE TABLE IF NOT EXISTS compatibility_tests (
+            id TEXT PRIMARY KEY,
+            initiator_id BIGINT,
+            partner_id BIGINT,
+            initiator_answers TEXT,
+            partner_answers TEXT,
+            result_percent INTEGER,
+            is_paid BOOLEAN DEFAULT FALSE,
+            created_at TIMESTAMP DEFAULT NOW()
+        )
+    """,
+    """
+        CREATE TABLE IF NOT EXISTS achievements (
+            user_id BIGINT REFERENCES users(user_id),
+            badge TEXT NOT NULL,
+            earned_at TIMESTAMP DEFAULT NOW(),
+            PRIMARY KEY (user_id, badge)
+        )
+    """,
+    """
+        CREATE TABLE IF NOT EXISTS subscriptions (
+            id SERIAL PRIMARY KEY,
+            user_id BIGINT REFERENCES users(user_id),
+            plan TEXT NOT NULL,
+            started_at TIMESTAMP DEFAULT NOW(),
+            expires_at TIMESTAMP NOT NULL,
+            telegram_payment_charge_id TEXT,
+            is_active BOOLEAN DEFAULT TRUE
+        )
+    """,
+)
+
+_SCHEMA_V1_SQLITE = (
+    """
+        CREATE TABLE IF NOT EXISTS users (
+            user_id INTEGER PRIMARY KEY,
+            username TEXT,
+            first_name TEXT,
+            registered_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            free_sends_today INTEGER DEFAULT 0,
+            last_send_date DATE,
+            bonus_valentines INTEGER DEFAULT 0,
+            zodiac_sign TEXT,
+            chain_count INTEGER DEFAULT 0,
+            roulette_uses_today INTEGER DEFAULT 0,
+            last_roulette_date DATE,
+            roulette_free_until TIMESTAMP
+        )
+    """,
+    """
+        CREATE TABLE IF NOT EXISTS valentines (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            sender_id INTEGER REFERENCES users(user_id),
+            receiver_id INTEGER REFERENCES users(user_id),
+            message TEXT NOT NULL,
+            is_premium BOOLEAN DEFAULT FALSE,
+            is_poem BOOLEAN DEFAULT FALSE,
+            is_revealed BOOLEAN DEFAULT FALSE,
+            is_delivered BOOLEAN DEFAULT FALSE,
+            reaction TEXT,
+            voice_file_id TEXT,
+            photo_file_id TEXT,
+            gift_emoji TEXT,
+            music_url TEXT,
+            scheduled_for TIMESTAMP,
+            is_scheduled_sent BOOLEAN DEFAULT FALSE,
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        )
+    """,
+    """
+        CREATE TABLE IF NOT EXISTS payments (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            user_id INTEGER REFERENCES users(user_id),
+            amount INTEGER,
+            type TEXT,
+            valentine_id INTEGER,
+            telegram_payment_charge_id TEXT,
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        )
+    """,
+    """
+        CREATE TABLE IF NOT EXISTS anon_chats (
+            id TEXT PRIMARY KEY,
+            valentine_id INTEGER,
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        )
+    """,
+    """
+        CREATE TABLE IF NOT EXISTS anon_messages (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            chat_id TEXT,
+            from_sender BOOLEAN,
+            text TEXT,
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        )
+    """,
+    """
+        CREATE TABLE IF NOT EXISTS roulette_queue (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            user_id INTEGER REFERENCES users(user_id),
+            message TEXT NOT NULL,
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            matched BOOLEAN DEFAULT FALSE
+        )
+    """,
+    """
+        CREATE TABLE IF NOT EXISTS compatibility_tests (
+            id TEXT PRIMARY KEY,
+            initiator_id INTEGER,
+            partner_id INTEGER,
+            initiator_answers TEXT,
+            partner_answers TEXT,
+            result_percent INTEGER,
+            is_paid BOOLEAN DEFAULT FALSE,
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        )
+    """,
+    """
+        CREATE TABLE IF NOT EXISTS achievements (
+            user_id INTEGER REFERENCES users(user_id),
+            badge TEXT NOT NULL,
+            earned_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            PRIMARY KEY (user_id, badge)
+        )
+    """,
+    """
+        CREATE TABLE IF NOT EXISTS subscriptions (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            user_id INTEGER REFERENCES users(user_id),
+            plan TEXT NOT NULL,
+            started_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            expires_at TIMESTAMP NOT NULL,
+            telegram_payment_charge_id TEXT,
+            is_active BOOLEAN DEFAULT TRUE
+        )
+    """,
+)
+
+# Indexes for the hot query paths:
+#   get_inbox / counters "received"                 -> idx_valentines_inbox (v5: _keyset)
+#   counters "sent"                                 -> idx_valentines_sender
+#   counters "revealed"                             -> idx_valentines_revealed
+#   claim_scheduled                                 -> idx_valentines_scheduled
+#   claim_roulette_match                            -> idx_roulette_waiting
+#   get_active_subscription                         -> idx_subscriptions_active
+#   find_user_by_username                           -> idx_users_username_lower
+_HOT_PATH_INDEXES = (
+    """CREATE INDEX IF NOT EXISTS idx_valentines_inbox
+       ON valentines (receiver_id, created_at DESC) WHERE is_delivered = TRUE""",
+    """CREATE INDEX IF NOT EXISTS idx_valentines_sender
+       ON valentines (sender_id)""",
+    """CREATE INDEX IF NOT EXISTS idx_valentines_revealed
+       ON valentines (receiver_id) WHERE is_revealed = TRUE""",
+    """CREATE INDEX IF NOT EXISTS idx_valentines_scheduled
+       ON valentines (scheduled_for)
+       WHERE is_scheduled_sent = FALSE AND is_delivered = FALSE""",
+    """CREATE INDEX IF NOT EXISTS idx_roulette_waiting
+       ON roulette_queue (created_at) WHERE matched = FALSE""",
+    """CREATE INDEX IF NOT EXISTS idx_subscriptions_active
+       ON subscriptions (user_id, expires_at DESC) WHERE is_active = TRUE""",
+    """CREATE INDEX IF NOT EXISTS idx_users_username_lower
+       ON users (LOWER(username))""",
+)
+
+# Per-user counters kept on the users row so get_user_stats is a PK lookup.
+# Writes bump them in the same transaction; these queries are the source of
+# truth for the backfill and repair_user_counters().
+_USER_COUNTERS = (
+    ("sent_count", "SELECT COUNT(*) FROM valentines WHERE sender_id = users.user_id"),
+    ("received_count", "SELECT COUNT(*) FROM valentines "
+                       "WHERE receiver_id = users.user_id AND is_delivered = TRUE"),
+    ("revealed_count", "SELECT COUNT(*) FROM valentines "
+                       "WHERE receiver_id = users.user_id AND is_revealed = TRUE"),
+    ("badge_count", "SELECT COUNT(*) FROM achievements WHERE user_id = users.user_id"),
+)
+_BACKFILL_COUNTERS = "UPDATE users SET " + ", ".join(
+    f"{column} = ({query})" for column, query in _USER_COUNTERS
+)
+_REPAIR_COUNTERS = _BACKFILL_COUNTERS + " WHERE " + " OR ".join(
+    f"{column} <> ({query})" for column, query in _USER_COUNTERS
+)
+
+_USER_COUNTERS_PG = tuple(
+    f"ALTER TABLE users ADD COLUMN IF NOT EXISTS {column} INTEGER NOT NULL DEFAULT 0"
+    for column, _ in _USER_COUNTERS
+) + (_BACKFILL_COUNTERS,)
+_USER_COUNTERS_SQLITE = tuple(
+    f"ALTER TABLE users ADD COLUMN {column} INTEGER NOT NULL DEFAULT 0"
+    for column, _ in _USER_COUNTERS
+) + (_BACKFILL_COUNTERS,)
+
+# Leaderboard: per-day rollup for the day/week windows, bumped on send and
+# delivery; all-time tops read the users counters through partial indexes.
+# The backfill buckets deliveries by created_at (there is no delivered_at).
+_LEADERBOARD_BACKFILL = (
+    """INSERT INTO leaderboard_daily (day, user_id, sent)
+       SELECT DATE(created_at), sender_id, COUNT(*) FROM valentines
+       WHERE sender_id IS NOT NULL
+       GROUP BY DATE(created_at), sender_id""",
+    """INSERT INTO leaderboard_daily (day, user_id, received)
+       SELECT DATE(created_at), receiver_id, COUNT(*) FROM valentines
+       WHERE receiver_id IS NOT NULL AND is_delivered = TRUE
+       GROUP BY DATE(created_at), receiver_id
+       ON CONFLICT (day, user_id) DO UPDATE SET received = excluded.received""",
+    """CREATE INDEX IF NOT EXISTS idx_users_top_received
+       ON users (received_count DESC) WHERE received_count > 0""",
+    """CREATE INDEX IF NOT EXISTS idx_users_top_sent
+       ON users (sent_count DESC) WHERE sent_count > 0""",
+)
+_LEADERBOARD_PG = (
+    """
+        CREATE TABLE IF NOT EXISTS leaderboard_daily (
+            day DATE NOT NULL,
+            user_id BIGINT NOT NULL,
+            sent INTEGER NOT NULL DEFAULT 0,
+            received INTEGER NOT NULL DEFAULT 0,
+            PRIMARY KEY (day, user_id)
+        )
+    """,
+) + _LEADERBOARD_BACKFILL
+_LEADERBOARD_SQLITE = (
+    """
+        CREATE TABLE IF NOT EXISTS leaderboard_daily (
+            day DATE NOT NULL,
+            user_id INTEGER NOT NULL,
+            sent INTEGER NOT NULL DEFAULT 0,
+            received INTEGER NOT NULL DEFAULT 0,
+            PRIMARY KEY (day, user_id)
+        )
+    """,
+) + _LEADERBOARD_BACKFILL
+
+# Inbox keyset pagination orders by (created_at, id); replaces idx_valentines_inbox
+_INBOX_KEYSET_INDEX = (
+    """CREATE INDEX IF NOT EXISTS idx_valentines_inbox_keyset
+       ON valentines (receiver_id, created_at DESC, id DESC) WHERE is_delivered = TRUE""",
+    "DROP INDEX IF EXISTS idx_valentines_inbox",
+)
+
+# Delivery lease for scheduled valentines; due rows are still found through
+# the partial idx_valentines_scheduled
+_SCHEDULED_LEASE = (
+    "ALTER TABLE valentines ADD COLUMN lease_until TIMESTAMP",
+)
+
+# Webhook updates acknowledged before processing; a row lives until its
+# update has been handled, so a crashed worker's updates are picked up again
+_UPDATE_SPOOL_PG = (
+    """
+        CREATE TABLE IF NOT EXISTS update_spool (
+            update_id BIGINT PRIMARY KEY,
+            payload TEXT NOT NULL,
+            received_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            lease_until TIMESTAMP
+        )
+    """,
+)
+_UPDATE_SPOOL_SQLITE = (
+    """
+        CREATE TABLE IF NOT EXISTS update_spool (
+            update_id INTEGER PRIMARY KEY,
+            payload TEXT NOT NULL,
+            received_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            lease_until TIMESTAMP
+        )
+    """,
+)
+
+# update_ids the webhook has claimed; a claim that never finished is taken
+# over once its lease runs out, finished rows are pruned after a TTL
+_PROCESSED_UPDATES_PG = (
+    """
+        CREATE TABLE IF NOT EXISTS processed_updates (
+            update_id BIGINT PRIMARY KEY,
+            claimed_at TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP,
+            lease_until TIMESTAMP,
+            done BOOLEAN NOT NULL DEFAULT FALSE
+        )
+    """,
+    "CREATE INDEX IF NOT EXISTS idx_processed_updates_claimed ON processed_updates (claimed_at)",
+)
+_PROCESSED_UPDATES_SQLITE = (
+    """
+        CREATE TABLE IF NOT EXISTS processed_updates (
+            update_id INTEGER PRIMARY KEY,
+            claimed_at TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP,
+            lease_until TIMESTAMP,
+            done BOOLEAN NOT NULL DEFAULT FALSE
+        )
+    """,
+    "CREATE INDEX IF NOT EXISTS idx_processed_updates_claimed ON processed_updates (claimed_at)",
+)
+
+# Roulette entries remember whether their slot was bought with Stars, so an
+# expired paid entry is refunded as a credit for another paid match
+_ROULETTE_PAID_CREDITS = (
+    "ALTER TABLE roulette_queue ADD COLUMN paid BOOLEAN DEFAULT FALSE",
+    "ALTER TABLE users ADD COLUMN roulette_paid_credits INTEGER DEFAULT 0",
+)
+
+_MIGRATIONS = [
+    (1, "initial schema", _SCHEMA_V1_PG, _SCHEMA_V1_SQLITE),
+    (2, "hot-path indexes", _HOT_PATH_INDEXES, _HOT_PATH_INDEXES),
+    (3, "user stat counters", _USER_COUNTERS_PG, _USER_COUNTERS_SQLITE),
+    (4, "leaderboard rollup", _LEADERBOARD_PG, _LEADERBOARD_SQLITE),
+    (5, "inbox keyset index", _INBOX_KEYSET_INDEX, _INBOX_KEYSET_INDEX),
+    (6, "scheduled delivery lease", _SCHEDULED_LEASE, _SCHEDULED_LEASE),
+    (7, "webhook update spool", _UPDATE_SPOOL_PG, _UPDATE_SPOOL_SQLITE),
+    (8, "processed update ids", _PROCESSED_UPDATES_PG, _PROCESSED_UPDATES_SQLITE),
+    (9, "paid roulette credits", _ROULETTE_PAID_CREDITS, _ROULETTE_PAID_CREDITS),
+]
+
+SCHEMA_VERSION = _MIGRATIONS[-1][0]
+
+# Arbitrary key so concurrent cold starts don't migrate at the same time
+_MIGRATION_LOCK_ID = 0x56414C45
+
+
+def _migrate_pg():
+    """Apply pending migrations to Postgres in one transaction"""
+    conn = _get_pg_conn()
+    try:
+        conn.autocommit = False
+        cur = conn.cursor()
+        cur.execute("SELECT pg_advisory_xact_lock(%s)", (_MIGRATION_LOCK_ID,))
         cur.execute("""
-            CREATE TABLE IF NOT EXISTS achievements (
-                user_id BIGINT REFERENCES users(user_id),
-                badge TEXT NOT NULL,
-                earned_at TIMESTAMP DEFAULT NOW(),
-                PRIMARY KEY (user_id, badge)
+            CREATE TABLE IF NOT EXISTS schema_version (
+                version INTEGER PRIMARY KEY,
+                description TEXT,
+                applied_at TIMESTAMP DEFAULT NOW()
             )
         """)
-
-        cur.execute("""
-            CREATE TABLE IF NOT EXISTS subscriptions (
-                id SERIAL PRIMARY KEY,
-                user_id BIGINT REFERENCES users(user_id),
-                plan TEXT NOT NULL,
-                started_at TIMESTAMP DEFAULT NOW(),
-                expires_at TIMESTAMP NOT NULL,
-                telegram_payment_charge_id TEXT,
-                is_active BOOLEAN DEFAULT TRUE
+        cur.execute("SELECT version FROM schema_version")
+        applied = {row[0] for row in cur.fetchall()}
+
+        for version, description, pg_statements, _ in _MIGRATIONS:
+            if version in applied:
+                continue
+            for statement in pg_statements:
+                cur.execute(statement)
+            cur.execute(
+                "INSERT INTO schema_version (version, description) VALUES (%s, %s)",
+                (version, description)
             )
-        """)
+            logger.info(f"Applied migration {version}: {description}")
 
         conn.commit()
-        logger.info("Postgres database initialized")
+        logger.info(f"Postgres schema at version {SCHEMA_VERSION}")
     finally:
-        conn.close()
+        _put_pg_conn(conn)
 
 
-async def _init_db_sqlite():
-    """Initialize SQLite tables (local dev)"""
-    import aiosqlite
-    async with aiosqlite.connect(config.DATABASE_PATH) as db:
-        await db.execute("""
-            CREATE TABLE IF NOT EXISTS users (
-                user_id INTEGER PRIMARY KEY,
-                username TEXT,
-                first_name TEXT,
-                registered_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-                free_sends_today INTEGER DEFAULT 0,
-                last_send_date DATE,
-                bonus_valentines INTEGER DEFAULT 0,
-                zodiac_sign TEXT,
-                chain_count INTEGER DEFAULT 0,
-                roulette_uses_today INTEGER DEFAULT 0,
-                last_roulette_date DATE,
-                roulette_free_until TIMESTAMP
-            )
-        """)
-        await db.execute("""
-            CREATE TABLE IF NOT EXISTS valentines (
-                id INTEGER PRIMARY KEY AUTOINCREMENT,
-                sender_id INTEGER REFERENCES users(user_id),
-                receiver_id INTEGER REFERENCES users(user_id),
-                message TEXT NOT NULL,
-                is_premium BOOLEAN DEFAULT FALSE,
-                is_poem BOOLEAN DEFAULT FALSE,
-                is_revealed BOOLEAN DEFAULT FALSE,
-                is_delivered BOOLEAN DEFAULT FALSE,
-                reaction TEXT,
-                voice_file_id TEXT,
-                photo_file_id TEXT,
-                gift_emoji TEXT,
-                music_url TEXT,
-                scheduled_for TIMESTAMP,
-                is_scheduled_sent BOOLEAN DEFAULT FALSE,
-                created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
-            )
-        """)
-        await db.execute("""
-            CREATE TABLE IF NOT EXISTS payments (
-                id INTEGER PRIMARY KEY AUTOINCREMENT,
-                user_id INTEGER REFERENCES users(user_id),
-                amount INTEGER,
-                type TEXT,
-                valentine_id INTEGER,
-                telegram_payment_charge_id TEXT,
-                created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
-            )
-        """)
-        await db.execute("""
-            CREATE TABLE IF NOT EXISTS anon_chats (
-                id TEXT PRIMARY KEY,
-                valentine_id INTEGER,
-                created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
-            )
-        """)
-        await db.execute("""
-            CREATE TABLE IF NOT EXISTS anon_messages (
-                id INTEGER PRIMARY KEY AUTOINCREMENT,
-                chat_id TEXT,
-                from_sender BOOLEAN,
-                text TEXT,
-                created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
-            )
-        """)
+async def _migrate_sqlite():
+    """Apply pending migrations to SQLite, one transaction per version"""
+    async with _sqlite() as db:
         await db.execute("""
-            CREATE TABLE IF NOT EXISTS roulette_queue (
-                id INTEGER PRIMARY KEY AUTOINCREMENT,
-                user_id INTEGER REFERENCES users(user_id),
-                message TEXT NOT NULL,
-                created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-                matched BOOLEAN DEFAULT FALSE
+            CREATE TABLE IF NOT EXISTS schema_version (
+                version INTEGER PRIMARY KEY,
+                description TEXT,
+                applied_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
             )
         """)
-        await db.execute("""
-            CREATE TABLE IF NOT EXISTS compatibility_tests (
-                id TEXT PRIMARY KEY,
-                initiator_id INTEGER,
-                partner_id INTEGER,
-                initiator_answers TEXT,
-                partner_answers TEXT,
-                result_percent INTEGER,
-                is_paid BOOLEAN DEFAULT FALSE,
-                created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
-            )
-        """)
-        await db.execute("""
-            CREATE TABLE IF NOT EXISTS achievements (
-                user_id INTEGER REFERENCES users(user_id),
-                badge TEXT NOT NULL,
-                earned_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-                PRIMARY KEY (user_id, badge)
-            )
-        """)
-        await db.execute("""
-            CREATE TABLE IF NOT EXISTS subscriptions (
-                id INTEGER PRIMARY KEY AUTOINCREMENT,
-                user_id INTEGER REFERENCES users(user_id),
-                plan TEXT NOT NULL,
-                started_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-                expires_at TIMESTAMP NOT NULL,
-                telegram_payment_charge_id TEXT,
-                is_active BOOLEAN DEFAULT TRUE
+        cursor = await db.execute("SELECT version FROM schema_version")
+        applied = {row[0] for row in await cursor.fetchall()}
+
+        for version, description, _, sqlite_statements in _MIGRATIONS:
+            if version in applied:
+                continue
+            # sqlite3 doesn't open implicit transactions for DDL
+            await db.execute("BEGIN")
+            for statement in sqlite_statements:
+                await db.execute(statement)
+            await db.execute(
+                "INSERT INTO schema_version (version, description) VALUES (?, ?)",
+                (version, description)
             )
-        """)
-        await db.commit()
-        logger.info("SQLite database initialized")
+            await db.commit()
+            logger.info(f"Applied migration {version}: {description}")
+
+        logger.info(f"SQLite schema at version {SCHEMA_VERSION}")
 
 
 # ==================== USER OPERATIONS ====================
 
+# Last profile written per user, so repeated /start and menu traffic skips the upsert
+_recent_profiles = {}  # user_id -> (username, first_name)
+_RECENT_PROFILES_MAX = 10000
+
+_UPSERT_USER_PG = """
+    INSERT INTO users (user_id, username, first_name) VALUES (%(user_id)s, %(username)s, %(first_name)s)
+    ON CONFLICT (user_id) DO UPDATE SET
+        username = COALESCE(EXCLUDED.username, users.username),
+        first_name = COALESCE(EXCLUDED.first_name, users.first_name)
+    WHERE users.username IS DISTINCT FROM COALESCE(EXCLUDED.username, users.username)
+       OR users.first_name IS DISTINCT FROM COALESCE(EXCLUDED.first_name, users.first_name)
+    RETURNING *
+"""
+_UPSERT_USER_SQLITE = """
+    INSERT INTO users (user_id, username, first_name) VALUES (:user_id, :username, :first_name)
+    ON CONFLICT (user_id) DO UPDATE SET
+        username = COALESCE(excluded.username, users.username),
+        first_name = COALESCE(excluded.first_name, users.first_name)
+    WHERE users.username IS NOT COALESCE(excluded.username, users.username)
+       OR users.first_name IS NOT COALESCE(excluded.first_name, users.first_name)
+"""
+
+
 async def get_or_create_user(user_id: int, username: Optional[str] = None,
                              first_name: Optional[str] = None) -> dict:
-    """Get existing user or create new one"""
-    if _use_postgres:
-        conn = _get_pg_conn()
-        try:
-            cur = conn.cursor()
-            cur.execute("SELECT * FROM users WHERE user_id = %s", (user_id,))
-            row = _fetchone_dict(cur)
-
-            if row:
-                if username or first_name:
-                    cur.execute(
-                        "UPDATE users SET username = %s, first_name = %s WHERE user_id = %s",
-                        (username or row['username'], first_name or row['first_name'], user_id)
-                    )
-                    conn.commit()
-                return row
+    """Get existing user or create new one
 
-            cur.execute(
-                "INSERT INTO users (user_id, username, first_name) VALUES (%s, %s, %s)",
-                (user_id, username, first_name)
-            )
-            conn.commit()
-            cur.execute("SELECT * FROM users WHERE user_id = %s", (user_id,))
-            return _fetchone_dict(cur)
-        finally:
-            conn.close()
+    One upsert that only writes when the profile actually changed (missing
+    fields never overwrite stored ones); a profile seen recently is just read.
+    """
+    params = {"user_id": user_id, "username": username or None, "first_name": first_name or None}
+    profile = (params["username"], params["first_name"])
+    known = _recent_profiles.get(user_id) == profile or profile == (None, None)
+
+    if _use_postgres:
+        async with _pg() as conn:
+            if known:
+                cur = await conn.execute("SELECT * FROM users WHERE user_id = %s", (user_id,))
+                row = await cur.fetchone()
+                if row:
+                    return dict(row)
+            # Unchanged rows come back from the second branch, without a write
+            cur = await conn.execute(
+                f"""WITH upserted AS ({_UPSERT_USER_PG})
+                    SELECT * FROM upserted
+                    UNION ALL
+                    SELECT * FROM users
+                    WHERE user_id = %(user_id)s AND NOT EXISTS (SELECT 1 FROM upserted)""",
+                params
+            )
+            row = await cur.fetchone()
+            if row is None:
+                # Created by a concurrent call since this statement's snapshot;
+                # the conflict left it untouched and the snapshot can't see it
+                cur = await conn.execute("SELECT * FROM users WHERE user_id = %s", (user_id,))
+                row = await cur.fetchone()
+            await conn.commit()
     else:
-        import aiosqlite
-        async with aiosqlite.connect(config.DATABASE_PATH) as db:
-            db.row_factory = aiosqlite.Row
-            cursor = await db.execute("SELECT * FROM users WHERE user_id = ?", (user_id,))
-            row = await cursor.fetchone()
-            if row:
-                if username or first_name:
-                    await db.execute(
-                        "UPDATE users SET username = ?, first_name = ? WHERE user_id = ?",
-                        (username or row['username'], first_name or row['first_name'], user_id)
-                    )
-                    await db.commit()
-                return dict(row)
-            await db.execute(
-                "INSERT INTO users (user_id, username, first_name) VALUES (?, ?, ?)",
-                (user_id, username, first_name)
-            )
+        async with _sqlite() as db:
+            if known:
+                cursor = await db.execute("SELECT * FROM users WHERE user_id = ?", (user_id,))
+                row = await cursor.fetchone()
+                if row:
+                    return dict(row)
+            await db.execute(_UPSERT_USER_SQLITE, params)
             await db.commit()
             cursor = await db.execute("SELECT * FROM users WHERE user_id = ?", (user_id,))
             row = await cursor.fetchone()
-            return dict(row)
+
+    if profile != (None, None) and _active_session() is None:
+        if len(_recent_profiles) >= _RECENT_PROFILES_MAX:
+            _recent_profiles.pop(next(iter(_recent_profiles)))
+        _recent_profiles[user_id] = profile
+    return dict(row)
 
 
 async def set_zodiac(user_id: int, sign: str):
     """Set user's zodiac sign"""
     if _use_postgres:
-        conn = _get_pg_conn()
-        try:
-            cur = conn.cursor()
-            cur.execute("UPDATE users SET zodiac_sign = %s WHERE user_id = %s", (sign, user_id))
-            conn.commit()
-        finally:
-            conn.close()
+        async with _pg() as conn:
+            await conn.execute("UPDATE users SET zodiac_sign = %s WHERE user_id = %s", (sign, user_id))
+            await conn.commit()
     else:
-        import aiosqlite
-        async with aiosqlite.connect(config.DATABASE_PATH) as db:
+        async with _sqlite() as db:
             await db.execute("UPDATE users SET zodiac_sign = ? WHERE user_id = ?", (sign, user_id))
             await db.commit()
 
@@ -366,17 +952,12 @@ async def set_zodiac(user_id: int, sign: str):
 async def get_user_zodiac(user_id: int) -> Optional[str]:
     """Get user's zodiac sign"""
     if _use_postgres:
-        conn = _get_pg_conn()
-        try:
-            cur = conn.cursor()
-            cur.execute("SELECT zodiac_sign FROM users WHERE user_id = %s", (user_id,))
-            row = cur.fetchone()
+        async with _pg() as conn:
+            cur = await conn.execute("SELECT zodiac_sign FROM users WHERE user_id = %s", (user_id,))
+            row = await cur.fetchone()
             return row[0] if row else None
-        finally:
-            conn.close()
     else:
-        import aiosqlite
-        async with aiosqlite.connect(config.DATABASE_PATH) as db:
+        async with _sqlite() as db:
             cursor = await db.execute("SELECT zodiac_sign FROM users WHERE user_id = ?", (user_id,))
             row = await cursor.fetchone()
             return row[0] if row else None
@@ -385,21 +966,16 @@ async def get_user_zodiac(user_id: int) -> Optional[str]:
 async def increment_chain(user_id: int) -> int:
     """Increment chain count and return new count"""
     if _use_postgres:
-        conn = _get_pg_conn()
-        try:
-            cur = conn.cursor()
-            cur.execute(
+        async with _pg() as conn:
+            cur = await conn.execute(
                 "UPDATE users SET chain_count = chain_count + 1 WHERE user_id = %s RETURNING chain_count",
                 (user_id,)
             )
-            row = cur.fetchone()
-            conn.commit()
+            row = await cur.fetchone()
+            await conn.commit()
             return row[0] if row else 0
-        finally:
-            conn.close()
     else:
-        import aiosqlite
-        async with aiosqlite.connect(config.DATABASE_PATH) as db:
+        async with _sqlite() as db:
             await db.execute(
                 "UPDATE users SET chain_count = chain_count + 1 WHERE user_id = ?", (user_id,)
             )
@@ -411,133 +987,127 @@ async def increment_chain(user_id: int) -> int:
 
 # ==================== SEND LIMITS ====================
 
+async def _active_plan(user_id: int) -> Optional[str]:
+    """Plan of the user's active subscription (served from the subscription cache)"""
+    sub = await get_active_subscription(user_id)
+    return sub['plan'] if sub else None
+
+
 async def can_send_free(user_id: int) -> bool:
     """Check if user can send free valentine today (respects subscription)"""
     from config import FREE_DAILY_LIMIT, ROMANTIC_DAILY_LIMIT
 
-    sub = await get_active_subscription(user_id)
-    if sub and sub['plan'] == 'lovebomb':
+    plan = await _active_plan(user_id)
+    if plan == 'lovebomb':
         return True
-
-    daily_limit = FREE_DAILY_LIMIT
-    if sub and sub['plan'] == 'romantic':
-        daily_limit = ROMANTIC_DAILY_LIMIT
+    daily_limit = ROMANTIC_DAILY_LIMIT if plan == 'romantic' else FREE_DAILY_LIMIT
 
     if _use_postgres:
-        conn = _get_pg_conn()
-        try:
-            cur = conn.cursor()
-            cur.execute(
+        async with _pg() as conn:
+            cur = await conn.execute(
                 "SELECT free_sends_today, last_send_date, bonus_valentines FROM users WHERE user_id = %s",
                 (user_id,)
             )
-            row = _fetchone_dict(cur)
-            if not row:
-                return True
+            row = await cur.fetchone()
             today = date.today()
-            if row['last_send_date'] != today:
-                return True
-            if row['bonus_valentines'] > 0:
-                return True
-            return row['free_sends_today'] < daily_limit
-        finally:
-            conn.close()
     else:
-        import aiosqlite
-        async with aiosqlite.connect(config.DATABASE_PATH) as db:
-            db.row_factory = aiosqlite.Row
+        async with _sqlite() as db:
             cursor = await db.execute(
                 "SELECT free_sends_today, last_send_date, bonus_valentines FROM users WHERE user_id = ?",
                 (user_id,)
             )
             row = await cursor.fetchone()
-            if not row:
-                return True
             today = date.today().isoformat()
-            if row['last_send_date'] != today:
-                return True
-            if row['bonus_valentines'] > 0:
-                return True
-            return row['free_sends_today'] < daily_limit
+
+    if not row:
+        return True
+
+    if row['last_send_date'] != today:
+        return True
+    if row['bonus_valentines'] > 0:
+        return True
+    return row['free_sends_today'] < daily_limit
 
 
 async def use_send_slot(user_id: int) -> bool:
-    """Use one send slot (free or bonus). Returns True if successful."""
-    today_val = date.today()
+    """Use one send slot (free or bonus). Returns True if successful.
 
+    Check and consume happen in one conditional UPDATE, so concurrent taps
+    can't both take the last slot: a new day resets the free counter, then
+    bonus valentines are spent, then free sends up to the plan's daily limit
+    (unlimited on lovebomb). Returns False when the user is over the limit.
+    """
+    from config import FREE_DAILY_LIMIT, ROMANTIC_DAILY_LIMIT
+
+    params = {
+        "user_id": user_id,
+        "plan": await _active_plan(user_id),
+        "free_limit": FREE_DAILY_LIMIT,
+        "romantic_limit": ROMANTIC_DAILY_LIMIT,
+    }
     if _use_postgres:
-        conn = _get_pg_conn()
-        try:
-            cur = conn.cursor()
-            cur.execute(
-                "SELECT free_sends_today, last_send_date, bonus_valentines FROM users WHERE user_id = %s",
-                (user_id,)
-            )
-            row = _fetchone_dict(cur)
-            if row['last_send_date'] != today_val:
-                cur.execute(
-                    "UPDATE users SET free_sends_today = 1, last_send_date = %s WHERE user_id = %s",
-                    (today_val, user_id)
-                )
-            elif row['bonus_valentines'] > 0:
-                cur.execute(
-                    "UPDATE users SET bonus_valentines = bonus_valentines - 1 WHERE user_id = %s",
-                    (user_id,)
-                )
-            else:
-                cur.execute(
-                    "UPDATE users SET free_sends_today = free_sends_today + 1, last_send_date = %s WHERE user_id = %s",
-                    (today_val, user_id)
-                )
-            conn.commit()
-            return True
-        finally:
-            conn.close()
+        params["today"] = date.today()
+        async with _pg() as conn:
+            cur = await conn.execute(
+                """UPDATE users SET
+                       free_sends_today = CASE
+                           WHEN last_send_date IS DISTINCT FROM %(today)s THEN 1
+                           WHEN bonus_valentines > 0 THEN free_sends_today
+                           ELSE free_sends_today + 1 END,
+                       bonus_valentines = CASE
+                           WHEN last_send_date IS DISTINCT FROM %(today)s THEN bonus_valentines
+                           WHEN bonus_valentines > 0 THEN bonus_valentines - 1
+                           ELSE bonus_valentines END,
+                       last_send_date = %(today)s
+                   WHERE user_id = %(user_id)s
+                     AND (last_send_date IS DISTINCT FROM %(today)s
+                          OR bonus_valentines > 0
+                          OR %(plan)s = 'lovebomb'
+                          OR free_sends_today < CASE %(plan)s
+                              WHEN 'romantic' THEN %(romantic_limit)s
+                              ELSE %(free_limit)s END)""",
+                params
+            )
+            await conn.commit()
+            return cur.rowcount > 0
     else:
-        import aiosqlite
-        async with aiosqlite.connect(config.DATABASE_PATH) as db:
-            db.row_factory = aiosqlite.Row
+        params["today"] = date.today().isoformat()
+        async with _sqlite() as db:
             cursor = await db.execute(
-                "SELECT free_sends_today, last_send_date, bonus_valentines FROM users WHERE user_id = ?",
-                (user_id,)
+                """UPDATE users SET
+                       free_sends_today = CASE
+                           WHEN last_send_date IS NOT :today THEN 1
+                           WHEN bonus_valentines > 0 THEN free_sends_today
+                           ELSE free_sends_today + 1 END,
+                       bonus_valentines = CASE
+                           WHEN last_send_date IS NOT :today THEN bonus_valentines
+                           WHEN bonus_valentines > 0 THEN bonus_valentines - 1
+                           ELSE bonus_valentines END,
+                       last_send_date = :today
+                   WHERE user_id = :user_id
+                     AND (last_send_date IS NOT :today
+                          OR bonus_valentines > 0
+                          OR :plan = 'lovebomb'
+                          OR free_sends_today < CASE :plan
+                              WHEN 'romantic' THEN :romantic_limit
+                              ELSE :free_limit END)""",
+                params
             )
-            row = await cursor.fetchone()
-            today = date.today().isoformat()
-            if row['last_send_date'] != today:
-                await db.execute(
-                    "UPDATE users SET free_sends_today = 1, last_send_date = ? WHERE user_id = ?",
-                    (today, user_id)
-                )
-            elif row['bonus_valentines'] > 0:
-                await db.execute(
-                    "UPDATE users SET bonus_valentines = bonus_valentines - 1 WHERE user_id = ?",
-                    (user_id,)
-                )
-            else:
-                await db.execute(
-                    "UPDATE users SET free_sends_today = free_sends_today + 1, last_send_date = ? WHERE user_id = ?",
-                    (today, user_id)
-                )
             await db.commit()
-            return True
+            return cursor.rowcount > 0
 
 
 async def add_bonus_valentines(user_id: int, count: int = 5):
     """Add bonus valentines to user (from bundle purchase)"""
     if _use_postgres:
-        conn = _get_pg_conn()
-        try:
-            cur = conn.cursor()
-            cur.execute(
+        async with _pg() as conn:
+            await conn.execute(
                 "UPDATE users SET bonus_valentines = bonus_valentines + %s WHERE user_id = %s",
                 (count, user_id)
             )
-            conn.commit()
-        finally:
-            conn.close()
+            await conn.commit()
     else:
-        import aiosqlite
-        async with aiosqlite.connect(config.DATABASE_PATH) as db:
+        async with _sqlite() as db:
             await db.execute(
                 "UPDATE users SET bonus_valentines = bonus_valentines + ? WHERE user_id = ?",
                 (count, user_id)
@@ -554,10 +1124,9 @@ async def create_valentine(sender_id: int, receiver_id: int, message: str,
                           scheduled_for: str = None) -> int:
     """Create new valentine and return its ID"""
     if _use_postgres:
-        conn = _get_pg_conn()
-        try:
-            cur = conn.cursor()
-            cur.execute(
+        async with _pg() as conn:
+            await conn.begin()
+            cur = await conn.execute(
                 """INSERT INTO valentines
                    (sender_id, receiver_id, message, is_premium, is_poem,
                     voice_file_id, photo_file_id, gift_emoji, music_url, scheduled_for)
@@ -565,14 +1134,19 @@ async def create_valentine(sender_id: int, receiver_id: int, message: str,
                 (sender_id, receiver_id, message, is_premium, is_poem,
                  voice_file_id, photo_file_id, gift_emoji, music_url, scheduled_for)
             )
-            vid = cur.fetchone()[0]
-            conn.commit()
+            vid = (await cur.fetchone())[0]
+            await conn.execute(
+                "UPDATE users SET sent_count = sent_count + 1 WHERE user_id = %s", (sender_id,)
+            )
+            await conn.execute(
+                """INSERT INTO leaderboard_daily (day, user_id, sent) VALUES (%s, %s, 1)
+                   ON CONFLICT (day, user_id) DO UPDATE SET sent = leaderboard_daily.sent + 1""",
+                (date.today(), sender_id)
+            )
+            await conn.commit()
             return vid
-        finally:
-            conn.close()
     else:
-        import aiosqlite
-        async with aiosqlite.connect(config.DATABASE_PATH) as db:
+        async with _sqlite() as db:
             cursor = await db.execute(
                 """INSERT INTO valentines
                    (sender_id, receiver_id, message, is_premium, is_poem,
@@ -581,6 +1155,14 @@ async def create_valentine(sender_id: int, receiver_id: int, message: str,
                 (sender_id, receiver_id, message, is_premium, is_poem,
                  voice_file_id, photo_file_id, gift_emoji, music_url, scheduled_for)
             )
+            await db.execute(
+                "UPDATE users SET sent_count = sent_count + 1 WHERE user_id = ?", (sender_id,)
+            )
+            await db.execute(
+                """INSERT INTO leaderboard_daily (day, user_id, sent) VALUES (?, ?, 1)
+                   ON CONFLICT (day, user_id) DO UPDATE SET sent = leaderboard_daily.sent + 1""",
+                (date.today().isoformat(), sender_id)
+            )
             await db.commit()
             return cursor.lastrowid
 
@@ -588,17 +1170,12 @@ async def create_valentine(sender_id: int, receiver_id: int, message: str,
 async def get_valentine(valentine_id: int) -> Optional[dict]:
     """Get valentine by ID"""
     if _use_postgres:
-        conn = _get_pg_conn()
-        try:
-            cur = conn.cursor()
-            cur.execute("SELECT * FROM valentines WHERE id = %s", (valentine_id,))
-            return _fetchone_dict(cur)
-        finally:
-            conn.close()
+        async with _pg() as conn:
+            cur = await conn.execute("SELECT * FROM valentines WHERE id = %s", (valentine_id,))
+            row = await cur.fetchone()
+            return dict(row) if row else None
     else:
-        import aiosqlite
-        async with aiosqlite.connect(config.DATABASE_PATH) as db:
-            db.row_factory = aiosqlite.Row
+        async with _sqlite() as db:
             cursor = await db.execute("SELECT * FROM valentines WHERE id = ?", (valentine_id,))
             row = await cursor.fetchone()
             return dict(row) if row else None
@@ -607,92 +1184,129 @@ async def get_valentine(valentine_id: int) -> Optional[dict]:
 async def mark_delivered(valentine_id: int):
     """Mark valentine as delivered"""
     if _use_postgres:
-        conn = _get_pg_conn()
-        try:
-            cur = conn.cursor()
-            cur.execute("UPDATE valentines SET is_delivered = TRUE WHERE id = %s", (valentine_id,))
-            conn.commit()
-        finally:
-            conn.close()
+        async with _pg() as conn:
+            await conn.begin()
+            cur = await conn.execute(
+                "UPDATE valentines SET is_delivered = TRUE WHERE id = %s AND is_delivered IS NOT TRUE",
+                (valentine_id,)
+            )
+            if cur.rowcount:
+                await conn.execute(
+                    """UPDATE users SET received_count = received_count + 1
+                       WHERE user_id = (SELECT receiver_id FROM valentines WHERE id = %s)""",
+                    (valentine_id,)
+                )
+                await conn.execute(
+                    """INSERT INTO leaderboard_daily (day, user_id, received)
+                       SELECT %s, receiver_id, 1 FROM valentines
+                       WHERE id = %s AND receiver_id IS NOT NULL
+                       ON CONFLICT (day, user_id) DO UPDATE SET received = leaderboard_daily.received + 1""",
+                    (date.today(), valentine_id)
+                )
+            await conn.commit()
     else:
-        import aiosqlite
-        async with aiosqlite.connect(config.DATABASE_PATH) as db:
-            await db.execute("UPDATE valentines SET is_delivered = TRUE WHERE id = ?", (valentine_id,))
+        async with _sqlite() as db:
+            cursor = await db.execute(
+                "UPDATE valentines SET is_delivered = TRUE WHERE id = ? AND is_delivered IS NOT TRUE",
+                (valentine_id,)
+            )
+            if cursor.rowcount:
+                await db.execute(
+                    """UPDATE users SET received_count = received_count + 1
+                       WHERE user_id = (SELECT receiver_id FROM valentines WHERE id = ?)""",
+                    (valentine_id,)
+                )
+                await db.execute(
+                    """INSERT INTO leaderboard_daily (day, user_id, received)
+                       SELECT ?, receiver_id, 1 FROM valentines
+                       WHERE id = ? AND receiver_id IS NOT NULL
+                       ON CONFLICT (day, user_id) DO UPDATE SET received = leaderboard_daily.received + 1""",
+                    (date.today().isoformat(), valentine_id)
+                )
             await db.commit()
 
 
-async def get_inbox(user_id: int, limit: int = 10, offset: int = 0) -> list:
-    """Get user's incoming valentines with pagination"""
+async def get_inbox(user_id: int, limit: int = 10, older_than: Optional[int] = None,
+                    newer_than: Optional[int] = None) -> list:
+    """Get user's incoming valentines, newest first, one keyset page at a time
+
+    `older_than` / `newer_than` take the id of the last / first valentine on
+    the current page; the (created_at, id) cursor is looked up from it, so
+    every page is an index range scan however deep the user scrolls.
+    """
+    where = "v.receiver_id = {p} AND v.is_delivered = TRUE"
+    order = "DESC"
+    params = [user_id]
+    if older_than is not None:
+        where += " AND (v.created_at, v.id) < (SELECT created_at, id FROM valentines WHERE id = {p})"
+        params.append(older_than)
+    elif newer_than is not None:
+        where += " AND (v.created_at, v.id) > (SELECT created_at, id FROM valentines WHERE id = {p})"
+        params.append(newer_than)
+        order = "ASC"
+    params.append(limit)
+    sql = f"""SELECT v.*, u.username as sender_username, u.first_name as sender_first_name
+              FROM valentines v
+              LEFT JOIN users u ON v.sender_id = u.user_id
+              WHERE {where}
+              ORDER BY v.created_at {order}, v.id {order}
+              LIMIT {{p}}"""
+
     if _use_postgres:
-        conn = _get_pg_conn()
-        try:
-            cur = conn.cursor()
-            cur.execute(
-                """SELECT v.*, u.username as sender_username, u.first_name as sender_first_name
-                   FROM valentines v
-                   LEFT JOIN users u ON v.sender_id = u.user_id
-                   WHERE v.receiver_id = %s AND v.is_delivered = TRUE
-                   ORDER BY v.created_at DESC
-                   LIMIT %s OFFSET %s""",
-                (user_id, limit, offset)
-            )
-            return _fetchall_dict(cur)
-        finally:
-            conn.close()
+        async with _pg() as conn:
+            cur = await conn.execute(sql.format(p="%s"), params)
+            rows = [dict(row) for row in await cur.fetchall()]
     else:
-        import aiosqlite
-        async with aiosqlite.connect(config.DATABASE_PATH) as db:
-            db.row_factory = aiosqlite.Row
-            cursor = await db.execute(
-                """SELECT v.*, u.username as sender_username, u.first_name as sender_first_name
-                   FROM valentines v
-                   LEFT JOIN users u ON v.sender_id = u.user_id
-                   WHERE v.receiver_id = ? AND v.is_delivered = TRUE
-                   ORDER BY v.created_at DESC
-                   LIMIT ? OFFSET ?""",
-                (user_id, limit, offset)
-            )
-            return [dict(row) for row in await cursor.fetchall()]
+        async with _sqlite() as db:
+            cursor = await db.execute(sql.format(p="?"), params)
+            rows = [dict(row) for row in await cursor.fetchall()]
+    if order == "ASC":
+        rows.reverse()
+    return rows
 
 
 async def get_inbox_count(user_id: int) -> int:
-    """Get total count of user's incoming valentines"""
+    """Get total count of user's incoming valentines (maintained counter)"""
     if _use_postgres:
-        conn = _get_pg_conn()
-        try:
-            cur = conn.cursor()
-            cur.execute(
-                "SELECT COUNT(*) FROM valentines WHERE receiver_id = %s AND is_delivered = TRUE",
-                (user_id,)
-            )
-            return cur.fetchone()[0]
-        finally:
-            conn.close()
+        async with _pg() as conn:
+            cur = await conn.execute("SELECT received_count FROM users WHERE user_id = %s", (user_id,))
+            row = await cur.fetchone()
     else:
-        import aiosqlite
-        async with aiosqlite.connect(config.DATABASE_PATH) as db:
-            cursor = await db.execute(
-                "SELECT COUNT(*) FROM valentines WHERE receiver_id = ? AND is_delivered = TRUE",
-                (user_id,)
-            )
-            return (await cursor.fetchone())[0]
+        async with _sqlite() as db:
+            cursor = await db.execute("SELECT received_count FROM users WHERE user_id = ?", (user_id,))
+            row = await cursor.fetchone()
+    return row[0] if row else 0
 
 
 async def reveal_sender(valentine_id: int) -> bool:
     """Mark valentine sender as revealed"""
     if _use_postgres:
-        conn = _get_pg_conn()
-        try:
-            cur = conn.cursor()
-            cur.execute("UPDATE valentines SET is_revealed = TRUE WHERE id = %s", (valentine_id,))
-            conn.commit()
+        async with _pg() as conn:
+            await conn.begin()
+            cur = await conn.execute(
+                "UPDATE valentines SET is_revealed = TRUE WHERE id = %s AND is_revealed IS NOT TRUE",
+                (valentine_id,)
+            )
+            if cur.rowcount:
+                await conn.execute(
+                    """UPDATE users SET revealed_count = revealed_count + 1
+                       WHERE user_id = (SELECT receiver_id FROM valentines WHERE id = %s)""",
+                    (valentine_id,)
+                )
+            await conn.commit()
             return True
-        finally:
-            conn.close()
     else:
-        import aiosqlite
-        async with aiosqlite.connect(config.DATABASE_PATH) as db:
-            await db.execute("UPDATE valentines SET is_revealed = TRUE WHERE id = ?", (valentine_id,))
+        async with _sqlite() as db:
+            cursor = await db.execute(
+                "UPDATE valentines SET is_revealed = TRUE WHERE id = ? AND is_revealed IS NOT TRUE",
+                (valentine_id,)
+            )
+            if cursor.rowcount:
+                await db.execute(
+                    """UPDATE users SET revealed_count = revealed_count + 1
+                       WHERE user_id = (SELECT receiver_id FROM valentines WHERE id = ?)""",
+                    (valentine_id,)
+                )
             await db.commit()
             return True
 
@@ -702,21 +1316,16 @@ async def record_payment(user_id: int, amount: int, payment_type: str,
                         charge_id: Optional[str] = None):
     """Record successful payment"""
     if _use_postgres:
-        conn = _get_pg_conn()
-        try:
-            cur = conn.cursor()
-            cur.execute(
+        async with _pg() as conn:
+            await conn.execute(
                 """INSERT INTO payments
                    (user_id, amount, type, valentine_id, telegram_payment_charge_id)
                    VALUES (%s, %s, %s, %s, %s)""",
                 (user_id, amount, payment_type, valentine_id, charge_id)
             )
-            conn.commit()
-        finally:
-            conn.close()
+            await conn.commit()
     else:
-        import aiosqlite
-        async with aiosqlite.connect(config.DATABASE_PATH) as db:
+        async with _sqlite() as db:
             await db.execute(
                 """INSERT INTO payments
                    (user_id, amount, type, valentine_id, telegram_payment_charge_id)
@@ -727,67 +1336,58 @@ async def record_payment(user_id: int, amount: int, payment_type: str,
 
 
 async def get_user_stats(user_id: int) -> dict:
-    """Get user statistics"""
+    """Get user statistics (maintained counters, one primary-key lookup)"""
     if _use_postgres:
-        conn = _get_pg_conn()
-        try:
-            cur = conn.cursor()
-            cur.execute("SELECT COUNT(*) FROM valentines WHERE sender_id = %s", (user_id,))
-            sent = cur.fetchone()[0]
-            cur.execute(
-                "SELECT COUNT(*) FROM valentines WHERE receiver_id = %s AND is_delivered = TRUE",
-                (user_id,)
-            )
-            received = cur.fetchone()[0]
-            cur.execute(
-                "SELECT COUNT(*) FROM valentines WHERE receiver_id = %s AND is_revealed = TRUE",
+        async with _pg() as conn:
+            cur = await conn.execute(
+                """SELECT sent_count, received_count, revealed_count, badge_count, chain_count
+                   FROM users WHERE user_id = %s""",
                 (user_id,)
             )
-            revealed = cur.fetchone()[0]
-            cur.execute("SELECT COUNT(*) FROM achievements WHERE user_id = %s", (user_id,))
-            badges = cur.fetchone()[0]
-            cur.execute("SELECT chain_count FROM users WHERE user_id = %s", (user_id,))
-            row = cur.fetchone()
-            chain = row[0] if row else 0
-            return {"sent": sent, "received": received, "revealed": revealed, "badges": badges, "chain": chain}
-        finally:
-            conn.close()
+            row = await cur.fetchone()
     else:
-        import aiosqlite
-        async with aiosqlite.connect(config.DATABASE_PATH) as db:
-            cursor = await db.execute("SELECT COUNT(*) FROM valentines WHERE sender_id = ?", (user_id,))
-            sent = (await cursor.fetchone())[0]
-            cursor = await db.execute(
-                "SELECT COUNT(*) FROM valentines WHERE receiver_id = ? AND is_delivered = TRUE", (user_id,)
-            )
-            received = (await cursor.fetchone())[0]
+        async with _sqlite() as db:
             cursor = await db.execute(
-                "SELECT COUNT(*) FROM valentines WHERE receiver_id = ? AND is_revealed = TRUE", (user_id,)
+                """SELECT sent_count, received_count, revealed_count, badge_count, chain_count
+                   FROM users WHERE user_id = ?""",
+                (user_id,)
             )
-            revealed = (await cursor.fetchone())[0]
-            cursor = await db.execute("SELECT COUNT(*) FROM achievements WHERE user_id = ?", (user_id,))
-            badges = (await cursor.fetchone())[0]
-            cursor = await db.execute("SELECT chain_count FROM users WHERE user_id = ?", (user_id,))
             row = await cursor.fetchone()
-            chain = row[0] if row else 0
-            return {"sent": sent, "received": received, "revealed": revealed, "badges": badges, "chain": chain}
+    if not row:
+        return {"sent": 0, "received": 0, "revealed": 0, "badges": 0, "chain": 0}
+    return {
+        "sent": row['sent_count'],
+        "received": row['received_count'],
+        "revealed": row['revealed_count'],
+        "badges": row['badge_count'],
+        "chain": row['chain_count'] or 0,
+    }
+
+
+async def repair_user_counters() -> int:
+    """Recompute drifted user stat counters from the source tables. Returns rows fixed."""
+    if _use_postgres:
+        async with _pg() as conn:
+            cur = await conn.execute(_REPAIR_COUNTERS)
+            await conn.commit()
+            return cur.rowcount
+    else:
+        async with _sqlite() as db:
+            cursor = await db.execute(_REPAIR_COUNTERS)
+            await db.commit()
+            return cursor.rowcount
 
 
 async def find_user_by_username(username: str) -> Optional[dict]:
     """Find user by username"""
     username = username.lstrip('@')
     if _use_postgres:
-        conn = _get_pg_conn()
-        try:
-            cur = conn.cursor()
-            cur.execute("SELECT * FROM users WHERE LOWER(username) = LOWER(%s)", (username,))
-            return _fetchone_dict(cur)
-        finally:
-            conn.close()
+        async with _pg() as conn:
+            cur = await conn.execute("SELECT * FROM users WHERE LOWER(username) = LOWER(%s)", (username,))
+            row = await cur.fetchone()
+            return dict(row) if row else None
     else:
-        import aiosqlite
-        async with aiosqlite.connect(config.DATABASE_PATH) as db:
-            db.row_factory = aiosqlite.Row
+        async with _sqlite() as db:
             cursor = await db.execute("SELECT * FROM users WHERE LOWER(username) = LOWER(?)", (username,))
             row = await cursor.fetchone()
             return dict(row) if row else None
@@ -796,82 +1396,73 @@ async def find_user_by_username(username: str) -> Optional[dict]:
 async def add_reaction(valentine_id: int, emoji: str):
     """Add reaction to valentine"""
     if _use_postgres:
-        conn = _get_pg_conn()
-        try:
-            cur = conn.cursor()
-            cur.execute("UPDATE valentines SET reaction = %s WHERE id = %s", (emoji, valentine_id))
-            conn.commit()
-        finally:
-            conn.close()
+        async with _pg() as conn:
+            await conn.execute("UPDATE valentines SET reaction = %s WHERE id = %s", (emoji, valentine_id))
+            await conn.commit()
     else:
-        import aiosqlite
-        async with aiosqlite.connect(config.DATABASE_PATH) as db:
+        async with _sqlite() as db:
             await db.execute("UPDATE valentines SET reaction = ? WHERE id = ?", (emoji, valentine_id))
             await db.commit()
 
 
 # ==================== LEADERBOARD ====================
 
-async def get_top_receivers(limit: int = 10) -> list:
-    """Get top valentine receivers"""
+# Leaderboard windows: days of rollup to sum, None = all time
+LEADERBOARD_WINDOWS = {"day": 1, "week": 7, "all": None}
+
+_leaderboard_cache = {}  # (column, window, limit) -> (expires_at, rows)
+
+
+async def _query_leaderboard(column: str, window: str, limit: int) -> list:
+    """Read a leaderboard straight from the counters / daily rollup"""
+    days = LEADERBOARD_WINDOWS[window]
+    if days is None:
+        counter = f"{column}_count"
+        sql = f"""SELECT first_name, username, {counter} AS count FROM users
+                  WHERE {counter} > 0
+                  ORDER BY {counter} DESC LIMIT {{p}}"""
+        params = (limit,)
+    else:
+        since = date.today() - timedelta(days=days - 1)
+        sql = f"""SELECT u.first_name, u.username, SUM(l.{column}) AS count
+                  FROM leaderboard_daily l
+                  JOIN users u ON u.user_id = l.user_id
+                  WHERE l.day >= {{p}}
+                  GROUP BY u.user_id, u.first_name, u.username
+                  HAVING SUM(l.{column}) > 0
+                  ORDER BY count DESC LIMIT {{p}}"""
+        params = (since if _use_postgres else since.isoformat(), limit)
+
     if _use_postgres:
-        conn = _get_pg_conn()
-        try:
-            cur = conn.cursor()
-            cur.execute("""
-                SELECT u.first_name, u.username, COUNT(v.id) as count
-                FROM users u
-                JOIN valentines v ON u.user_id = v.receiver_id
-                WHERE v.is_delivered = TRUE
-                GROUP BY u.user_id, u.first_name, u.username
-                ORDER BY count DESC LIMIT %s
-            """, (limit,))
-            return _fetchall_dict(cur)
-        finally:
-            conn.close()
+        async with _pg() as conn:
+            cur = await conn.execute(sql.format(p="%s"), params)
+            return [dict(row) for row in await cur.fetchall()]
     else:
-        import aiosqlite
-        async with aiosqlite.connect(config.DATABASE_PATH) as db:
-            db.row_factory = aiosqlite.Row
-            cursor = await db.execute("""
-                SELECT u.first_name, u.username, COUNT(v.id) as count
-                FROM users u
-                JOIN valentines v ON u.user_id = v.receiver_id
-                WHERE v.is_delivered = TRUE
-                GROUP BY u.user_id
-                ORDER BY count DESC LIMIT ?
-            """, (limit,))
+        async with _sqlite() as db:
+            cursor = await db.execute(sql.format(p="?"), params)
             return [dict(row) for row in await cursor.fetchall()]
 
 
-async def get_top_senders(limit: int = 10) -> list:
+async def get_leaderboard(column: str, window: str = "all", limit: int = 10) -> list:
+    """Top users by 'received' or 'sent' for a window, cached for LEADERBOARD_CACHE_TTL"""
+    key = (column, window, limit)
+    cached = _leaderboard_cache.get(key)
+    now = time.monotonic()
+    if cached and cached[0] > now:
+        return cached[1]
+    rows = await _query_leaderboard(column, window, limit)
+    _leaderboard_cache[key] = (now + config.LEADERBOARD_CACHE_TTL, rows)
+    return rows
+
+
+async def get_top_receivers(limit: int = 10, window: str = "all") -> list:
+    """Get top valentine receivers"""
+    return await get_leaderboard("received", window, limit)
+
+
+async def get_top_senders(limit: int = 10, window: str = "all") -> list:
     """Get top valentine senders"""
-    if _use_postgres:
-        conn = _get_pg_conn()
-        try:
-            cur = conn.cursor()
-            cur.execute("""
-                SELECT u.first_name, u.username, COUNT(v.id) as count
-                FROM users u
-                JOIN valentines v ON u.user_id = v.sender_id
-                GROUP BY u.user_id, u.first_name, u.username
-                ORDER BY count DESC LIMIT %s
-            """, (limit,))
-            return _fetchall_dict(cur)
-        finally:
-            conn.close()
-    else:
-        import aiosqlite
-        async with aiosqlite.connect(config.DATABASE_PATH) as db:
-            db.row_factory = aiosqlite.Row
-            cursor = await db.execute("""
-                SELECT u.first_name, u.username, COUNT(v.id) as count
-                FROM users u
-                JOIN valentines v ON u.user_id = v.sender_id
-                GROUP BY u.user_id
-                ORDER BY count DESC LIMIT ?
-            """, (limit,))
-            return [dict(row) for row in await cursor.fetchall()]
+    return await get_leaderboard("sent", window, limit)
 
 
 # ==================== ANONYMOUS CHAT ====================
@@ -880,16 +1471,11 @@ async def create_anon_chat(valentine_id: int) -> str:
     """Create anonymous chat session"""
     chat_id = secrets.token_hex(8)
     if _use_postgres:
-        conn = _get_pg_conn()
-        try:
-            cur = conn.cursor()
-            cur.execute("INSERT INTO anon_chats (id, valentine_id) VALUES (%s, %s)", (chat_id, valentine_id))
-            conn.commit()
-        finally:
-            conn.close()
+        async with _pg() as conn:
+            await conn.execute("INSERT INTO anon_chats (id, valentine_id) VALUES (%s, %s)", (chat_id, valentine_id))
+            await conn.commit()
     else:
-        import aiosqlite
-        async with aiosqlite.connect(config.DATABASE_PATH) as db:
+        async with _sqlite() as db:
             await db.execute("INSERT INTO anon_chats (id, valentine_id) VALUES (?, ?)", (chat_id, valentine_id))
             await db.commit()
     return chat_id
@@ -898,17 +1484,12 @@ async def create_anon_chat(valentine_id: int) -> str:
 async def get_anon_chat(chat_id: str) -> Optional[dict]:
     """Get anon chat by ID"""
     if _use_postgres:
-        conn = _get_pg_conn()
-        try:
-            cur = conn.cursor()
-            cur.execute("SELECT * FROM anon_chats WHERE id = %s", (chat_id,))
-            return _fetchone_dict(cur)
-        finally:
-            conn.close()
+        async with _pg() as conn:
+            cur = await conn.execute("SELECT * FROM anon_chats WHERE id = %s", (chat_id,))
+            row = await cur.fetchone()
+            return dict(row) if row else None
     else:
-        import aiosqlite
-        async with aiosqlite.connect(config.DATABASE_PATH) as db:
-            db.row_factory = aiosqlite.Row
+        async with _sqlite() as db:
             cursor = await db.execute("SELECT * FROM anon_chats WHERE id = ?", (chat_id,))
             row = await cursor.fetchone()
             return dict(row) if row else None
@@ -917,19 +1498,14 @@ async def get_anon_chat(chat_id: str) -> Optional[dict]:
 async def save_anon_message(chat_id: str, from_sender: bool, text: str):
     """Save message in anon chat"""
     if _use_postgres:
-        conn = _get_pg_conn()
-        try:
-            cur = conn.cursor()
-            cur.execute(
+        async with _pg() as conn:
+            await conn.execute(
                 "INSERT INTO anon_messages (chat_id, from_sender, text) VALUES (%s, %s, %s)",
                 (chat_id, from_sender, text)
             )
-            conn.commit()
-        finally:
-            conn.close()
+            await conn.commit()
     else:
-        import aiosqlite
-        async with aiosqlite.connect(config.DATABASE_PATH) as db:
+        async with _sqlite() as db:
             await db.execute(
                 "INSERT INTO anon_messages (chat_id, from_sender, text) VALUES (?, ?, ?)",
                 (chat_id, from_sender, text)
@@ -939,76 +1515,131 @@ async def save_anon_message(chat_id: str, from_sender: bool, text: str):
 
 # ==================== ROULETTE ====================
 
-async def add_to_roulette(user_id: int, message: str) -> int:
-    """Add user to roulette queue, return queue ID"""
+async def add_to_roulette(user_id: int, message: str, paid: bool = False) -> int:
+    """Add user to roulette queue, return queue ID (`paid`: the slot was bought with Stars)"""
     if _use_postgres:
-        conn = _get_pg_conn()
-        try:
-            cur = conn.cursor()
-            cur.execute(
-                "INSERT INTO roulette_queue (user_id, message) VALUES (%s, %s) RETURNING id",
-                (user_id, message)
+        async with _pg() as conn:
+            cur = await conn.execute(
+                "INSERT INTO roulette_queue (user_id, message, paid) VALUES (%s, %s, %s) RETURNING id",
+                (user_id, message, paid)
             )
-            qid = cur.fetchone()[0]
-            conn.commit()
+            qid = (await cur.fetchone())[0]
+            await conn.commit()
             return qid
-        finally:
-            conn.close()
     else:
-        import aiosqlite
-        async with aiosqlite.connect(config.DATABASE_PATH) as db:
+        async with _sqlite() as db:
             cursor = await db.execute(
-                "INSERT INTO roulette_queue (user_id, message) VALUES (?, ?)",
-                (user_id, message)
+                "INSERT INTO roulette_queue (user_id, message, paid) VALUES (?, ?, ?)",
+                (user_id, message, paid)
             )
             await db.commit()
             return cursor.lastrowid
 
 
-async def find_roulette_match(user_id: int) -> Optional[dict]:
-    """Find a match in roulette queue (different user)"""
+async def claim_roulette_match(user_id: int) -> Optional[dict]:
+    """Atomically claim the oldest waiting entry of another user (marked matched)
+
+    Concurrent players never get the same entry: Postgres claims it in one
+    UPDATE whose subquery skips rows locked by other claimers; SQLite writes
+    are serialized and the UPDATE re-checks `matched`. Call it inside
+    db.transaction() so a failure later in the match releases the entry.
+    """
     if _use_postgres:
-        conn = _get_pg_conn()
-        try:
-            cur = conn.cursor()
-            cur.execute(
-                """SELECT * FROM roulette_queue
-                   WHERE user_id != %s AND matched = FALSE
-                   ORDER BY created_at ASC LIMIT 1""",
+        async with _pg() as conn:
+            cur = await conn.execute(
+                """UPDATE roulette_queue SET matched = TRUE
+                   WHERE id = (
+                       SELECT id FROM roulette_queue
+                       WHERE user_id != %s AND matched = FALSE
+                       ORDER BY created_at ASC, id ASC LIMIT 1
+                       FOR UPDATE SKIP LOCKED
+                   )
+                   RETURNING *""",
                 (user_id,)
             )
-            return _fetchone_dict(cur)
-        finally:
-            conn.close()
+            row = await cur.fetchone()
+            await conn.commit()
+            return dict(row) if row else None
     else:
-        import aiosqlite
-        async with aiosqlite.connect(config.DATABASE_PATH) as db:
-            db.row_factory = aiosqlite.Row
+        async with _sqlite() as db:
+            while True:
+                cursor = await db.execute(
+                    """SELECT * FROM roulette_queue
+                       WHERE user_id != ? AND matched = FALSE
+                       ORDER BY created_at ASC, id ASC LIMIT 1""",
+                    (user_id,)
+                )
+                row = await cursor.fetchone()
+                if not row:
+                    return None
+                cursor = await db.execute(
+                    "UPDATE roulette_queue SET matched = TRUE WHERE id = ? AND matched = FALSE",
+                    (row['id'],)
+                )
+                await db.commit()
+                if cursor.rowcount:
+                    match = dict(row)
+                    match['matched'] = True
+                    return match
+
+
+async def claim_roulette_entry(queue_id: int) -> Optional[dict]:
+    """Claim one specific waiting entry; None if it was matched or expired meanwhile"""
+    if _use_postgres:
+        async with _pg() as conn:
+            cur = await conn.execute(
+                "UPDATE roulette_queue SET matched = TRUE WHERE id = %s AND matched = FALSE RETURNING *",
+                (queue_id,)
+            )
+            row = await cur.fetchone()
+            await conn.commit()
+            return dict(row) if row else None
+    else:
+        async with _sqlite() as db:
             cursor = await db.execute(
-                """SELECT * FROM roulette_queue
-                   WHERE user_id != ? AND matched = FALSE
-                   ORDER BY created_at ASC LIMIT 1""",
-                (user_id,)
+                "UPDATE roulette_queue SET matched = TRUE WHERE id = ? AND matched = FALSE",
+                (queue_id,)
             )
+            if not cursor.rowcount:
+                return None
+            cursor = await db.execute("SELECT * FROM roulette_queue WHERE id = ?", (queue_id,))
             row = await cursor.fetchone()
-            return dict(row) if row else None
+            await db.commit()
+            return dict(row)
 
 
-async def mark_roulette_matched(queue_id: int):
-    """Mark roulette entry as matched"""
+async def get_waiting_roulette() -> list:
+    """Unmatched roulette entries, oldest first"""
     if _use_postgres:
-        conn = _get_pg_conn()
-        try:
-            cur = conn.cursor()
-            cur.execute("UPDATE roulette_queue SET matched = TRUE WHERE id = %s", (queue_id,))
-            conn.commit()
-        finally:
-            conn.close()
+        async with _pg() as conn:
+            cur = await conn.execute(
+                "SELECT * FROM roulette_queue WHERE matched = FALSE ORDER BY created_at ASC, id ASC"
+            )
+            return [dict(row) for row in await cur.fetchall()]
     else:
-        import aiosqlite
-        async with aiosqlite.connect(config.DATABASE_PATH) as db:
-            await db.execute("UPDATE roulette_queue SET matched = TRUE WHERE id = ?", (queue_id,))
+        async with _sqlite() as db:
+            cursor = await db.execute(
+                "SELECT * FROM roulette_queue WHERE matched = FALSE ORDER BY created_at ASC, id ASC"
+            )
+            return [dict(row) for row in await cursor.fetchall()]
+
+
+async def expire_roulette_entry(queue_id: int) -> bool:
+    """Drop a still-unmatched entry from the queue. Returns True if it was removed."""
+    if _use_postgres:
+        async with _pg() as conn:
+            cur = await conn.execute(
+                "DELETE FROM roulette_queue WHERE id = %s AND matched = FALSE", (queue_id,)
+            )
+            await conn.commit()
+            return cur.rowcount > 0
+    else:
+        async with _sqlite() as db:
+            cursor = await db.execute(
+                "DELETE FROM roulette_queue WHERE id = ? AND matched = FALSE", (queue_id,)
+            )
             await db.commit()
+            return cursor.rowcount > 0
 
 
 # ==================== COMPATIBILITY ====================
@@ -1017,19 +1648,14 @@ async def create_compat_test(initiator_id: int) -> str:
     """Create compatibility test and return test ID"""
     test_id = secrets.token_hex(6)
     if _use_postgres:
-        conn = _get_pg_conn()
-        try:
-            cur = conn.cursor()
-            cur.execute(
+        async with _pg() as conn:
+            await conn.execute(
                 "INSERT INTO compatibility_tests (id, initiator_id) VALUES (%s, %s)",
                 (test_id, initiator_id)
             )
-            conn.commit()
-        finally:
-            conn.close()
+            await conn.commit()
     else:
-        import aiosqlite
-        async with aiosqlite.connect(config.DATABASE_PATH) as db:
+        async with _sqlite() as db:
             await db.execute(
                 "INSERT INTO compatibility_tests (id, initiator_id) VALUES (?, ?)",
                 (test_id, initiator_id)
@@ -1041,17 +1667,12 @@ async def create_compat_test(initiator_id: int) -> str:
 async def get_compat_test(test_id: str) -> Optional[dict]:
     """Get compatibility test by ID"""
     if _use_postgres:
-        conn = _get_pg_conn()
-        try:
-            cur = conn.cursor()
-            cur.execute("SELECT * FROM compatibility_tests WHERE id = %s", (test_id,))
-            return _fetchone_dict(cur)
-        finally:
-            conn.close()
+        async with _pg() as conn:
+            cur = await conn.execute("SELECT * FROM compatibility_tests WHERE id = %s", (test_id,))
+            row = await cur.fetchone()
+            return dict(row) if row else None
     else:
-        import aiosqlite
-        async with aiosqlite.connect(config.DATABASE_PATH) as db:
-            db.row_factory = aiosqlite.Row
+        async with _sqlite() as db:
             cursor = await db.execute("SELECT * FROM compatibility_tests WHERE id = ?", (test_id,))
             row = await cursor.fetchone()
             return dict(row) if row else None
@@ -1065,25 +1686,20 @@ async def save_compat_answers(test_id: str, user_id: int, answers: list):
         return
 
     if _use_postgres:
-        conn = _get_pg_conn()
-        try:
-            cur = conn.cursor()
+        async with _pg() as conn:
             if test['initiator_id'] == user_id:
-                cur.execute(
+                await conn.execute(
                     "UPDATE compatibility_tests SET initiator_answers = %s WHERE id = %s",
                     (answers_json, test_id)
                 )
             else:
-                cur.execute(
+                await conn.execute(
                     "UPDATE compatibility_tests SET partner_id = %s, partner_answers = %s WHERE id = %s",
                     (user_id, answers_json, test_id)
                 )
-            conn.commit()
-        finally:
-            conn.close()
+            await conn.commit()
     else:
-        import aiosqlite
-        async with aiosqlite.connect(config.DATABASE_PATH) as db:
+        async with _sqlite() as db:
             if test['initiator_id'] == user_id:
                 await db.execute(
                     "UPDATE compatibility_tests SET initiator_answers = ? WHERE id = ?",
@@ -1100,19 +1716,14 @@ async def save_compat_answers(test_id: str, user_id: int, answers: list):
 async def set_compat_result(test_id: str, percent: int):
     """Set compatibility test result"""
     if _use_postgres:
-        conn = _get_pg_conn()
-        try:
-            cur = conn.cursor()
-            cur.execute(
+        async with _pg() as conn:
+            await conn.execute(
                 "UPDATE compatibility_tests SET result_percent = %s WHERE id = %s",
                 (percent, test_id)
             )
-            conn.commit()
-        finally:
-            conn.close()
+            await conn.commit()
     else:
-        import aiosqlite
-        async with aiosqlite.connect(config.DATABASE_PATH) as db:
+        async with _sqlite() as db:
             await db.execute(
                 "UPDATE compatibility_tests SET result_percent = ? WHERE id = ?",
                 (percent, test_id)
@@ -1123,19 +1734,14 @@ async def set_compat_result(test_id: str, percent: int):
 async def mark_compat_paid(test_id: str):
     """Mark compatibility test as paid"""
     if _use_postgres:
-        conn = _get_pg_conn()
-        try:
-            cur = conn.cursor()
-            cur.execute(
+        async with _pg() as conn:
+            await conn.execute(
                 "UPDATE compatibility_tests SET is_paid = TRUE WHERE id = %s",
                 (test_id,)
             )
-            conn.commit()
-        finally:
-            conn.close()
+            await conn.commit()
     else:
-        import aiosqlite
-        async with aiosqlite.connect(config.DATABASE_PATH) as db:
+        async with _sqlite() as db:
             await db.execute(
                 "UPDATE compatibility_tests SET is_paid = TRUE WHERE id = ?",
                 (test_id,)
@@ -1148,25 +1754,29 @@ async def mark_compat_paid(test_id: str):
 async def grant_achievement(user_id: int, badge: str) -> bool:
     """Grant achievement to user. Returns True if new."""
     if _use_postgres:
-        conn = _get_pg_conn()
-        try:
-            cur = conn.cursor()
-            cur.execute(
+        async with _pg() as conn:
+            await conn.begin()
+            cur = await conn.execute(
                 "INSERT INTO achievements (user_id, badge) VALUES (%s, %s) ON CONFLICT DO NOTHING",
                 (user_id, badge)
             )
-            conn.commit()
+            if cur.rowcount:
+                await conn.execute(
+                    "UPDATE users SET badge_count = badge_count + 1 WHERE user_id = %s", (user_id,)
+                )
+            await conn.commit()
             return cur.rowcount > 0
-        finally:
-            conn.close()
     else:
         import aiosqlite
-        async with aiosqlite.connect(config.DATABASE_PATH) as db:
+        async with _sqlite() as db:
             try:
                 await db.execute(
                     "INSERT INTO achievements (user_id, badge) VALUES (?, ?)",
                     (user_id, badge)
                 )
+                await db.execute(
+                    "UPDATE users SET badge_count = badge_count + 1 WHERE user_id = ?", (user_id,)
+                )
                 await db.commit()
                 return True
             except aiosqlite.IntegrityError:
@@ -1176,20 +1786,14 @@ async def grant_achievement(user_id: int, badge: str) -> bool:
 async def get_user_achievements(user_id: int) -> list:
     """Get all user achievements"""
     if _use_postgres:
-        conn = _get_pg_conn()
-        try:
-            cur = conn.cursor()
-            cur.execute(
+        async with _pg() as conn:
+            cur = await conn.execute(
                 "SELECT * FROM achievements WHERE user_id = %s ORDER BY earned_at DESC",
                 (user_id,)
             )
-            return _fetchall_dict(cur)
-        finally:
-            conn.close()
+            return [dict(row) for row in await cur.fetchall()]
     else:
-        import aiosqlite
-        async with aiosqlite.connect(config.DATABASE_PATH) as db:
-            db.row_factory = aiosqlite.Row
+        async with _sqlite() as db:
             cursor = await db.execute(
                 "SELECT * FROM achievements WHERE user_id = ? ORDER BY earned_at DESC",
                 (user_id,)
@@ -1199,59 +1803,244 @@ async def get_user_achievements(user_id: int) -> list:
 
 # ==================== SCHEDULED VALENTINES ====================
 
-async def get_pending_scheduled() -> list:
-    """Get valentines scheduled for delivery now"""
+async def claim_scheduled(limit: int = 100, lease_seconds: float = 300,
+                          now: Optional[datetime] = None) -> list:
+    """Lease a batch of due scheduled valentines for delivery
+
+    Claimed rows are hidden from other claimers until the lease runs out, so
+    several workers (the polling worker, /api/cron) deliver disjoint batches;
+    a row whose delivery failed is retried once its lease expires. `now` is
+    the caller's idea of the current time (default: the database clock).
+    """
     if _use_postgres:
-        conn = _get_pg_conn()
-        try:
-            cur = conn.cursor()
-            cur.execute(
+        async with _pg() as conn:
+            cur = await conn.execute(
+                """UPDATE valentines SET lease_until = NOW() + make_interval(secs => %s)
+                   WHERE id IN (
+                       SELECT id FROM valentines
+                       WHERE scheduled_for IS NOT NULL
+                       AND scheduled_for <= COALESCE(%s::timestamp, NOW())
+                       AND is_scheduled_sent = FALSE
+                       AND is_delivered = FALSE
+                       AND (lease_until IS NULL OR lease_until < NOW())
+                       ORDER BY scheduled_for ASC LIMIT %s
+                       FOR UPDATE SKIP LOCKED
+                   )
+                   RETURNING *""",
+                (lease_seconds, now, limit)
+            )
+            rows = [dict(row) for row in await cur.fetchall()]
+            await conn.commit()
+            return rows
+    else:
+        clock = datetime.now()
+        lease_until = (clock + timedelta(seconds=lease_seconds)).isoformat()
+        async with _sqlite() as db:
+            await db.execute(
+                """UPDATE valentines SET lease_until = ?
+                   WHERE id IN (
+                       SELECT id FROM valentines
+                       WHERE scheduled_for IS NOT NULL
+                       AND scheduled_for <= ?
+                       AND is_scheduled_sent = FALSE
+                       AND is_delivered = FALSE
+                       AND (lease_until IS NULL OR lease_until < ?)
+                       ORDER BY scheduled_for ASC LIMIT ?
+                   )""",
+                (lease_until, (now or clock).isoformat(), clock.isoformat(), limit)
+            )
+            # Same transaction, so only this claim's rows carry this lease stamp
+            cursor = await db.execute(
                 """SELECT * FROM valentines
+                   WHERE lease_until = ? AND is_scheduled_sent = FALSE AND is_delivered = FALSE
+                   ORDER BY scheduled_for ASC""",
+                (lease_until,)
+            )
+            rows = [dict(row) for row in await cursor.fetchall()]
+            await db.commit()
+            return rows
+
+
+async def get_upcoming_scheduled(limit: int = 1000) -> list:
+    """(id, scheduled_for) of the soonest undelivered scheduled valentines, due ones included"""
+    if _use_postgres:
+        async with _pg() as conn:
+            cur = await conn.execute(
+                """SELECT id, scheduled_for FROM valentines
                    WHERE scheduled_for IS NOT NULL
-                   AND scheduled_for <= NOW()
                    AND is_scheduled_sent = FALSE
-                   AND is_delivered = FALSE"""
+                   AND is_delivered = FALSE
+                   ORDER BY scheduled_for ASC LIMIT %s""",
+                (limit,)
             )
-            return _fetchall_dict(cur)
-        finally:
-            conn.close()
+            return [dict(row) for row in await cur.fetchall()]
     else:
-        import aiosqlite
-        now = datetime.now().isoformat()
-        async with aiosqlite.connect(config.DATABASE_PATH) as db:
-            db.row_factory = aiosqlite.Row
+        async with _sqlite() as db:
             cursor = await db.execute(
-                """SELECT * FROM valentines
+                """SELECT id, scheduled_for FROM valentines
                    WHERE scheduled_for IS NOT NULL
-                   AND scheduled_for <= ?
                    AND is_scheduled_sent = FALSE
-                   AND is_delivered = FALSE""",
-                (now,)
+                   AND is_delivered = FALSE
+                   ORDER BY scheduled_for ASC LIMIT ?""",
+                (limit,)
             )
             return [dict(row) for row in await cursor.fetchall()]
 
 
 async def mark_scheduled_sent(valentine_id: int):
     """Mark scheduled valentine as sent"""
+    async with transaction():
+        if _use_postgres:
+            async with _pg() as conn:
+                await conn.execute(
+                    "UPDATE valentines SET is_scheduled_sent = TRUE WHERE id = %s", (valentine_id,)
+                )
+        else:
+            async with _sqlite() as db:
+                await db.execute(
+                    "UPDATE valentines SET is_scheduled_sent = TRUE WHERE id = ?", (valentine_id,)
+                )
+        # Flips is_delivered and bumps the receiver's counter
+        await mark_delivered(valentine_id)
+
+
+# ==================== WEBHOOK UPDATES ====================
+
+async def spool_update(update_id: int, payload: str) -> bool:
+    """Persist a webhook update before acknowledging it; False if already spooled"""
     if _use_postgres:
-        conn = _get_pg_conn()
-        try:
-            cur = conn.cursor()
-            cur.execute(
-                "UPDATE valentines SET is_scheduled_sent = TRUE, is_delivered = TRUE WHERE id = %s",
-                (valentine_id,)
+        async with _pg() as conn:
+            cur = await conn.execute(
+                """INSERT INTO update_spool (update_id, payload) VALUES (%s, %s)
+                   ON CONFLICT (update_id) DO NOTHING""",
+                (update_id, payload)
             )
-            conn.commit()
-        finally:
-            conn.close()
+            await conn.commit()
+            return cur.rowcount > 0
     else:
-        import aiosqlite
-        async with aiosqlite.connect(config.DATABASE_PATH) as db:
+        async with _sqlite() as db:
+            cursor = await db.execute(
+                """INSERT INTO update_spool (update_id, payload) VALUES (?, ?)
+                   ON CONFLICT (update_id) DO NOTHING""",
+                (update_id, payload)
+            )
+            await db.commit()
+            return cursor.rowcount > 0
+
+
+async def claim_spooled_updates(limit: int = 50, lease_seconds: float = 60) -> list:
+    """Lease the oldest spooled updates, including ones a crashed worker left behind"""
+    if _use_postgres:
+        async with _pg() as conn:
+            cur = await conn.execute(
+                """UPDATE update_spool SET lease_until = NOW() + make_interval(secs => %s)
+                   WHERE update_id IN (
+                       SELECT update_id FROM update_spool
+                       WHERE lease_until IS NULL OR lease_until < NOW()
+                       ORDER BY update_id ASC LIMIT %s
+                       FOR UPDATE SKIP LOCKED
+                   )
+                   RETURNING update_id, payload""",
+                (lease_seconds, limit)
+            )
+            rows = sorted((dict(row) for row in await cur.fetchall()),
+                          key=lambda row: row['update_id'])
+            await conn.commit()
+            return rows
+    else:
+        now = datetime.now()
+        lease_until = (now + timedelta(seconds=lease_seconds)).isoformat()
+        async with _sqlite() as db:
             await db.execute(
-                "UPDATE valentines SET is_scheduled_sent = TRUE, is_delivered = TRUE WHERE id = ?",
-                (valentine_id,)
+                """UPDATE update_spool SET lease_until = ?
+                   WHERE update_id IN (
+                       SELECT update_id FROM update_spool
+                       WHERE lease_until IS NULL OR lease_until < ?
+                       ORDER BY update_id ASC LIMIT ?
+                   )""",
+                (lease_until, now.isoformat(), limit)
+            )
+            # Same transaction, so only this claim's rows carry this lease stamp
+            cursor = await db.execute(
+                """SELECT update_id, payload FROM update_spool
+                   WHERE lease_until = ? ORDER BY update_id ASC""",
+                (lease_until,)
+            )
+            rows = [dict(row) for row in await cursor.fetchall()]
+            await db.commit()
+            return rows
+
+
+async def delete_spooled_update(update_id: int):
+    """Drop an update once it has been processed"""
+    if _use_postgres:
+        async with _pg() as conn:
+            await conn.execute("DELETE FROM update_spool WHERE update_id = %s", (update_id,))
+            await conn.commit()
+    else:
+        async with _sqlite() as db:
+            await db.execute("DELETE FROM update_spool WHERE update_id = ?", (update_id,))
+            await db.commit()
+
+
+async def claim_update(update_id: int, lease_seconds: float = 300) -> bool:
+    """Claim an update for processing; False if it is done or being processed"""
+    if _use_postgres:
+        async with _pg() as conn:
+            cur = await conn.execute(
+                """INSERT INTO processed_updates (update_id, lease_until)
+                   VALUES (%s, NOW() + make_interval(secs => %s))
+                   ON CONFLICT (update_id) DO UPDATE
+                   SET claimed_at = NOW(), lease_until = excluded.lease_until
+                   WHERE processed_updates.done = FALSE AND processed_updates.lease_until < NOW()""",
+                (update_id, lease_seconds)
+            )
+            await conn.commit()
+            return cur.rowcount > 0
+    else:
+        now = datetime.now()
+        lease_until = (now + timedelta(seconds=lease_seconds)).isoformat()
+        async with _sqlite() as db:
+            cursor = await db.execute(
+                """INSERT INTO processed_updates (update_id, claimed_at, lease_until)
+                   VALUES (?, ?, ?)
+                   ON CONFLICT (update_id) DO UPDATE
+                   SET claimed_at = excluded.claimed_at, lease_until = excluded.lease_until
+                   WHERE processed_updates.done = FALSE AND processed_updates.lease_until < ?""",
+                (update_id, now.isoformat(), lease_until, now.isoformat())
+            )
+            await db.commit()
+            return cursor.rowcount > 0
+
+
+async def finish_update(update_id: int):
+    """Mark a claimed update as processed"""
+    if _use_postgres:
+        async with _pg() as conn:
+            await conn.execute("UPDATE processed_updates SET done = TRUE WHERE update_id = %s", (update_id,))
+            await conn.commit()
+    else:
+        async with _sqlite() as db:
+            await db.execute("UPDATE processed_updates SET done = TRUE WHERE update_id = ?", (update_id,))
+            await db.commit()
+
+
+async def prune_processed_updates(max_age_seconds: float) -> int:
+    """Forget update_ids claimed longer ago than Telegram would redeliver them"""
+    if _use_postgres:
+        async with _pg() as conn:
+            cur = await conn.execute(
+                "DELETE FROM processed_updates WHERE claimed_at < NOW() - make_interval(secs => %s)",
+                (max_age_seconds,)
             )
+            await conn.commit()
+            return cur.rowcount
+    else:
+        cutoff = (datetime.now() - timedelta(seconds=max_age_seconds)).isoformat()
+        async with _sqlite() as db:
+            cursor = await db.execute("DELETE FROM processed_updates WHERE claimed_at < ?", (cutoff,))
             await db.commit()
+            return cursor.rowcount
 
 
 # ==================== SUBSCRIPTIONS ====================
@@ -1262,21 +2051,17 @@ async def create_subscription(user_id: int, plan: str, days: int,
     expires_at = (datetime.now() + timedelta(days=days)).isoformat()
 
     if _use_postgres:
-        conn = _get_pg_conn()
-        try:
-            cur = conn.cursor()
-            cur.execute("UPDATE subscriptions SET is_active = FALSE WHERE user_id = %s", (user_id,))
-            cur.execute(
+        async with _pg() as conn:
+            await conn.begin()
+            await conn.execute("UPDATE subscriptions SET is_active = FALSE WHERE user_id = %s", (user_id,))
+            await conn.execute(
                 """INSERT INTO subscriptions (user_id, plan, expires_at, telegram_payment_charge_id)
                    VALUES (%s, %s, %s, %s)""",
                 (user_id, plan, expires_at, charge_id)
             )
-            conn.commit()
-        finally:
-            conn.close()
+            await conn.commit()
     else:
-        import aiosqlite
-        async with aiosqlite.connect(config.DATABASE_PATH) as db:
+        async with _sqlite() as db:
             await db.execute("UPDATE subscriptions SET is_active = FALSE WHERE user_id = ?", (user_id,))
             await db.execute(
                 """INSERT INTO subscriptions (user_id, plan, expires_at, telegram_payment_charge_id)
@@ -1284,36 +2069,76 @@ async def create_subscription(user_id: int, plan: str, days: int,
                 (user_id, plan, expires_at, charge_id)
             )
             await db.commit()
+    _after_commit(functools.partial(invalidate_subscription, user_id))
+
+
+_subscription_cache = {}  # user_id -> (valid_until, subscription or None)
+_subscription_cache_stats = {"hits": 0, "negative_hits": 0, "misses": 0, "invalidations": 0}
+
+
+def invalidate_subscription(user_id: int):
+    """Drop the cached subscription of a user"""
+    _subscription_cache.pop(user_id, None)
+    _subscription_cache_stats["invalidations"] += 1
+
+
+def get_subscription_cache_stats() -> dict:
+    """Subscription cache counters"""
+    return dict(_subscription_cache_stats, size=len(_subscription_cache))
 
 
 async def get_active_subscription(user_id: int) -> Optional[dict]:
-    """Get user's active non-expired subscription"""
+    """Get user's active non-expired subscription
+
+    Cached per process for SUBSCRIPTION_CACHE_TTL seconds, never past the
+    subscription's own expiry; purchases invalidate the entry. "No
+    subscription" is only kept SUBSCRIPTION_NEGATIVE_CACHE_TTL seconds: the
+    purchase may have been paid through another instance, whose invalidation
+    never reaches this one.
+    """
+    now = datetime.now()
+    cached = _subscription_cache.get(user_id)
+    if cached and cached[0] > now:
+        _subscription_cache_stats["hits"] += 1
+        if cached[1] is None:
+            _subscription_cache_stats["negative_hits"] += 1
+        return cached[1]
+    _subscription_cache_stats["misses"] += 1
+
     if _use_postgres:
-        conn = _get_pg_conn()
-        try:
-            cur = conn.cursor()
-            cur.execute(
+        async with _pg() as conn:
+            cur = await conn.execute(
                 """SELECT * FROM subscriptions
                    WHERE user_id = %s AND is_active = TRUE AND expires_at > NOW()
                    ORDER BY expires_at DESC LIMIT 1""",
                 (user_id,)
             )
-            return _fetchone_dict(cur)
-        finally:
-            conn.close()
+            row = await cur.fetchone()
     else:
-        import aiosqlite
-        now = datetime.now().isoformat()
-        async with aiosqlite.connect(config.DATABASE_PATH) as db:
-            db.row_factory = aiosqlite.Row
+        async with _sqlite() as db:
             cursor = await db.execute(
                 """SELECT * FROM subscriptions
                    WHERE user_id = ? AND is_active = TRUE AND expires_at > ?
                    ORDER BY expires_at DESC LIMIT 1""",
-                (user_id, now)
+                (user_id, now.isoformat())
             )
             row = await cursor.fetchone()
-            return dict(row) if row else None
+    sub = dict(row) if row else None
+
+    if sub is None:
+        valid_until = now + timedelta(seconds=config.SUBSCRIPTION_NEGATIVE_CACHE_TTL)
+    else:
+        valid_until = now + timedelta(seconds=config.SUBSCRIPTION_CACHE_TTL)
+        expires_at = sub['expires_at']
+        if isinstance(expires_at, str):
+            expires_at = datetime.fromisoformat(expires_at)
+        valid_until = min(valid_until, expires_at)
+    if _active_session() is None:
+        # Uncommitted reads inside db.transaction() are never cached
+        if len(_subscription_cache) >= config.SUBSCRIPTION_CACHE_SIZE:
+            _subscription_cache.pop(next(iter(_subscription_cache)))
+        _subscription_cache[user_id] = (valid_until, sub)
+    return sub
 
 
 async def has_premium(user_id: int) -> bool:
@@ -1328,94 +2153,158 @@ async def can_use_roulette_free(user_id: int) -> bool:
     """Check if user has free roulette match today"""
     from config import ROULETTE_FREE_DAILY
 
-    sub = await get_active_subscription(user_id)
-    if sub:
+    if await _active_plan(user_id):
         return True
 
+    params = {"user_id": user_id, "now": datetime.now().isoformat()}
     if _use_postgres:
-        conn = _get_pg_conn()
-        try:
-            cur = conn.cursor()
-            cur.execute(
-                "SELECT roulette_uses_today, last_roulette_date, roulette_free_until FROM users WHERE user_id = %s",
-                (user_id,)
-            )
-            row = _fetchone_dict(cur)
-            if not row:
-                return True
-            if row['roulette_free_until']:
-                if row['roulette_free_until'] > datetime.now():
-                    return True
+        async with _pg() as conn:
+            cur = await conn.execute(
+                """SELECT roulette_uses_today, last_roulette_date,
+                          roulette_free_until > %(now)s AS free_until_active
+                   FROM users WHERE user_id = %(user_id)s""",
+                params
+            )
+            row = await cur.fetchone()
             today = date.today()
-            if row['last_roulette_date'] != today:
-                return True
-            return (row['roulette_uses_today'] or 0) < ROULETTE_FREE_DAILY
-        finally:
-            conn.close()
     else:
-        import aiosqlite
-        async with aiosqlite.connect(config.DATABASE_PATH) as db:
-            db.row_factory = aiosqlite.Row
+        async with _sqlite() as db:
             cursor = await db.execute(
-                "SELECT roulette_uses_today, last_roulette_date, roulette_free_until FROM users WHERE user_id = ?",
-                (user_id,)
+                """SELECT roulette_uses_today, last_roulette_date,
+                          roulette_free_until > :now AS free_until_active
+                   FROM users WHERE user_id = :user_id""",
+                params
             )
             row = await cursor.fetchone()
-            if not row:
-                return True
-            if row['roulette_free_until']:
-                now = datetime.now().isoformat()
-                if row['roulette_free_until'] > now:
-                    return True
             today = date.today().isoformat()
-            if row['last_roulette_date'] != today:
-                return True
-            return (row['roulette_uses_today'] or 0) < ROULETTE_FREE_DAILY
 
+    if not row:
+        return True
+    if row['free_until_active']:
+        return True
+    if row['last_roulette_date'] != today:
+        return True
+    return (row['roulette_uses_today'] or 0) < ROULETTE_FREE_DAILY
+
+
+async def use_roulette_slot(user_id: int, paid: bool = False) -> bool:
+    """Record roulette usage for today. Returns False if the free limit is used up.
 
-async def use_roulette_slot(user_id: int):
-    """Record roulette usage for today"""
-    today_val = date.today()
+    A single conditional UPDATE checks and consumes the slot; `paid` (a match
+    bought with Stars) and an active subscription skip the limit.
+    """
+    from config import ROULETTE_FREE_DAILY
 
+    params = {
+        "user_id": user_id,
+        "now": datetime.now().isoformat(),
+        "paid": paid or await _active_plan(user_id) is not None,
+        "limit": ROULETTE_FREE_DAILY,
+    }
     if _use_postgres:
-        conn = _get_pg_conn()
-        try:
-            cur = conn.cursor()
-            cur.execute("SELECT last_roulette_date FROM users WHERE user_id = %s", (user_id,))
-            row = _fetchone_dict(cur)
-            if row and row['last_roulette_date'] == today_val:
-                cur.execute(
-                    "UPDATE users SET roulette_uses_today = roulette_uses_today + 1 WHERE user_id = %s",
-                    (user_id,)
-                )
-            else:
-                cur.execute(
-                    "UPDATE users SET roulette_uses_today = 1, last_roulette_date = %s WHERE user_id = %s",
-                    (today_val, user_id)
-                )
-            conn.commit()
-        finally:
-            conn.close()
+        params["today"] = date.today()
+        async with _pg() as conn:
+            cur = await conn.execute(
+                """UPDATE users SET
+                       roulette_uses_today = CASE
+                           WHEN last_roulette_date = %(today)s THEN COALESCE(roulette_uses_today, 0) + 1
+                           ELSE 1 END,
+                       last_roulette_date = %(today)s
+                   WHERE user_id = %(user_id)s
+                     AND (%(paid)s
+                          OR last_roulette_date IS DISTINCT FROM %(today)s
+                          OR COALESCE(roulette_uses_today, 0) < %(limit)s
+                          OR roulette_free_until > %(now)s)""",
+                params
+            )
+            await conn.commit()
+            return cur.rowcount > 0
     else:
-        import aiosqlite
-        today = date.today().isoformat()
-        async with aiosqlite.connect(config.DATABASE_PATH) as db:
-            db.row_factory = aiosqlite.Row
+        params["today"] = date.today().isoformat()
+        async with _sqlite() as db:
             cursor = await db.execute(
-                "SELECT last_roulette_date FROM users WHERE user_id = ?", (user_id,)
+                """UPDATE users SET
+                       roulette_uses_today = CASE
+                           WHEN last_roulette_date = :today THEN COALESCE(roulette_uses_today, 0) + 1
+                           ELSE 1 END,
+                       last_roulette_date = :today
+                   WHERE user_id = :user_id
+                     AND (:paid
+                          OR last_roulette_date IS NOT :today
+                          OR COALESCE(roulette_uses_today, 0) < :limit
+                          OR roulette_free_until > :now)""",
+                params
+            )
+            await db.commit()
+            return cursor.rowcount > 0
+
+
+async def refund_roulette_slot(user_id: int, paid: bool = False) -> bool:
+    """Give back the slot of an entry that expired unmatched. Returns True if refunded.
+
+    A free slot gives back today's use. A paid slot (bought with Stars)
+    becomes a credit for another match, as does a free one once paid matches
+    took the player past the limit: giving back a use would leave them at it.
+    """
+    from config import ROULETTE_FREE_DAILY
+
+    params = {"user_id": user_id, "paid": paid, "limit": ROULETTE_FREE_DAILY}
+    if _use_postgres:
+        params["today"] = date.today()
+        async with _pg() as conn:
+            cur = await conn.execute(
+                """UPDATE users SET
+                       roulette_uses_today = CASE
+                           WHEN NOT %(paid)s AND roulette_uses_today <= %(limit)s
+                           THEN roulette_uses_today - 1 ELSE roulette_uses_today END,
+                       roulette_paid_credits = CASE
+                           WHEN %(paid)s OR roulette_uses_today > %(limit)s
+                           THEN COALESCE(roulette_paid_credits, 0) + 1 ELSE roulette_paid_credits END
+                   WHERE user_id = %(user_id)s
+                     AND (%(paid)s OR (last_roulette_date = %(today)s AND roulette_uses_today > 0))""",
+                params
+            )
+            await conn.commit()
+            return cur.rowcount > 0
+    else:
+        params["today"] = date.today().isoformat()
+        async with _sqlite() as db:
+            cursor = await db.execute(
+                """UPDATE users SET
+                       roulette_uses_today = CASE
+                           WHEN NOT :paid AND roulette_uses_today <= :limit
+                           THEN roulette_uses_today - 1 ELSE roulette_uses_today END,
+                       roulette_paid_credits = CASE
+                           WHEN :paid OR roulette_uses_today > :limit
+                           THEN COALESCE(roulette_paid_credits, 0) + 1 ELSE roulette_paid_credits END
+                   WHERE user_id = :user_id
+                     AND (:paid OR (last_roulette_date = :today AND roulette_uses_today > 0))""",
+                params
+            )
+            await db.commit()
+            return cursor.rowcount > 0
+
+
+async def take_roulette_credit(user_id: int) -> bool:
+    """Spend a paid-match credit left by a refund. Returns False if there is none."""
+    if _use_postgres:
+        async with _pg() as conn:
+            cur = await conn.execute(
+                """UPDATE users SET roulette_paid_credits = roulette_paid_credits - 1
+                   WHERE user_id = %s AND roulette_paid_credits > 0""",
+                (user_id,)
+            )
+            await conn.commit()
+            return cur.rowcount > 0
+    else:
+        async with _sqlite() as db:
+            cursor = await db.execute(
+                """UPDATE users SET roulette_paid_credits = roulette_paid_credits - 1
+                   WHERE user_id = ? AND roulette_paid_credits > 0""",
+                (user_id,)
             )
-            row = await cursor.fetchone()
-            if row and row['last_roulette_date'] == today:
-                await db.execute(
-                    "UPDATE users SET roulette_uses_today = roulette_uses_today + 1 WHERE user_id = ?",
-                    (user_id,)
-                )
-            else:
-                await db.execute(
-                    "UPDATE users SET roulette_uses_today = 1, last_roulette_date = ? WHERE user_id = ?",
-                    (today, user_id)
-                )
             await db.commit()
+            return cursor.rowcount > 0
 
 
 async def activate_weekly_bundle(user_id: int):
@@ -1423,21 +2312,17 @@ async def activate_weekly_bundle(user_id: int):
     roulette_free_until = (datetime.now() + timedelta(days=7)).isoformat()
 
     if _use_postgres:
-        conn = _get_pg_conn()
-        try:
-            cur = conn.cursor()
-            cur.execute(
+        async with _pg() as conn:
+            await conn.execute(
                 "UPDATE users SET bonus_valentines = bonus_valentines + 20, roulette_free_until = %s WHERE user_id = %s",
                 (roulette_free_until, user_id)
             )
-            conn.commit()
-        finally:
-            conn.close()
+            await conn.commit()
     else:
-        import aiosqlite
-        async with aiosqlite.connect(config.DATABASE_PATH) as db:
+        async with _sqlite() as db:
             await db.execute(
                 "UPDATE users SET bonus_valentines = bonus_valentines + 20, roulette_free_until = ? WHERE user_id = ?",
                 (roulette_free_until, user_id)
             )
             await db.commit()
+    _after_commit(functools.partial(invalidate_subscription, user_id))
@@ -0,0 +1,54 @@
+"""
+Webhook update de-duplication
+Telegram redelivers an update when the webhook was slow or failed; each
+update_id is claimed once (recent ids in memory, every id in processed_updates)
+so handlers never run twice for the same update
+"""
+import logging
+import time
+from collections import OrderedDict
+
+import config
+import database as db
+
+logger = logging.getLogger(__name__)
+
+_RECENT_SIZE = 10000
+_recent = OrderedDict()  # update_ids this process claimed, oldest first
+_last_prune = 0.0
+
+
+async def begin(update_id: int) -> bool:
+    """Claim update_id for processing; False for a duplicate"""
+    if update_id in _recent:
+        return False
+    # Taken before the await, so a concurrent duplicate in this process stops here
+    _recent[update_id] = True
+    if len(_recent) > _RECENT_SIZE:
+        _recent.popitem(last=False)
+    try:
+        claimed = await db.claim_update(update_id, config.UPDATE_SPOOL_LEASE_SECONDS)
+    except Exception:
+        _recent.pop(update_id, None)
+        raise
+    if not claimed:
+        # Another instance has it; only ids claimed here are remembered
+        _recent.pop(update_id, None)
+    return claimed
+
+
+def abandon(update_id: int):
+    """Processing failed: let a redelivery retry once the DB lease runs out"""
+    _recent.pop(update_id, None)
+
+
+async def finish(update_id: int):
+    """Record update_id as processed and prune old ids now and then"""
+    global _last_prune
+    await db.finish_update(update_id)
+    now = time.monotonic()
+    if now - _last_prune > config.UPDATE_DEDUP_PRUNE_INTERVAL:
+        _last_prune = now
+        pruned = await db.prune_processed_updates(config.UPDATE_DEDUP_TTL)
+        if pruned:
+            logger.info(f"Pruned {pruned} processed update ids")
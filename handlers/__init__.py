@@ -1,6 +1,14 @@
 """
 Handlers package for Valentine Bot v3.0
 """
+import logging
+
+from telegram import Update
+from telegram.ext import (
+    CallbackQueryHandler, CommandHandler, ConversationHandler, MessageHandler,
+    PreCheckoutQueryHandler, filters
+)
+
 from handlers.start import get_start_handlers
 from handlers.send import get_send_handlers
 from handlers.inbox import get_inbox_handlers
@@ -16,39 +24,86 @@ from handlers.subscription import get_subscription_handlers
 from handlers.occasions import get_occasion_handlers
 
 
-def register_all_handlers(application):
-    """Register all handlers to the application"""
+logger = logging.getLogger(__name__)
+
+# Update types a message-based handler can see (filters.BaseFilter.check_update)
+_MESSAGE_UPDATES = tuple(t for t in (
+    "message", "edited_message", "channel_post", "edited_channel_post",
+    "business_message", "edited_business_message", "guest_message",
+) if t in Update.ALL_TYPES)
+
+
+def get_all_handlers() -> list:
+    """Every handler, in registration (priority) order"""
+    handlers = []
     # Payment handlers first (highest priority)
-    for handler in get_payment_handlers():
-        application.add_handler(handler)
+    handlers += get_payment_handlers()
 
     # ConversationHandlers MUST be registered before plain text handlers
     # so they can intercept user input during conversations
-    for handler in get_send_handlers():
-        application.add_handler(handler)
-    for handler in get_roulette_handlers():
-        application.add_handler(handler)
-    for handler in get_poem_handlers():
-        application.add_handler(handler)
-    for handler in get_extra_handlers():
-        application.add_handler(handler)
+    handlers += get_send_handlers()
+    handlers += get_roulette_handlers()
+    handlers += get_poem_handlers()
+    handlers += get_extra_handlers()
 
     # Feature handlers (callback-based, safe to register before text router)
-    for handler in get_inbox_handlers():
-        application.add_handler(handler)
-    for handler in get_reveal_handlers():
-        application.add_handler(handler)
-    for handler in get_compat_handlers():
-        application.add_handler(handler)
-    for handler in get_horoscope_handlers():
-        application.add_handler(handler)
-    for handler in get_achievement_handlers():
-        application.add_handler(handler)
-    for handler in get_subscription_handlers():
-        application.add_handler(handler)
-    for handler in get_occasion_handlers():
-        application.add_handler(handler)
+    handlers += get_inbox_handlers()
+    handlers += get_reveal_handlers()
+    handlers += get_compat_handlers()
+    handlers += get_horoscope_handlers()
+    handlers += get_achievement_handlers()
+    handlers += get_subscription_handlers()
+    handlers += get_occasion_handlers()
 
     # Start, menu commands and reply-keyboard text router (lowest priority - registered last)
-    for handler in get_start_handlers():
+    handlers += get_start_handlers()
+    return handlers
+
+
+def register_all_handlers(application):
+    """Register all handlers to the application"""
+    for handler in get_all_handlers():
         application.add_handler(handler)
+
+
+def _handler_updates(handler):
+    """Update types one handler consumes, or None if it can't be told"""
+    if isinstance(handler, ConversationHandler):
+        types = set()
+        nested = handler.entry_points + handler.fallbacks + [
+            h for state in handler.states.values() for h in state
+        ]
+        for inner in nested:
+            inner_types = _handler_updates(inner)
+            if inner_types is None:
+                return None
+            types |= inner_types
+        return types
+    if isinstance(handler, CallbackQueryHandler):
+        return {Update.CALLBACK_QUERY}
+    if isinstance(handler, PreCheckoutQueryHandler):
+        return {Update.PRE_CHECKOUT_QUERY}
+    if isinstance(handler, CommandHandler) and handler.filters is filters.UpdateType.MESSAGES:
+        return {Update.MESSAGE, Update.EDITED_MESSAGE}
+    if isinstance(handler, (CommandHandler, MessageHandler)):
+        return set(_MESSAGE_UPDATES)
+    return None
+
+
+def get_allowed_updates(handlers=None):
+    """Update types the handlers consume, for run_polling / set_webhook
+
+    Telegram then stops sending the rest. None (every type) if some
+    handler's update types can't be derived.
+    """
+    types = set()
+    for handler in get_all_handlers() if handlers is None else handlers:
+        handler_types = _handler_updates(handler)
+        if handler_types is None:
+            logger.warning(f"Can't derive update types of {type(handler).__name__}, not filtering updates")
+            return None
+        types |= handler_types
+    allowed = [t for t in Update.ALL_TYPES if t in types]
+    filtered = [t for t in Update.ALL_TYPES if t not in types]
+    logger.info(f"allowed_updates: {', '.join(allowed)}; filtered out: {', '.join(filtered)}")
+    return allowed
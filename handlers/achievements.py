@@ -5,6 +5,7 @@ from telegram import Update, InlineKeyboardButton, InlineKeyboardMarkup
 from telegram.ext import ContextTypes, CallbackQueryHandler
 
 import database as db
+from ratelimit import NOTIFY
 
 # Badge definitions
 BADGES = {
@@ -27,6 +28,12 @@ BADGES = {
 
 async def check_achievements(user_id: int, action: str, context: ContextTypes.DEFAULT_TYPE):
     """Check and grant achievements after action"""
+    new_badges = await award_achievements(user_id, action)
+    await notify_new_badges(user_id, new_badges, context)
+
+
+async def award_achievements(user_id: int, action: str) -> list:
+    """Grant achievements earned by an action (DB only, safe inside db.transaction())"""
     new_badges = []
 
     if action == 'send':
@@ -86,7 +93,11 @@ async def check_achievements(user_id: int, action: str, context: ContextTypes.DE
         if await db.grant_achievement(user_id, 'subscriber'):
             new_badges.append('subscriber')
 
-    # Notify about new badges
+    return new_badges
+
+
+async def notify_new_badges(user_id: int, new_badges: list, context: ContextTypes.DEFAULT_TYPE):
+    """Notify user about newly earned badges"""
     for badge_key in new_badges:
         badge = BADGES[badge_key]
         try:
@@ -96,7 +107,8 @@ async def check_achievements(user_id: int, action: str, context: ContextTypes.DE
                      f"{badge['emoji']} **{badge['name']}**\n"
                      f"{badge['desc']}\n\n"
                      f"Посмотри все бейджи в меню!",
-                parse_mode="Markdown"
+                parse_mode="Markdown",
+                rate_limit_args=NOTIFY
             )
         except Exception:
             pass
@@ -6,6 +6,7 @@ from telegram import Update, InlineKeyboardButton, InlineKeyboardMarkup, Labeled
 from telegram.ext import ContextTypes, CallbackQueryHandler
 
 import database as db
+from ratelimit import NOTIFY
 from config import COMPAT_PRICE, BOT_USERNAME
 
 # 7 compatibility questions
@@ -202,7 +203,8 @@ async def finish_compat(update: Update, context: ContextTypes.DEFAULT_TYPE):
                 chat_id=test['initiator_id'],
                 text=result_msg,
                 reply_markup=reply_markup,
-                parse_mode="Markdown"
+                parse_mode="Markdown",
+                rate_limit_args=NOTIFY
             )
         except Exception:
             pass
@@ -8,6 +8,7 @@ from telegram.ext import (
 )
 
 import database as db
+from ratelimit import NOTIFY
 from config import VOICE_PRICE, GIFT_PRICE, SCHEDULE_PRICE, PHOTO_PREMIUM_PRICE, VIRTUAL_GIFTS
 
 REACTIONS = ["❤️", "😍", "🥰", "💕", "😘", "🔥", "💖", "✨"]
@@ -19,15 +20,15 @@ WAITING_PHOTO_RECIPIENT, WAITING_PHOTO_MSG = range(102, 104)
 
 # ==================== LEADERBOARD ====================
 
-async def show_leaderboard(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    """Show top senders and receivers"""
-    query = update.callback_query
-    await query.answer()
+LEADERBOARD_TITLES = {"day": "за сегодня", "week": "за неделю", "all": "за всё время"}
+
 
-    top_receivers = await db.get_top_receivers(5)
-    top_senders = await db.get_top_senders(5)
+async def build_leaderboard(window: str = "all"):
+    """Leaderboard text and window switcher keyboard"""
+    top_receivers = await db.get_top_receivers(5, window=window)
+    top_senders = await db.get_top_senders(5, window=window)
 
-    text = "🏆 **ТОП ВАЛЕНТИНОК**\n\n"
+    text = f"🏆 **ТОП ВАЛЕНТИНОК** {LEADERBOARD_TITLES[window]}\n\n"
 
     text += "💌 **Больше всего получили:**\n"
     for i, u in enumerate(top_receivers, 1):
@@ -44,8 +45,23 @@ async def show_leaderboard(update: Update, context: ContextTypes.DEFAULT_TYPE):
     if not top_receivers and not top_senders:
         text += "\nПока нет данных. Будь первым! 🚀"
 
-    keyboard = [[InlineKeyboardButton("◀️ Назад", callback_data="menu_main")]]
-    await query.edit_message_text(text, reply_markup=InlineKeyboardMarkup(keyboard), parse_mode="Markdown")
+    windows = [("day", "📅 День"), ("week", "🗓 Неделя"), ("all", "♾ Всё время")]
+    keyboard = [
+        [InlineKeyboardButton(f"• {label}" if key == window else label, callback_data=f"top_{key}")
+         for key, label in windows],
+        [InlineKeyboardButton("◀️ Назад", callback_data="menu_main")]
+    ]
+    return text, InlineKeyboardMarkup(keyboard)
+
+
+async def show_leaderboard(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Show top senders and receivers"""
+    query = update.callback_query
+    await query.answer()
+
+    window = query.data.replace("top_", "") if query.data.startswith("top_") else "all"
+    text, reply_markup = await build_leaderboard(window)
+    await query.edit_message_text(text, reply_markup=reply_markup, parse_mode="Markdown")
 
 
 # ==================== REACTIONS ====================
@@ -83,7 +99,8 @@ async def set_reaction(update: Update, context: ContextTypes.DEFAULT_TYPE):
         try:
             await context.bot.send_message(
                 valentine['sender_id'],
-                f"💫 На твою валентинку отреагировали: {emoji}"
+                f"💫 На твою валентинку отреагировали: {emoji}",
+                rate_limit_args=NOTIFY
             )
         except Exception:
             pass
@@ -119,7 +136,8 @@ async def start_anon_chat(update: Update, context: ContextTypes.DEFAULT_TYPE):
     await context.bot.send_message(
         valentine['sender_id'],
         "💬 Получатель твоей валентинки хочет пообщаться анонимно!\nНажми кнопку, чтобы начать чат.",
-        reply_markup=InlineKeyboardMarkup(keyboard)
+        reply_markup=InlineKeyboardMarkup(keyboard),
+        rate_limit_args=NOTIFY
     )
 
     await query.edit_message_text(
@@ -253,12 +271,14 @@ async def voice_receive_message(update: Update, context: ContextTypes.DEFAULT_TY
                 chat_id=recipient_id,
                 text="🎤 **Тебе пришла голосовая валентинка!**\n\n❓ От тайного поклонника",
                 reply_markup=reply_markup,
-                parse_mode="Markdown"
+                parse_mode="Markdown",
+                rate_limit_args=NOTIFY
             )
             await context.bot.send_voice(
                 chat_id=recipient_id,
                 voice=voice.file_id,
-                caption="🎤 Анонимная голосовая валентинка!"
+                caption="🎤 Анонимная голосовая валентинка!",
+                rate_limit_args=NOTIFY
             )
             await db.mark_delivered(valentine_id)
         except Exception:
@@ -366,12 +386,14 @@ async def photo_receive_message(update: Update, context: ContextTypes.DEFAULT_TY
                 chat_id=recipient_id,
                 photo=photo_file_id,
                 caption="📸 **Тебе пришла фото-валентинка!**\n\n❓ От тайного поклонника",
-                parse_mode="Markdown"
+                parse_mode="Markdown",
+                rate_limit_args=NOTIFY
             )
             await context.bot.send_message(
                 chat_id=recipient_id,
                 text="Хочешь узнать, кто отправил?",
-                reply_markup=reply_markup
+                reply_markup=reply_markup,
+                rate_limit_args=NOTIFY
             )
             await db.mark_delivered(valentine_id)
         except Exception:
@@ -595,7 +617,7 @@ def get_extra_handlers():
     return [
         voice_conv,
         photo_conv,
-        CallbackQueryHandler(show_leaderboard, pattern="^menu_top$"),
+        CallbackQueryHandler(show_leaderboard, pattern="^(menu_top|top_(day|week|all))$"),
         CallbackQueryHandler(show_reactions, pattern=r"^react_\d+$"),
         CallbackQueryHandler(set_reaction, pattern="^setreact_"),
         CallbackQueryHandler(start_anon_chat, pattern=r"^anonchat_\d+$"),
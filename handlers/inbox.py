@@ -10,8 +10,9 @@ from templates import VALENTINE_DISPLAY
 ITEMS_PER_PAGE = 5
 
 
-async def show_inbox(update: Update, context: ContextTypes.DEFAULT_TYPE, page: int = 1):
-    """Show user's inbox with pagination"""
+async def show_inbox(update: Update, context: ContextTypes.DEFAULT_TYPE, page: int = 1,
+                     older_than: int = None, newer_than: int = None):
+    """Show user's inbox with keyset pagination (cursor = valentine id in callback data)"""
     query = update.callback_query
     if query:
         await query.answer()
@@ -36,9 +37,14 @@ async def show_inbox(update: Update, context: ContextTypes.DEFAULT_TYPE, page: i
     # Pagination
     total_pages = (total + ITEMS_PER_PAGE - 1) // ITEMS_PER_PAGE
     page = max(1, min(page, total_pages))
-    offset = (page - 1) * ITEMS_PER_PAGE
 
-    valentines = await db.get_inbox(user.id, limit=ITEMS_PER_PAGE, offset=offset)
+    valentines = await db.get_inbox(
+        user.id, limit=ITEMS_PER_PAGE, older_than=older_than, newer_than=newer_than
+    )
+    if not valentines or (newer_than is not None and len(valentines) < ITEMS_PER_PAGE):
+        # Cursor fell off an end of the list — restart from the newest page
+        page = 1
+        valentines = await db.get_inbox(user.id, limit=ITEMS_PER_PAGE)
 
     text = f"📬 **Входящие** ({total} шт., стр. {page}/{total_pages})\n"
 
@@ -48,7 +54,7 @@ async def show_inbox(update: Update, context: ContextTypes.DEFAULT_TYPE, page: i
         else:
             sender_info = "❓ Тайный отправитель"
 
-        created_at = v['created_at'][:10] if v['created_at'] else ""
+        created_at = str(v['created_at'])[:10] if v['created_at'] else ""
 
         text += VALENTINE_DISPLAY.format(
             id=v['id'],
@@ -89,9 +95,13 @@ async def show_inbox(update: Update, context: ContextTypes.DEFAULT_TYPE, page: i
     # Pagination
     nav_buttons = []
     if page > 1:
-        nav_buttons.append(InlineKeyboardButton("⬅️", callback_data=f"inbox_page_{page - 1}"))
-    if page < total_pages:
-        nav_buttons.append(InlineKeyboardButton("➡️", callback_data=f"inbox_page_{page + 1}"))
+        nav_buttons.append(InlineKeyboardButton(
+            "⬅️", callback_data=f"inbox_prev_{page - 1}_{valentines[0]['id']}"
+        ))
+    if page < total_pages and len(valentines) == ITEMS_PER_PAGE:
+        nav_buttons.append(InlineKeyboardButton(
+            "➡️", callback_data=f"inbox_next_{page + 1}_{valentines[-1]['id']}"
+        ))
     if nav_buttons:
         keyboard.append(nav_buttons)
 
@@ -111,14 +121,20 @@ async def inbox_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
 
     if query.data == "menu_inbox":
         await show_inbox(update, context, page=1)
+    elif query.data.startswith("inbox_next_"):
+        page, cursor = map(int, query.data.replace("inbox_next_", "").split("_"))
+        await show_inbox(update, context, page=page, older_than=cursor)
+    elif query.data.startswith("inbox_prev_"):
+        page, cursor = map(int, query.data.replace("inbox_prev_", "").split("_"))
+        await show_inbox(update, context, page=page, newer_than=cursor)
     elif query.data.startswith("inbox_page_"):
-        page = int(query.data.replace("inbox_page_", ""))
-        await show_inbox(update, context, page=page)
+        # Buttons on messages sent before keyset pagination
+        await show_inbox(update, context, page=1)
 
 
 def get_inbox_handlers():
     """Return inbox-related handlers"""
     return [
         CallbackQueryHandler(inbox_callback, pattern="^menu_inbox$"),
-        CallbackQueryHandler(inbox_callback, pattern="^inbox_page_"),
+        CallbackQueryHandler(inbox_callback, pattern="^inbox_(next|prev|page)_"),
     ]
@@ -161,11 +161,12 @@ async def successful_payment_callback(update: Update, context: ContextTypes.DEFA
             if plan_key == "lovebomb3m":
                 plan_key = "lovebomb"
                 days = 90
-            await db.create_subscription(user.id, plan_key, days, charge_id)
-            await db.record_payment(
-                user_id=user.id, amount=amount,
-                payment_type=f"sub_{plan_key}", charge_id=charge_id
-            )
+            async with db.transaction():
+                await db.create_subscription(user.id, plan_key, days, charge_id)
+                await db.record_payment(
+                    user_id=user.id, amount=amount,
+                    payment_type=f"sub_{plan_key}", charge_id=charge_id
+                )
             plan_labels = {
                 "romantic": "Romantic 💕",
                 "lovebomb": "Lovebomb 💣",
@@ -8,6 +8,8 @@ from telegram.ext import (
 )
 
 import database as db
+import matchmaker
+from ratelimit import NOTIFY
 from templates import format_valentine, VALENTINE_RECEIVED_TEXT
 from config import ROULETTE_EXTRA_PRICE
 
@@ -23,7 +25,12 @@ async def start_roulette(update: Update, context: ContextTypes.DEFAULT_TYPE):
 
     can_free = await db.can_use_roulette_free(user.id)
 
-    if not can_free and not context.user_data.pop('roulette_paid', False):
+    paid = context.user_data.pop('roulette_paid', False)
+    if not can_free and not paid:
+        # A paid match refunded when its entry expired unmatched
+        paid = await db.take_roulette_credit(user.id)
+
+    if not can_free and not paid:
         # Limit reached — offer to pay 10⭐
         keyboard = [
             [InlineKeyboardButton(
@@ -42,6 +49,9 @@ async def start_roulette(update: Update, context: ContextTypes.DEFAULT_TYPE):
         )
         return ConversationHandler.END
 
+    # A paid extra match is consumed past the free limit
+    context.user_data['roulette_force'] = not can_free
+
     keyboard = [[InlineKeyboardButton("❌ Отмена", callback_data="cancel_roulette")]]
     reply_markup = InlineKeyboardMarkup(keyboard)
 
@@ -66,31 +76,37 @@ async def receive_roulette_message(update: Update, context: ContextTypes.DEFAULT
         await update.message.reply_text("❌ Слишком длинно! Максимум 500 символов.")
         return WAITING_ROULETTE_MSG
 
-    # Record roulette usage
-    await db.use_roulette_slot(user.id)
+    # Record roulette usage (check-and-consume, so double taps can't exceed the limit)
+    paid = context.user_data.pop('roulette_force', False)
+    if not await db.use_roulette_slot(user.id, paid=paid):
+        keyboard = [[InlineKeyboardButton("◀️ Меню", callback_data="menu_main")]]
+        await update.message.reply_text(
+            "⚠️ Бесплатный матч на сегодня уже использован!",
+            reply_markup=InlineKeyboardMarkup(keyboard)
+        )
+        return ConversationHandler.END
 
-    # Check for existing match
-    match = await db.find_roulette_match(user.id)
+    # Claim a waiting player and exchange valentines in one unit of work
+    async with db.transaction():
+        match = await matchmaker.claim(user.id)
 
-    if match:
-        # Found a match! Exchange valentines
-        await db.mark_roulette_matched(match['id'])
-
-        # Create valentines for both
-        v1_id = await db.create_valentine(
-            sender_id=user.id,
-            receiver_id=match['user_id'],
-            message=message
-        )
-        v2_id = await db.create_valentine(
-            sender_id=match['user_id'],
-            receiver_id=user.id,
-            message=match['message']
-        )
+        if match:
+            # Create valentines for both
+            v1_id = await db.create_valentine(
+                sender_id=user.id,
+                receiver_id=match['user_id'],
+                message=message
+            )
+            v2_id = await db.create_valentine(
+                sender_id=match['user_id'],
+                receiver_id=user.id,
+                message=match['message']
+            )
 
-        await db.mark_delivered(v1_id)
-        await db.mark_delivered(v2_id)
+            await db.mark_delivered(v1_id)
+            await db.mark_delivered(v2_id)
 
+    if match:
         # Send to current user
         formatted_received = format_valentine(match['message'])
         keyboard1 = [
@@ -118,7 +134,8 @@ async def receive_roulette_message(update: Update, context: ContextTypes.DEFAULT
                 text=f"🎰 **МАТЧ В РУЛЕТКЕ!**\n\n"
                      f"Тебе пришла валентинка:\n\n{formatted_sent}",
                 reply_markup=InlineKeyboardMarkup(keyboard2),
-                parse_mode="Markdown"
+                parse_mode="Markdown",
+                rate_limit_args=NOTIFY
             )
         except Exception:
             pass
@@ -129,7 +146,7 @@ async def receive_roulette_message(update: Update, context: ContextTypes.DEFAULT
 
     else:
         # No match - add to queue
-        await db.add_to_roulette(user.id, message)
+        await matchmaker.enqueue(user.id, message, paid)
 
         keyboard = [
             [InlineKeyboardButton("◀️ Меню", callback_data="menu_main")]
@@ -151,6 +168,10 @@ async def cancel_roulette(update: Update, context: ContextTypes.DEFAULT_TYPE):
     query = update.callback_query
     await query.answer()
 
+    # An unused paid match stays available for the next try
+    if context.user_data.pop('roulette_force', False):
+        context.user_data['roulette_paid'] = True
+
     from handlers.start import show_main_menu
     await show_main_menu(update, context)
     return ConversationHandler.END
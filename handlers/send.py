@@ -8,6 +8,8 @@ from telegram.ext import (
 )
 
 import database as db
+import scheduler
+from ratelimit import NOTIFY
 from config import MAX_MESSAGE_LENGTH, BUNDLE_PRICE, BOT_USERNAME, CHAIN_TARGET, REVEAL_PRICE
 from templates import (
     RECIPIENT_PROMPT_TEXT, MESSAGE_PROMPT_TEXT, CONFIRM_SEND_TEXT,
@@ -246,37 +248,54 @@ async def confirm_send(update: Update, context: ContextTypes.DEFAULT_TYPE):
     music_url = context.user_data.get('music_url')
     schedule_time = context.user_data.get('schedule_time') if context.user_data.get('schedule_active') else None
 
-    # Use send slot
-    await db.use_send_slot(user.id)
+    # Quota, valentine, chain and badges commit together in one transaction
+    from handlers.achievements import award_achievements, notify_new_badges
+    new_badges = []
+    async with db.transaction():
+        # Use send slot — checked and consumed atomically, nothing is written if over the limit
+        slot_used = await db.use_send_slot(user.id)
+        if slot_used:
+            # Create valentine
+            valentine_id = await db.create_valentine(
+                sender_id=user.id,
+                receiver_id=recipient_id,
+                message=message,
+                music_url=music_url,
+                scheduled_for=schedule_time
+            )
 
-    # Create valentine
-    valentine_id = await db.create_valentine(
-        sender_id=user.id,
-        receiver_id=recipient_id,
-        message=message,
-        music_url=music_url,
-        scheduled_for=schedule_time
-    )
+            # Increment chain
+            chain_count = await db.increment_chain(user.id)
 
-    # Increment chain
-    chain_count = await db.increment_chain(user.id)
+            # Check chain achievement
+            if chain_count >= CHAIN_TARGET:
+                new_badges += await award_achievements(user.id, 'chain')
+                # Grant bonus valentine
+                if chain_count == CHAIN_TARGET:
+                    await db.add_bonus_valentines(user.id, 1)
 
-    # Check chain achievement
-    from handlers.achievements import check_achievements
-    if chain_count >= CHAIN_TARGET:
-        await check_achievements(user.id, 'chain', context)
-        # Grant bonus valentine
-        if chain_count == CHAIN_TARGET:
-            await db.add_bonus_valentines(user.id, 1)
+            # Check send achievement
+            new_badges += await award_achievements(user.id, 'send')
+            if music_url:
+                new_badges += await award_achievements(user.id, 'music')
 
-    # Check send achievement
-    await check_achievements(user.id, 'send', context)
-    if music_url:
-        await check_achievements(user.id, 'music', context)
+    if not slot_used:
+        context.user_data.clear()
+        keyboard = [[InlineKeyboardButton("◀️ В меню", callback_data="menu_main")]]
+        await query.edit_message_text(
+            "⚠️ **Дневной лимит исчерпан!**\n\n"
+            "Бесплатные послания на сегодня закончились.",
+            reply_markup=InlineKeyboardMarkup(keyboard),
+            parse_mode="Markdown"
+        )
+        return ConversationHandler.END
+
+    await notify_new_badges(user.id, new_badges, context)
 
     # Deliver
     if schedule_time:
-        # Scheduled delivery
+        # Scheduled delivery — wake the scheduler so it sleeps until this one is due
+        scheduler.poke(valentine_id, schedule_time)
         context.user_data.clear()
 
         keyboard = [[InlineKeyboardButton("◀️ В меню", callback_data="menu_main")]]
@@ -342,7 +361,8 @@ async def deliver_valentine(context: ContextTypes.DEFAULT_TYPE, valentine_id: in
         chat_id=recipient_id,
         text=text,
         reply_markup=reply_markup,
-        parse_mode="Markdown"
+        parse_mode="Markdown",
+        rate_limit_args=NOTIFY
     )
 
 
@@ -5,6 +5,7 @@ from telegram import Update, InlineKeyboardButton, InlineKeyboardMarkup, ReplyKe
 from telegram.ext import ContextTypes, CommandHandler, CallbackQueryHandler, MessageHandler, filters
 
 import database as db
+from ratelimit import NOTIFY
 from templates import WELCOME_TEXT, STATS_TEXT
 from config import ZODIAC_SIGNS, CHAIN_TARGET, BOT_USERNAME
 
@@ -49,7 +50,8 @@ async def start_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
                 try:
                     await context.bot.send_message(
                         referrer_id,
-                        f"🎁 Твой друг {user.first_name} присоединился! +1 валентинка!"
+                        f"🎁 Твой друг {user.first_name} присоединился! +1 валентинка!",
+                        rate_limit_args=NOTIFY
                     )
                 except Exception:
                     pass
@@ -349,28 +351,9 @@ async def handle_keyboard_button(update: Update, context: ContextTypes.DEFAULT_T
         await show_invite(update, context)
 
     elif action == "top":
-        top_receivers = await db.get_top_receivers(5)
-        top_senders = await db.get_top_senders(5)
-
-        content = "🏆 **ТОП ВАЛЕНТИНОК**\n\n"
-        content += "💌 **Больше всего получили:**\n"
-        for i, u in enumerate(top_receivers, 1):
-            name = u['first_name'] or u['username'] or 'Аноним'
-            medal = ["🥇", "🥈", "🥉"][i - 1] if i <= 3 else f"{i}."
-            content += f"{medal} {name} — {u['count']} 💌\n"
-        if not top_receivers:
-            content += "_Пока нет данных_\n"
-
-        content += "\n💝 **Больше всего отправили:**\n"
-        for i, u in enumerate(top_senders, 1):
-            name = u['first_name'] or u['username'] or 'Аноним'
-            medal = ["🥇", "🥈", "🥉"][i - 1] if i <= 3 else f"{i}."
-            content += f"{medal} {name} — {u['count']} 💝\n"
-        if not top_senders:
-            content += "_Пока нет данных. Будь первым! 🚀_\n"
-
-        keyboard = [[InlineKeyboardButton("◀️ Назад", callback_data="menu_main")]]
-        await update.message.reply_text(content, reply_markup=InlineKeyboardMarkup(keyboard), parse_mode="Markdown")
+        from handlers.extras import build_leaderboard
+        content, reply_markup = await build_leaderboard()
+        await update.message.reply_text(content, reply_markup=reply_markup, parse_mode="Markdown")
 
     elif action == "chain":
         stats = await db.get_user_stats(user.id)
@@ -0,0 +1,167 @@
+"""
+In-process roulette matchmaker for the polling worker
+Waiting players live in memory and are paired the moment someone joins;
+roulette_queue only keeps them durable across restarts
+"""
+import asyncio
+import functools
+import logging
+from collections import OrderedDict
+from typing import Optional
+
+from telegram import InlineKeyboardButton, InlineKeyboardMarkup
+
+import config
+import database as db
+from ratelimit import NOTIFY
+
+logger = logging.getLogger(__name__)
+
+_engine = None
+
+
+class _Waiter:
+    """One player waiting for a pair"""
+    __slots__ = ("queue_id", "user_id", "paid", "timer")
+
+    def __init__(self, queue_id: int, user_id: int, paid: bool, timer: asyncio.TimerHandle):
+        self.queue_id = queue_id
+        self.user_id = user_id
+        self.paid = paid
+        self.timer = timer
+
+
+class Matchmaker:
+    """Pairs roulette players from memory and expires entries nobody took"""
+
+    def __init__(self, bot, timeout: float):
+        self._bot = bot
+        self.timeout = timeout
+        self._waiting = OrderedDict()  # queue_id -> _Waiter, oldest first
+        self._tasks = set()
+
+    def _add(self, queue_id: int, user_id: int, paid: bool):
+        loop = asyncio.get_running_loop()
+        timer = loop.call_later(self.timeout, self._spawn_expire, queue_id)
+        self._waiting[queue_id] = _Waiter(queue_id, user_id, paid, timer)
+
+    def _restore(self, waiter: _Waiter):
+        """Put back a waiter whose claim was rolled back, keeping its deadline"""
+        if waiter.queue_id in self._waiting:
+            return
+        loop = asyncio.get_running_loop()
+        waiter.timer = loop.call_at(waiter.timer.when(), self._spawn_expire, waiter.queue_id)
+        self._waiting[waiter.queue_id] = waiter
+        # Back to its oldest-first position
+        for queue_id in [q for q in self._waiting if q > waiter.queue_id]:
+            self._waiting.move_to_end(queue_id)
+
+    def _spawn_expire(self, queue_id: int):
+        task = asyncio.create_task(self._expire(queue_id))
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+
+    async def restore(self):
+        """Pick up entries left waiting before a restart (each gets a fresh timeout)"""
+        for entry in await db.get_waiting_roulette():
+            self._add(entry['id'], entry['user_id'], bool(entry.get('paid')))
+        if self._waiting:
+            logger.info(f"Matchmaker restored {len(self._waiting)} waiting roulette entries")
+
+    async def claim(self, user_id: int) -> Optional[dict]:
+        """Take the oldest in-memory waiter of another user, else any waiting row
+
+        Inside db.transaction() a rollback releases the row again, so the
+        waiter is put back then (with its original expiry).
+        """
+        while True:
+            waiter = next((w for w in self._waiting.values() if w.user_id != user_id), None)
+            if waiter is None:
+                break
+            # Popped before the await, so concurrent claimers never see it
+            del self._waiting[waiter.queue_id]
+            waiter.timer.cancel()
+            try:
+                match = await db.claim_roulette_entry(waiter.queue_id)
+            except Exception:
+                self._restore(waiter)
+                raise
+            if match:
+                db.after_rollback(functools.partial(self._restore, waiter))
+                return match
+        # Entries queued by other processes (e.g. the webhook) aren't in memory
+        match = await db.claim_roulette_match(user_id)
+        if match:
+            stale = self._waiting.pop(match['id'], None)
+            if stale:
+                stale.timer.cancel()
+                db.after_rollback(functools.partial(self._restore, stale))
+        return match
+
+    async def enqueue(self, user_id: int, message: str, paid: bool = False) -> int:
+        """Persist the entry and wait in memory until paired or expired"""
+        queue_id = await db.add_to_roulette(user_id, message, paid)
+        self._add(queue_id, user_id, paid)
+        return queue_id
+
+    async def _expire(self, queue_id: int):
+        waiter = self._waiting.pop(queue_id, None)
+        if waiter is None:
+            return
+        try:
+            if not await db.expire_roulette_entry(queue_id):
+                return
+            refunded = await db.refund_roulette_slot(waiter.user_id, waiter.paid)
+            keyboard = [
+                [InlineKeyboardButton("🎰 Ещё раз!", callback_data="menu_roulette")],
+                [InlineKeyboardButton("◀️ Меню", callback_data="menu_main")]
+            ]
+            await self._bot.send_message(
+                chat_id=waiter.user_id,
+                text="⌛ **Пара не нашлась**\n\n"
+                     "За это время никто не присоединился к рулетке"
+                     + (" — попытка возвращена. " if refunded else ". ")
+                     + "Попробуй ещё раз! 🎰",
+                reply_markup=InlineKeyboardMarkup(keyboard),
+                parse_mode="Markdown",
+                rate_limit_args=NOTIFY
+            )
+        except Exception as e:
+            logger.error(f"Failed to expire roulette entry {queue_id}: {e}")
+
+    def stop(self):
+        """Cancel pending expiry timers (entries stay in roulette_queue)"""
+        for waiter in self._waiting.values():
+            waiter.timer.cancel()
+        self._waiting.clear()
+        for task in self._tasks:
+            task.cancel()
+
+
+async def start(bot):
+    """Start the in-process matchmaker (polling worker only)"""
+    global _engine
+    _engine = Matchmaker(bot, config.ROULETTE_WAIT_TIMEOUT)
+    await _engine.restore()
+
+
+def stop():
+    """Stop the matchmaker on shutdown"""
+    global _engine
+    if _engine is not None:
+        _engine.stop()
+        _engine = None
+
+
+async def claim(user_id: int) -> Optional[dict]:
+    """Claim a roulette partner for user_id; call inside db.transaction()"""
+    if _engine is not None:
+        return await _engine.claim(user_id)
+    return await db.claim_roulette_match(user_id)
+
+
+async def enqueue(user_id: int, message: str, paid: bool = False) -> int:
+    """Put user_id in the roulette queue (`paid`: the slot was bought with Stars)"""
+    if _engine is not None:
+        return await _engine.enqueue(user_id, message, paid)
+    return await db.add_to_roulette(user_id, message, paid)
@@ -0,0 +1,35 @@
+"""
+Schema migration entry point
+Run once per deploy: python migrate.py
+Recompute user stat counters: python migrate.py --repair-counters
+"""
+import asyncio
+import logging
+import sys
+
+import database as db
+
+logging.basicConfig(
+    format='%(asctime)s - %(name)s - %(levelname)s - %(message)s',
+    level=logging.INFO
+)
+logger = logging.getLogger(__name__)
+
+
+async def main():
+    """Apply pending migrations and report the schema version"""
+    before = await db.get_schema_version()
+    await db.migrate()
+    after = await db.get_schema_version()
+    if after == before:
+        logger.info(f"Schema already at version {after}")
+    else:
+        logger.info(f"Schema migrated from version {before} to {after}")
+    if "--repair-counters" in sys.argv[1:]:
+        fixed = await db.repair_user_counters()
+        logger.info(f"Repaired stat counters for {fixed} users")
+    await db.close_db()
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
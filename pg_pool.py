@@ -0,0 +1,265 @@
+"""
+Postgres connection pool for Valentine Bot
+Keeps warm psycopg2 connections around instead of a full connect per query
+"""
+import logging
+import threading
+import time
+from collections import deque
+
+import psycopg2
+from psycopg2 import extensions
+from psycopg2.pool import PoolError
+
+logger = logging.getLogger(__name__)
+
+
+class _Slot:
+    """Bookkeeping for one pooled connection"""
+    __slots__ = ("conn", "created_at", "last_used")
+
+    def __init__(self, conn):
+        now = time.monotonic()
+        self.conn = conn
+        self.created_at = now
+        self.last_used = now
+
+
+class PgPool:
+    """Thread-safe psycopg2 pool with health checks and idle recycling
+
+    - keeps at least `min_size` connections open, never more than `max_size`
+    - idle connections above `min_size` are closed after `max_idle` seconds
+    - every connection is replaced after `max_lifetime` seconds
+    - a connection idle longer than `check_after` seconds is pinged before reuse
+    """
+
+    def __init__(self, dsn: str, min_size: int = 1, max_size: int = 10,
+                 max_idle: float = 300.0, max_lifetime: float = 1800.0,
+                 timeout: float = 10.0, check_after: float = 30.0,
+                 autocommit: bool = False, cursor_factory=None):
+        if min_size < 0 or max_size < 1 or min_size > max_size:
+            raise ValueError("invalid pool size: min=%s max=%s" % (min_size, max_size))
+        self._dsn = dsn
+        self._autocommit = autocommit
+        self._cursor_factory = cursor_factory
+        self.min_size = min_size
+        self.max_size = max_size
+        self.max_idle = max_idle
+        self.max_lifetime = max_lifetime
+        self.timeout = timeout
+        self.check_after = check_after
+
+        self._cond = threading.Condition()
+        self._idle = deque()     # _Slot, most recently used on the right
+        self._in_use = {}        # id(conn) -> _Slot
+        self._opening = 0
+        self._closed = False
+
+        self._stats = {
+            "connections_opened": 0,
+            "connections_closed": 0,
+            "acquired": 0,
+            "released": 0,
+            "waits": 0,
+            "timeouts": 0,
+            "health_check_failures": 0,
+            "wait_time_total": 0.0,
+            "wait_time_max": 0.0,
+        }
+
+    # ---------------------------------------------------------------- connect
+
+    def _connect(self):
+        conn = psycopg2.connect(self._dsn, cursor_factory=self._cursor_factory)
+        conn.autocommit = self._autocommit
+        return conn
+
+    def _open_slot(self) -> _Slot:
+        """Open a new connection outside the lock (reserved via self._opening)"""
+        try:
+            slot = _Slot(self._connect())
+        except Exception:
+            with self._cond:
+                self._opening -= 1
+                self._cond.notify()
+            raise
+        with self._cond:
+            self._opening -= 1
+            self._stats["connections_opened"] += 1
+        return slot
+
+    def _close_slot(self, slot: _Slot):
+        try:
+            slot.conn.close()
+        except Exception:
+            pass
+        with self._cond:
+            self._stats["connections_closed"] += 1
+
+    def _size(self) -> int:
+        return len(self._idle) + len(self._in_use) + self._opening
+
+    def _is_healthy(self, slot: _Slot, now: float) -> bool:
+        """Cheap checks always, a round-trip ping only if the connection sat idle"""
+        conn = slot.conn
+        if conn.closed:
+            return False
+        if now - slot.created_at > self.max_lifetime:
+            return False
+        if now - slot.last_used < self.check_after:
+            return True
+        try:
+            cur = conn.cursor()
+            cur.execute("SELECT 1")
+            cur.close()
+            conn.rollback()
+            return True
+        except Exception:
+            with self._cond:
+                self._stats["health_check_failures"] += 1
+            return False
+
+    # ---------------------------------------------------------------- acquire / release
+
+    def getconn(self):
+        """Check out a connection, waiting up to `timeout` seconds if the pool is full"""
+        deadline = None
+        started = time.monotonic()
+
+        while True:
+            slot = None
+            open_new = False
+            with self._cond:
+                if self._closed:
+                    raise PoolError("connection pool is closed")
+                while not self._idle and self._size() >= self.max_size:
+                    if deadline is None:
+                        deadline = started + self.timeout
+                        self._stats["waits"] += 1
+                    remaining = deadline - time.monotonic()
+                    if remaining <= 0:
+                        self._stats["timeouts"] += 1
+                        raise PoolError(
+                            "connection pool exhausted (max_size=%s, timeout=%ss)"
+                            % (self.max_size, self.timeout)
+                        )
+                    self._cond.wait(remaining)
+                    if self._closed:
+                        raise PoolError("connection pool is closed")
+                if self._idle:
+                    slot = self._idle.pop()
+                else:
+                    self._opening += 1
+                    open_new = True
+
+            if open_new:
+                slot = self._open_slot()
+            elif not self._is_healthy(slot, time.monotonic()):
+                self._close_slot(slot)
+                continue
+
+            now = time.monotonic()
+            slot.last_used = now
+            with self._cond:
+                self._in_use[id(slot.conn)] = slot
+                self._stats["acquired"] += 1
+                if deadline is not None:
+                    waited = now - started
+                    self._stats["wait_time_total"] += waited
+                    self._stats["wait_time_max"] = max(self._stats["wait_time_max"], waited)
+            return slot.conn
+
+    def putconn(self, conn, discard: bool = False):
+        """Return a connection to the pool (rolled back if a transaction was left open)"""
+        with self._cond:
+            slot = self._in_use.pop(id(conn), None)
+            self._stats["released"] += 1
+        if slot is None:
+            raise PoolError("trying to put unkeyed connection")
+
+        if not discard and not conn.closed:
+            try:
+                if conn.get_transaction_status() != extensions.TRANSACTION_STATUS_IDLE:
+                    conn.rollback()
+                if conn.autocommit != self._autocommit:
+                    conn.autocommit = self._autocommit
+            except Exception:
+                discard = True
+        if discard or conn.closed or time.monotonic() - slot.created_at > self.max_lifetime:
+            self._close_slot(slot)
+            with self._cond:
+                self._cond.notify()
+            return
+
+        slot.last_used = time.monotonic()
+        with self._cond:
+            if self._closed:
+                stale = [slot]
+            else:
+                self._idle.append(slot)
+                stale = self._take_stale_locked(slot.last_used)
+            self._cond.notify()
+        for s in stale:
+            self._close_slot(s)
+
+    def _take_stale_locked(self, now: float) -> list:
+        """Pop idle connections above min_size that have not been used for max_idle"""
+        stale = []
+        while self._idle and len(self._idle) + len(self._in_use) > self.min_size:
+            oldest = self._idle[0]
+            if now - oldest.last_used <= self.max_idle:
+                break
+            stale.append(self._idle.popleft())
+        return stale
+
+    # ---------------------------------------------------------------- maintenance
+
+    def fill(self):
+        """Open connections until min_size are available"""
+        while True:
+            with self._cond:
+                if self._closed or self._size() >= self.min_size:
+                    return
+                self._opening += 1
+            slot = self._open_slot()
+            with self._cond:
+                self._idle.appendleft(slot)
+                self._cond.notify()
+
+    def recycle_idle(self):
+        """Close idle connections past max_idle / max_lifetime"""
+        now = time.monotonic()
+        with self._cond:
+            stale = self._take_stale_locked(now)
+            keep = deque()
+            for slot in self._idle:
+                if now - slot.created_at > self.max_lifetime or slot.conn.closed:
+                    stale.append(slot)
+                else:
+                    keep.append(slot)
+            self._idle = keep
+        for slot in stale:
+            self._close_slot(slot)
+
+    def closeall(self):
+        """Close every idle connection; checked-out ones are closed when returned"""
+        with self._cond:
+            self._closed = True
+            idle, self._idle = list(self._idle), deque()
+            self._cond.notify_all()
+        for slot in idle:
+            self._close_slot(slot)
+
+    def stats(self) -> dict:
+        """Snapshot of pool counters"""
+        with self._cond:
+            snapshot = dict(self._stats)
+            snapshot.update({
+                "min_size": self.min_size,
+                "max_size": self.max_size,
+                "size": self._size(),
+                "idle": len(self._idle),
+                "in_use": len(self._in_use),
+            })
+        return snapshot
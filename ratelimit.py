@@ -0,0 +1,199 @@
+"""
+Outgoing Telegram request limiting
+Every Bot API call goes through one OutboundLimiter: a global token bucket
+(Telegram allows a bot ~30 messages/s) served by priority lane, per-chat
+spacing for notifications and RetryAfter-aware retries
+"""
+import asyncio
+import heapq
+import itertools
+import logging
+import time
+from datetime import timedelta
+
+from telegram.error import RetryAfter
+from telegram.ext import BaseRateLimiter
+
+import config
+
+logger = logging.getLogger(__name__)
+
+# Priority lanes, passed to bot methods as `rate_limit_args`; lower goes first
+INTERACTIVE = 0  # replies, edits and callback answers to the user at hand (default)
+NOTIFY = 1       # messages to other users: deliveries, matches, badges
+BULK = 2         # scheduled deliveries
+LANE_NAMES = {INTERACTIVE: "interactive", NOTIFY: "notify", BULK: "bulk"}
+
+_limiter = None
+
+
+def retry_after_seconds(error: RetryAfter) -> float:
+    """RetryAfter.retry_after is an int or a timedelta depending on the PTB version"""
+    value = error.retry_after
+    if isinstance(value, timedelta):
+        return value.total_seconds()
+    return float(value)
+
+
+class TokenBucket:
+    """Allows `rate` acquisitions per second with bursts up to `capacity`
+
+    The default capacity of 1 spaces calls evenly, so no one-second window
+    ever sees more than `rate` + 1 of them. Waiters are served by lane,
+    then in arrival order.
+    """
+
+    def __init__(self, rate: float, capacity: float = 1):
+        self.rate = rate
+        self.capacity = capacity
+        self._tokens = self.capacity
+        self._updated = time.monotonic()
+        self._paused_until = 0.0
+        self._waiters = []  # heap of (lane, seq, future)
+        self._seq = itertools.count()
+        self._pump = None
+
+    def _refill(self, now: float):
+        self._tokens = min(self.capacity, self._tokens + (now - self._updated) * self.rate)
+        self._updated = now
+
+    async def acquire(self, lane: int = INTERACTIVE):
+        """Wait for a token"""
+        future = asyncio.get_running_loop().create_future()
+        heapq.heappush(self._waiters, (lane, next(self._seq), future))
+        if self._pump is None or self._pump.done():
+            self._pump = asyncio.create_task(self._hand_out())
+        await future
+
+    async def _hand_out(self):
+        """Give tokens to the best waiter as they become available"""
+        while self._waiters:
+            now = time.monotonic()
+            if now < self._paused_until:
+                await asyncio.sleep(self._paused_until - now)
+                continue
+            self._refill(now)
+            if self._tokens < 1:
+                await asyncio.sleep((1 - self._tokens) / self.rate)
+                continue
+            _, _, future = heapq.heappop(self._waiters)
+            if future.done():  # the waiter was cancelled
+                continue
+            self._tokens -= 1
+            future.set_result(None)
+
+    def pause(self, seconds: float):
+        """Hold every caller back, e.g. after Telegram answered with RetryAfter"""
+        self._paused_until = max(self._paused_until, time.monotonic() + seconds)
+        self._tokens = 0
+
+    def close(self):
+        """Stop handing out tokens"""
+        if self._pump is not None:
+            self._pump.cancel()
+
+
+class ChatSpacer:
+    """Keeps at least `interval` seconds between messages to the same chat"""
+
+    def __init__(self, interval: float):
+        self.interval = interval
+        self._next = {}  # chat_id -> monotonic time of the next free slot
+
+    async def wait(self, chat_id):
+        """Reserve the chat's next slot and sleep until it"""
+        now = time.monotonic()
+        if len(self._next) > 10000:
+            self._next = {c: t for c, t in self._next.items() if t > now}
+        slot = max(now, self._next.get(chat_id, 0.0))
+        self._next[chat_id] = slot + self.interval
+        if slot > now:
+            await asyncio.sleep(slot - now)
+
+
+class OutboundLimiter(BaseRateLimiter):
+    """Rate limiter for ExtBot: priority lanes over one global bucket
+
+    - every request takes a token; INTERACTIVE requests are served first
+    - NOTIFY and BULK sends to the same chat are `chat_interval` seconds apart
+    - on RetryAfter the whole bucket pauses and the request is retried
+      up to `max_retries` times
+    """
+
+    def __init__(self, rate: float, chat_interval: float, max_retries: int = 3):
+        self.rate = rate
+        self.max_retries = max_retries
+        self._spacer = ChatSpacer(chat_interval)
+        self._bucket = None  # (event loop, TokenBucket)
+        self._stats = {
+            name: {"requests": 0, "retries": 0, "failed": 0,
+                   "wait_time_total": 0.0, "wait_time_max": 0.0}
+            for name in LANE_NAMES.values()
+        }
+        self._stats["flood_waits"] = 0
+
+    def _get_bucket(self) -> TokenBucket:
+        # One bucket per event loop: the webhook reuses one Application across
+        # per-request loops, and a bucket's waiters and pump belong to the
+        # loop that created them. All lanes share that loop's bucket (and so
+        # the rate); the lane only orders its waiters
+        loop = asyncio.get_running_loop()
+        if self._bucket is None or self._bucket[0] is not loop:
+            self._bucket = (loop, TokenBucket(self.rate))
+        return self._bucket[1]
+
+    async def initialize(self):
+        pass
+
+    async def shutdown(self):
+        if self._bucket is not None:
+            self._bucket[1].close()
+            self._bucket = None
+
+    async def process_request(self, callback, args, kwargs, endpoint, data, rate_limit_args):
+        lane = rate_limit_args if rate_limit_args in LANE_NAMES else INTERACTIVE
+        stats = self._stats[LANE_NAMES[lane]]
+        stats["requests"] += 1
+        chat_id = data.get("chat_id")
+        bucket = self._get_bucket()
+
+        for attempt in range(self.max_retries + 1):
+            started = time.monotonic()
+            if lane != INTERACTIVE and chat_id is not None:
+                await self._spacer.wait(chat_id)
+            await bucket.acquire(lane)
+            waited = time.monotonic() - started
+            stats["wait_time_total"] += waited
+            stats["wait_time_max"] = max(stats["wait_time_max"], waited)
+            try:
+                return await callback(*args, **kwargs)
+            except RetryAfter as e:
+                self._stats["flood_waits"] += 1
+                if attempt == self.max_retries:
+                    stats["failed"] += 1
+                    raise
+                stats["retries"] += 1
+                delay = retry_after_seconds(e)
+                logger.warning(f"Flood control on {endpoint}, pausing sends for {delay}s")
+                bucket.pause(delay)
+
+    def stats(self) -> dict:
+        """Snapshot of per-lane counters"""
+        return {key: dict(value) if isinstance(value, dict) else value
+                for key, value in self._stats.items()}
+
+
+def get_limiter() -> OutboundLimiter:
+    """Process-wide limiter shared by every bot this process builds"""
+    global _limiter
+    if _limiter is None:
+        _limiter = OutboundLimiter(config.SEND_RATE_PER_SECOND, config.SEND_CHAT_INTERVAL,
+                                   config.SEND_MAX_RETRIES)
+    return _limiter
+
+
+def get_stats() -> dict:
+    """Outbound request statistics (empty before the first bot is built)"""
+    if _limiter is None:
+        return {}
+    return _limiter.stats()
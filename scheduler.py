@@ -2,88 +2,176 @@
 Scheduled valentine delivery
 """
 import asyncio
+import heapq
 import logging
+import time
 from datetime import datetime
 
 import database as db
+from config import (
+    SCHEDULED_BATCH_SIZE, SCHEDULED_LEASE_SECONDS,
+    SCHEDULER_RESYNC_SECONDS, SCHEDULER_HEAP_SIZE, SCHEDULED_CONCURRENCY,
+    PG_POOL_MAX_IDLE
+)
+from ratelimit import BULK
 from templates import format_valentine, VALENTINE_RECEIVED_TEXT
 
 logger = logging.getLogger(__name__)
 
+async def deliver_scheduled(bot, now: datetime = None):
+    """Deliver due scheduled valentines, one leased batch at a time
 
-async def deliver_scheduled(bot):
-    """Check and deliver scheduled valentines"""
-    pending = await db.get_pending_scheduled()
+    Valentines in a batch go out concurrently (up to SCHEDULED_CONCURRENCY);
+    the bot's rate limiter keeps them behind interactive traffic and under
+    Telegram's global and per-chat limits. `now` decides what is due
+    (default: the database clock).
+    """
+    slots = asyncio.Semaphore(SCHEDULED_CONCURRENCY)
 
-    for valentine in pending:
-        try:
-            message = valentine['message']
-            formatted = format_valentine(message, is_premium=valentine.get('is_premium', False))
-
-            from telegram import InlineKeyboardButton, InlineKeyboardMarkup
+    async def deliver(valentine):
+        async with slots:
+            await _deliver_one(bot, valentine)
 
-            keyboard = [
-                [InlineKeyboardButton(
-                    "💫 Узнать кто отправил (50⭐)",
-                    callback_data=f"reveal_{valentine['id']}"
-                )],
-                [InlineKeyboardButton("◀️ В меню", callback_data="menu_main")]
-            ]
-            reply_markup = InlineKeyboardMarkup(keyboard)
+    while True:
+        batch = await db.claim_scheduled(SCHEDULED_BATCH_SIZE, SCHEDULED_LEASE_SECONDS, now)
+        await asyncio.gather(*(deliver(valentine) for valentine in batch))
+        if len(batch) < SCHEDULED_BATCH_SIZE:
+            break
+
+
+async def _deliver_one(bot, valentine):
+    """Send one scheduled valentine and mark it sent"""
+    try:
+        message = valentine['message']
+        formatted = format_valentine(message, is_premium=valentine.get('is_premium', False))
+
+        from telegram import InlineKeyboardButton, InlineKeyboardMarkup
+
+        keyboard = [
+            [InlineKeyboardButton(
+                "💫 Узнать кто отправил (50⭐)",
+                callback_data=f"reveal_{valentine['id']}"
+            )],
+            [InlineKeyboardButton("◀️ В меню", callback_data="menu_main")]
+        ]
+        reply_markup = InlineKeyboardMarkup(keyboard)
+
+        text = VALENTINE_RECEIVED_TEXT.format(message=formatted)
+
+        # Add gift if present
+        if valentine.get('gift_emoji'):
+            text = f"🎁 Подарок: {valentine['gift_emoji']}\n\n" + text
+
+        # Send text valentine
+        receiver_id = valentine['receiver_id']
+        await bot.send_message(
+            chat_id=receiver_id,
+            text=text,
+            reply_markup=reply_markup,
+            parse_mode="Markdown",
+            rate_limit_args=BULK
+        )
+
+        # Send voice if present
+        if valentine.get('voice_file_id'):
+            await bot.send_voice(
+                chat_id=receiver_id,
+                voice=valentine['voice_file_id'],
+                caption="🎤 Голосовая валентинка от тайного поклонника!",
+                rate_limit_args=BULK
+            )
 
-            text = VALENTINE_RECEIVED_TEXT.format(message=formatted)
+        # Send photo if present
+        if valentine.get('photo_file_id'):
+            await bot.send_photo(
+                chat_id=receiver_id,
+                photo=valentine['photo_file_id'],
+                caption="📸 Фото-валентинка от тайного поклонника!",
+                rate_limit_args=BULK
+            )
 
-            # Add gift if present
-            if valentine.get('gift_emoji'):
-                text = f"🎁 Подарок: {valentine['gift_emoji']}\n\n" + text
+        # Mark as sent
+        await db.mark_scheduled_sent(valentine['id'])
+        logger.info(f"Delivered scheduled valentine {valentine['id']}")
 
-            # Send text valentine
+        # Notify sender
+        try:
             await bot.send_message(
-                chat_id=valentine['receiver_id'],
-                text=text,
-                reply_markup=reply_markup,
-                parse_mode="Markdown"
+                chat_id=valentine['sender_id'],
+                text="✅ Твоя отложенная валентинка доставлена! 💌",
+                rate_limit_args=BULK
             )
+        except Exception:
+            pass
 
-            # Send voice if present
-            if valentine.get('voice_file_id'):
-                await bot.send_voice(
-                    chat_id=valentine['receiver_id'],
-                    voice=valentine['voice_file_id'],
-                    caption="🎤 Голосовая валентинка от тайного поклонника!"
-                )
-
-            # Send photo if present
-            if valentine.get('photo_file_id'):
-                await bot.send_photo(
-                    chat_id=valentine['receiver_id'],
-                    photo=valentine['photo_file_id'],
-                    caption="📸 Фото-валентинка от тайного поклонника!"
-                )
-
-            # Mark as sent
-            await db.mark_scheduled_sent(valentine['id'])
-            logger.info(f"Delivered scheduled valentine {valentine['id']}")
-
-            # Notify sender
-            try:
-                await bot.send_message(
-                    chat_id=valentine['sender_id'],
-                    text="✅ Твоя отложенная валентинка доставлена! 💌"
-                )
-            except Exception:
-                pass
+    except Exception as e:
+        logger.error(f"Failed to deliver scheduled valentine {valentine['id']}: {e}")
 
-        except Exception as e:
-            logger.error(f"Failed to deliver scheduled valentine {valentine['id']}: {e}")
+
+# Upcoming deliveries as (scheduled_for, valentine_id), soonest first
+_heap = []
+_wakeup = None
+
+
+def _as_datetime(value) -> datetime:
+    return value if isinstance(value, datetime) else datetime.fromisoformat(value)
+
+
+def poke(valentine_id: int, scheduled_for):
+    """Tell the running scheduler about a newly scheduled valentine"""
+    if _wakeup is None:
+        return  # no in-process scheduler (webhook mode) — the cron picks it up
+    heapq.heappush(_heap, (_as_datetime(scheduled_for), valentine_id))
+    _wakeup.set()
+
+
+async def _resync() -> bool:
+    """Reload the heap from the DB. Returns True if more rows exist than were loaded."""
+    rows = await db.get_upcoming_scheduled(SCHEDULER_HEAP_SIZE)
+    _heap[:] = [(_as_datetime(row['scheduled_for']), row['id']) for row in rows]
+    heapq.heapify(_heap)
+    return len(rows) == SCHEDULER_HEAP_SIZE
 
 
 async def run_scheduler(bot):
-    """Run scheduler loop - check every 30 seconds"""
+    """Sleep until the next scheduled valentine is due, woken early by poke()
+
+    The DB is only re-read every SCHEDULER_RESYNC_SECONDS, to catch rows
+    created elsewhere (other processes) and deliveries that need a retry.
+    Every PG_POOL_MAX_IDLE seconds it also lets the connection pool close
+    connections that sat idle or lived too long.
+    """
+    global _wakeup
+    _wakeup = asyncio.Event()
     logger.info("Scheduler started")
+    next_resync = 0.0
+    next_pool_check = time.monotonic() + PG_POOL_MAX_IDLE
+    truncated = False
     while True:
+        _wakeup.clear()
         try:
-            await deliver_scheduled(bot)
+            if time.monotonic() >= next_pool_check:
+                next_pool_check = time.monotonic() + PG_POOL_MAX_IDLE
+                await db.maintain_pool()
+            if time.monotonic() >= next_resync or (truncated and not _heap):
+                truncated = await _resync()
+                next_resync = time.monotonic() + SCHEDULER_RESYNC_SECONDS
+            now = datetime.now()
+            if _heap and _heap[0][0] <= now:
+                while _heap and _heap[0][0] <= now:
+                    heapq.heappop(_heap)
+                # Due by the clock that popped them: the DB clock may lag behind
+                await deliver_scheduled(bot, now)
+                continue
         except Exception as e:
             logger.error(f"Scheduler error: {e}")
-        await asyncio.sleep(30)
+            await asyncio.sleep(30)
+            continue
+
+        timeout = min(next_resync, next_pool_check) - time.monotonic()
+        if _heap:
+            timeout = min(timeout, (_heap[0][0] - datetime.now()).total_seconds())
+        try:
+            await asyncio.wait_for(_wakeup.wait(), timeout=max(timeout, 0))
+        except asyncio.TimeoutError:
+            pass
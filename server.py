@@ -0,0 +1,246 @@
+"""
+Self-hosted webhook server for Valentine Bot
+One asyncio loop serves many concurrent Telegram connections
+
+    python server.py --port 8080
+
+--workers N runs N processes sharing the port through SO_REUSEPORT, but
+ConversationHandler state and context.user_data live in each process's
+memory, and Telegram's connections land on workers regardless of user. A
+user whose next update reaches another worker loses their place in the
+send, roulette and extras conversations, and per-user update ordering
+only holds within a process. It therefore needs --allow-split-state, for
+bots that don't depend on that state.
+"""
+import argparse
+import asyncio
+import json
+import logging
+import multiprocessing
+import os
+import signal
+import sys
+
+from telegram import Bot
+
+import config
+import database as db
+import matchmaker
+import ratelimit
+import scheduler
+import update_processor
+import webhook_app
+
+logging.basicConfig(
+    format='%(asctime)s - %(name)s - %(levelname)s - %(message)s',
+    level=logging.INFO
+)
+logger = logging.getLogger(__name__)
+
+MAX_BODY_SIZE = 1 << 20  # Telegram updates are a few KB
+IDLE_TIMEOUT = 75        # seconds a keep-alive connection may sit idle
+READ_TIMEOUT = 10        # seconds to receive headers and body once a request started
+
+_REASONS = {200: "OK", 400: "Bad Request", 403: "Forbidden", 404: "Not Found",
+            405: "Method Not Allowed", 413: "Payload Too Large", 500: "Internal Server Error"}
+
+
+class _HttpError(Exception):
+    """A request we answer with an error status and then close"""
+
+    def __init__(self, status: int):
+        super().__init__(status)
+        self.status = status
+
+
+async def _read_request(reader):
+    """Parse one HTTP/1.1 request; None when the client closed the connection"""
+    request_line = await asyncio.wait_for(reader.readline(), IDLE_TIMEOUT)
+    if not request_line:
+        return None
+    parts = request_line.decode("latin-1").split()
+    if len(parts) != 3:
+        raise _HttpError(400)
+    method, path, version = parts
+    headers, body = await asyncio.wait_for(_read_headers_and_body(reader), READ_TIMEOUT)
+    return method, path.split("?", 1)[0], version, headers, body
+
+
+async def _read_headers_and_body(reader):
+    headers = {}
+    while True:
+        line = await reader.readline()
+        if line in (b"\r\n", b"\n", b""):
+            break
+        name, _, value = line.decode("latin-1").partition(":")
+        headers[name.strip().lower()] = value.strip()
+    try:
+        length = int(headers.get("content-length", 0))
+    except ValueError:
+        raise _HttpError(400)
+    if length > MAX_BODY_SIZE:
+        raise _HttpError(413)
+    body = await reader.readexactly(length) if length else b""
+    return headers, body
+
+
+async def _dispatch(method: str, path: str, headers: dict, body: bytes):
+    """Route a request; returns (status, JSON payload or None)"""
+    if path != config.WEBHOOK_PATH:
+        return 404, None
+    if method != "POST":
+        return 405, None
+    if not webhook_app.secret_ok(headers.get("x-telegram-bot-api-secret-token")):
+        return 403, None
+
+    if config.WEBHOOK_ACK_FIRST:
+        try:
+            await webhook_app.spool_update(body)
+        except ValueError:
+            return 400, None  # malformed update, nothing to redeliver
+        except Exception as e:
+            # Not persisted: a non-200 makes Telegram deliver it again
+            logger.error(f"Update spool error: {e}")
+            return 500, None
+        return 200, {"ok": True}
+
+    try:
+        reply = await webhook_app.process_update(body)
+    except Exception as e:
+        logger.error(f"Update processing error: {e}")
+        return 200, {"ok": True, "error": str(e)}  # Always return 200 to Telegram
+    return 200, reply or {"ok": True}
+
+
+async def _serve_connection(reader, writer):
+    """Serve requests on one keep-alive connection until it closes"""
+    try:
+        while True:
+            try:
+                request = await _read_request(reader)
+            except _HttpError as e:
+                status, payload, keep_alive = e.status, None, False
+            else:
+                if request is None:
+                    break
+                method, path, version, headers, body = request
+                status, payload = await _dispatch(method, path, headers, body)
+                keep_alive = version == "HTTP/1.1" and headers.get("connection", "").lower() != "close"
+
+            content = json.dumps(payload).encode() if payload is not None else b""
+            head = [
+                f"HTTP/1.1 {status} {_REASONS.get(status, '')}",
+                f"Content-Length: {len(content)}",
+                f"Connection: {'keep-alive' if keep_alive else 'close'}",
+            ]
+            if payload is not None:
+                head.append("Content-Type: application/json")
+            writer.write(("\r\n".join(head) + "\r\n\r\n").encode() + content)
+            await writer.drain()
+            if not keep_alive:
+                break
+    except (asyncio.TimeoutError, asyncio.IncompleteReadError, ConnectionError):
+        pass
+    finally:
+        writer.close()
+
+
+async def _serve(host: str, port: int, reuse_port: bool):
+    """Run the bot and the HTTP server in this process until SIGTERM/SIGINT"""
+    app = await webhook_app.get_app()
+
+    # Same background work as the polling worker; leases keep several
+    # processes from delivering or expiring the same rows twice
+    asyncio.create_task(scheduler.run_scheduler(app.bot))
+    await matchmaker.start(app.bot)
+
+    server = await asyncio.start_server(
+        _serve_connection, host, port, reuse_port=reuse_port, backlog=1024
+    )
+    logger.info(f"Worker {os.getpid()} serving {config.WEBHOOK_PATH} on {host}:{port}")
+
+    stop = asyncio.Event()
+    loop = asyncio.get_running_loop()
+    for sig in (signal.SIGTERM, signal.SIGINT):
+        loop.add_signal_handler(sig, stop.set)
+    async with server:
+        await stop.wait()
+
+    matchmaker.stop()
+    await webhook_app.shutdown()
+    logger.info(f"Outbound requests: {ratelimit.get_stats()}")
+    logger.info(f"Updates: {update_processor.get_stats()}")
+    logger.info(f"Database pool: {db.get_pool_stats()}")
+    logger.info(f"Subscription cache: {db.get_subscription_cache_stats()}")
+    await db.close_db()
+
+
+def _worker(host: str, port: int, reuse_port: bool):
+    asyncio.run(_serve(host, port, reuse_port))
+
+
+async def _set_webhook():
+    kwargs = {"base_url": f"{config.BOT_API_URL}/bot"} if config.BOT_API_URL else {}
+    async with Bot(token=config.BOT_TOKEN, **kwargs) as bot:
+        result = await webhook_app.setup_webhook(bot)
+    logger.info(f"Webhook: {result}")
+
+
+def main():
+    """Parse arguments, register the webhook and start the workers"""
+    parser = argparse.ArgumentParser(description="Valentine Bot webhook server")
+    parser.add_argument("--host", default=config.SERVER_HOST)
+    parser.add_argument("--port", type=int, default=config.SERVER_PORT)
+    parser.add_argument("--workers", type=int, default=config.SERVER_WORKERS)
+    parser.add_argument("--allow-split-state", action="store_true",
+                        help="run several workers although conversation state is per process")
+    parser.add_argument("--set-webhook", action="store_true",
+                        help="register WEBHOOK_URL with Telegram before serving")
+    args = parser.parse_args()
+
+    if not config.BOT_TOKEN:
+        logger.error("BOT_TOKEN not set! Please set it in .env file")
+        return
+
+    if args.workers > 1:
+        if not args.allow_split_state:
+            logger.error(
+                f"Refusing to start {args.workers} workers: conversations and user_data are kept "
+                f"per process, so a user's updates spread over workers break the send, roulette "
+                f"and extras flows. Run one worker, or pass --allow-split-state to accept that."
+            )
+            sys.exit(2)
+        logger.warning(
+            f"Starting {args.workers} workers with per-process conversation state: "
+            f"multi-step flows WILL break when a user's updates reach different workers"
+        )
+
+    if args.set_webhook:
+        asyncio.run(_set_webhook())
+
+    if args.workers <= 1:
+        _worker(args.host, args.port, False)
+        return
+
+    workers = [
+        multiprocessing.Process(target=_worker, args=(args.host, args.port, True), daemon=True)
+        for _ in range(args.workers)
+    ]
+    for process in workers:
+        process.start()
+
+    def stop(signum, frame):
+        # Workers shut down cleanly on SIGTERM; without this `kill <parent>`
+        # would leave them serving the port
+        for process in workers:
+            if process.is_alive():
+                process.terminate()
+
+    signal.signal(signal.SIGTERM, stop)
+    signal.signal(signal.SIGINT, stop)
+    for process in workers:
+        process.join()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,52 @@
+"""
+Shared fixtures: every test gets a fresh SQLite database; the Postgres tests
+run only when POSTGRES_URL (a scratch database) is set in the environment
+"""
+import asyncio
+import os
+import sys
+
+import pytest
+
+# The tests run against SQLite, whatever the local .env says
+POSTGRES_URL = os.environ.get("POSTGRES_URL", "")
+os.environ["POSTGRES_URL"] = ""
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import config  # noqa: E402
+import database as db  # noqa: E402
+
+
+@pytest.fixture
+def sqlite_db(tmp_path, monkeypatch):
+    """Migrated SQLite database in tmp_path; yields the database module"""
+    monkeypatch.setattr(config, "DATABASE_PATH", str(tmp_path / "valentine_bot.db"))
+    monkeypatch.setattr(db, "_sqlite_conn", None)
+    monkeypatch.setattr(db, "_sqlite_lock", asyncio.Lock())  # bound to the test's event loop
+    monkeypatch.setattr(db, "_schema_ready", False)
+    monkeypatch.setattr(db, "_subscription_cache", {})
+    asyncio.run(_migrate())
+    yield db
+    asyncio.run(db.close_db())
+
+
+async def _migrate():
+    await db.migrate()
+    await db.close_db()
+
+
+@pytest.fixture
+def postgres_db(monkeypatch):
+    """Migrated Postgres database at POSTGRES_URL; yields the database module"""
+    if not POSTGRES_URL:
+        pytest.skip("POSTGRES_URL not set")
+    monkeypatch.setattr(config, "POSTGRES_URL", POSTGRES_URL)
+    monkeypatch.setattr(db, "_use_postgres", True)
+    monkeypatch.setattr(db, "_pg_pool", None)
+    monkeypatch.setattr(db, "_pg_executor", None)
+    monkeypatch.setattr(db, "_schema_ready", False)
+    monkeypatch.setattr(db, "_subscription_cache", {})
+    monkeypatch.setattr(db, "_recent_profiles", {})
+    asyncio.run(_migrate())
+    yield db
+    asyncio.run(db.close_db())
@@ -0,0 +1,48 @@
+"""
+EXPLAIN QUERY PLAN for the hot query paths: each must use its index
+"""
+import asyncio
+import sqlite3
+
+import pytest
+
+
+def _plans(db, call) -> list:
+    """Run `call` and return the query plan of every statement it executed"""
+    statements = []
+
+    async def run():
+        conn = await db._open_sqlite()
+        await conn.set_trace_callback(statements.append)
+        try:
+            await call()
+        finally:
+            await conn.set_trace_callback(None)
+        await db.close_db()
+
+    asyncio.run(run())
+    conn = sqlite3.connect(db.config.DATABASE_PATH)
+    try:
+        plans = []
+        for sql in statements:
+            if sql.lstrip().upper().startswith(("SELECT", "UPDATE", "DELETE", "WITH")):
+                rows = conn.execute(f"EXPLAIN QUERY PLAN {sql}").fetchall()
+                plans.append((sql, "\n".join(row[3] for row in rows)))
+        return plans
+    finally:
+        conn.close()
+
+
+@pytest.mark.parametrize("name, call, index", [
+    ("get_inbox", lambda db: db.get_inbox(1), "idx_valentines_inbox_keyset"),
+    ("get_inbox older page", lambda db: db.get_inbox(1, older_than=5), "idx_valentines_inbox_keyset"),
+    ("claim_scheduled", lambda db: db.claim_scheduled(), "idx_valentines_scheduled"),
+    ("claim_roulette_match", lambda db: db.claim_roulette_match(1), "idx_roulette_waiting"),
+    ("get_active_subscription", lambda db: db.get_active_subscription(1), "idx_subscriptions_active"),
+    ("find_user_by_username", lambda db: db.find_user_by_username("@Alice"), "idx_users_username_lower"),
+])
+def test_hot_path_uses_index(sqlite_db, name, call, index):
+    plans = _plans(sqlite_db, lambda: call(sqlite_db))
+    assert plans, f"{name} ran no query"
+    report = "\n\n".join(f"{sql}\n{plan}" for sql, plan in plans)
+    assert any(index in plan for _, plan in plans), f"{name} does not use {index}:\n{report}"
@@ -0,0 +1,188 @@
+"""
+Roulette matching under load: no waiting entry is ever claimed twice
+"""
+import asyncio
+import multiprocessing
+from collections import Counter
+
+PLAYERS = 400
+PROCESSES = 4
+
+
+async def _users(db, user_ids):
+    for user_id in user_ids:
+        await db.get_or_create_user(user_id, f"player{user_id}", "Player")
+
+
+async def _all_entries(db) -> list:
+    async with db._sqlite() as conn:
+        cursor = await conn.execute("SELECT id, user_id, matched FROM roulette_queue")
+        return [dict(row) for row in await cursor.fetchall()]
+
+
+def test_simultaneous_claims_never_share_an_entry(sqlite_db):
+    db = sqlite_db
+    waiting, claimers = range(1, PLAYERS + 1), range(PLAYERS + 1, 2 * PLAYERS + 1)
+
+    async def claim(user_id):
+        async with db.transaction():
+            return await db.claim_roulette_match(user_id)
+
+    async def run():
+        await _users(db, [*waiting, *claimers])
+        for user_id in waiting:
+            await db.add_to_roulette(user_id, "hi")
+        matches = await asyncio.gather(*(claim(user_id) for user_id in claimers))
+        return matches, await _all_entries(db)
+
+    matches, entries = asyncio.run(run())
+    claimed = Counter(match['id'] for match in matches if match)
+    assert claimed and max(claimed.values()) == 1, "an entry was handed to two players"
+    assert len(claimed) == PLAYERS
+    assert all(match['user_id'] in waiting for match in matches)
+    assert all(entry['matched'] for entry in entries)
+
+
+def test_players_joining_at_once_pair_up_exactly_once(sqlite_db):
+    db = sqlite_db
+    players = range(1, PLAYERS + 1)
+
+    async def play(user_id):
+        # Same flow as the roulette handler: take a waiting entry or start waiting
+        async with db.transaction():
+            match = await db.claim_roulette_match(user_id)
+            if match is None:
+                await db.add_to_roulette(user_id, "hi")
+        return user_id, match
+
+    async def run():
+        await _users(db, players)
+        results = await asyncio.gather(*(play(user_id) for user_id in players))
+        return results, await _all_entries(db)
+
+    results, entries = asyncio.run(run())
+    matches = [(user_id, match) for user_id, match in results if match]
+    claimed = Counter(match['id'] for _, match in matches)
+    assert max(claimed.values()) == 1, "an entry was handed to two players"
+    assert all(match['user_id'] != user_id for user_id, match in matches)
+
+    matched_rows = {entry['id'] for entry in entries if entry['matched']}
+    assert matched_rows == set(claimed)
+    # Every player either paired with one entry or left exactly one waiting
+    assert len(entries) + len(matches) == PLAYERS
+    assert len(entries) - len(matched_rows) <= 1
+
+
+def _claim_in_process(database_path: str, user_ids: list, results):
+    """Claimer process with its own connection, like a second bot instance"""
+    import config
+    import database as db
+    config.DATABASE_PATH = database_path
+
+    async def run():
+        matches = await asyncio.gather(*(db.claim_roulette_match(user_id) for user_id in user_ids))
+        await db.close_db()
+        return [match['id'] for match in matches if match]
+
+    results.put(asyncio.run(run()))
+
+
+def test_claims_from_several_processes_never_share_an_entry(sqlite_db):
+    db = sqlite_db
+    waiting, claimers = range(1, PLAYERS + 1), list(range(PLAYERS + 1, 2 * PLAYERS + 1))
+
+    async def setup():
+        await _users(db, [*waiting, *claimers])
+        for user_id in waiting:
+            await db.add_to_roulette(user_id, "hi")
+        await db.close_db()
+
+    asyncio.run(setup())
+    context = multiprocessing.get_context("spawn")
+    results = context.Queue()
+    processes = [
+        context.Process(target=_claim_in_process,
+                        args=(db.config.DATABASE_PATH, claimers[i::PROCESSES], results))
+        for i in range(PROCESSES)
+    ]
+    for process in processes:
+        process.start()
+    claimed = Counter(queue_id for _ in processes for queue_id in results.get(timeout=120))
+    for process in processes:
+        process.join()
+
+    assert max(claimed.values()) == 1, "an entry was handed to two players"
+    assert len(claimed) == PLAYERS
+
+
+PG_BASE_ID = 9_200_000_000
+
+
+async def _pg_cleanup(db, user_ids):
+    async with db._pg() as conn:
+        await conn.execute("DELETE FROM roulette_queue WHERE user_id = ANY(%s)", (list(user_ids),))
+        await conn.execute("DELETE FROM users WHERE user_id = ANY(%s)", (list(user_ids),))
+
+
+def test_postgres_claims_never_share_an_entry(postgres_db, monkeypatch):
+    db = postgres_db
+    # Enough pool connections that the claims really overlap in the database
+    monkeypatch.setattr(db.config, "PG_POOL_MAX_SIZE", 20)
+    players = 200
+    waiting = range(PG_BASE_ID + 1, PG_BASE_ID + players + 1)
+    claimers = range(PG_BASE_ID + players + 1, PG_BASE_ID + 2 * players + 1)
+
+    async def claim(user_id):
+        # Inside a transaction, as the roulette handler does: row locks last until commit
+        async with db.transaction():
+            match = await db.claim_roulette_match(user_id)
+            await asyncio.sleep(0.001)
+        return match
+
+    async def claim_entry(queue_id):
+        return await db.claim_roulette_entry(queue_id)
+
+    async def run():
+        await _pg_cleanup(db, [*waiting, *claimers])
+        await _users(db, [*waiting, *claimers])
+        queue_ids = [await db.add_to_roulette(user_id, "hi") for user_id in waiting]
+        try:
+            matches = await asyncio.gather(*(claim(user_id) for user_id in claimers))
+            # Every entry is taken now; claiming one directly must fail for all
+            late = await asyncio.gather(*(claim_entry(queue_ids[0]) for _ in range(20)))
+            async with db._pg() as conn:
+                cur = await conn.execute(
+                    "SELECT COUNT(*) FROM roulette_queue WHERE user_id = ANY(%s) AND matched = FALSE",
+                    (list(waiting),)
+                )
+                still_waiting = (await cur.fetchone())[0]
+            return matches, late, still_waiting
+        finally:
+            await _pg_cleanup(db, [*waiting, *claimers])
+
+    matches, late, still_waiting = asyncio.run(run())
+    claimed = Counter(match['id'] for match in matches if match)
+    assert claimed and max(claimed.values()) == 1, "an entry was handed to two players"
+    assert len(claimed) == players and still_waiting == 0
+    assert not any(late)
+
+
+def test_postgres_claims_of_one_entry_have_one_winner(postgres_db, monkeypatch):
+    db = postgres_db
+    monkeypatch.setattr(db.config, "PG_POOL_MAX_SIZE", 20)
+    user_ids = [PG_BASE_ID + 1]
+
+    async def run():
+        await _pg_cleanup(db, user_ids)
+        await _users(db, user_ids)
+        try:
+            wins = 0
+            for _ in range(20):
+                queue_id = await db.add_to_roulette(user_ids[0], "hi")
+                claims = await asyncio.gather(*(db.claim_roulette_entry(queue_id) for _ in range(20)))
+                wins += sum(1 for claim in claims if claim)
+            return wins
+        finally:
+            await _pg_cleanup(db, user_ids)
+
+    assert asyncio.run(run()) == 20
@@ -0,0 +1,72 @@
+"""
+Refunds for roulette entries that expired unmatched
+"""
+import asyncio
+from datetime import date
+
+USER_ID = 1
+
+
+async def _uses(db, user_id: int) -> tuple:
+    async with db._sqlite() as conn:
+        cursor = await conn.execute(
+            "SELECT roulette_uses_today, roulette_paid_credits FROM users WHERE user_id = ?", (user_id,)
+        )
+        return tuple(await cursor.fetchone())
+
+
+def test_free_slot_is_given_back_as_todays_use(sqlite_db):
+    db = sqlite_db
+
+    async def run():
+        await db.get_or_create_user(USER_ID, "player", "Player")
+        assert await db.use_roulette_slot(USER_ID)
+        assert not await db.can_use_roulette_free(USER_ID)
+        assert await db.refund_roulette_slot(USER_ID)
+        return await _uses(db, USER_ID), await db.can_use_roulette_free(USER_ID)
+
+    assert asyncio.run(run()) == ((0, 0), True)
+
+
+def test_paid_slot_is_given_back_as_a_credit(sqlite_db):
+    db = sqlite_db
+
+    async def run():
+        await db.get_or_create_user(USER_ID, "player", "Player")
+        assert await db.use_roulette_slot(USER_ID)             # the free match
+        assert await db.use_roulette_slot(USER_ID, paid=True)  # an extra one bought with Stars
+        assert await db.refund_roulette_slot(USER_ID, paid=True)
+        # Still at the free limit, but the paid match can be played again once
+        assert not await db.can_use_roulette_free(USER_ID)
+        assert await _uses(db, USER_ID) == (2, 1)
+        return await db.take_roulette_credit(USER_ID), await db.take_roulette_credit(USER_ID)
+
+    assert asyncio.run(run()) == (True, False)
+
+
+def test_free_slot_past_the_limit_becomes_a_credit(sqlite_db):
+    db = sqlite_db
+
+    async def run():
+        await db.get_or_create_user(USER_ID, "player", "Player")
+        assert await db.use_roulette_slot(USER_ID)             # free entry, still waiting
+        assert await db.use_roulette_slot(USER_ID, paid=True)  # paid match meanwhile
+        assert await db.refund_roulette_slot(USER_ID)          # the free entry expires
+        return await _uses(db, USER_ID)
+
+    assert asyncio.run(run()) == (2, 1)
+
+
+def test_nothing_to_refund_once_the_day_is_over(sqlite_db):
+    db = sqlite_db
+
+    async def run():
+        await db.get_or_create_user(USER_ID, "player", "Player")
+        assert await db.use_roulette_slot(USER_ID)
+        async with db._sqlite() as conn:
+            await conn.execute("UPDATE users SET last_roulette_date = ? WHERE user_id = ?",
+                               (date.fromordinal(date.today().toordinal() - 1).isoformat(), USER_ID))
+            await conn.commit()
+        return await db.refund_roulette_slot(USER_ID), await db.can_use_roulette_free(USER_ID)
+
+    assert asyncio.run(run()) == (False, True)
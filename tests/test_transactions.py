@@ -0,0 +1,39 @@
+"""
+db.transaction() on SQLite: a unit of work waits for another process's
+write instead of failing with "database is locked"
+"""
+import asyncio
+import sqlite3
+import threading
+
+USER_ID = 1
+
+
+def test_unit_of_work_waits_for_a_concurrent_writer(sqlite_db):
+    db = sqlite_db
+
+    async def setup():
+        await db.get_or_create_user(USER_ID, "player", "Player")
+        await db.close_db()
+
+    asyncio.run(setup())
+    # Another process (a second worker, migrate.py) is mid-write
+    other = sqlite3.connect(db.config.DATABASE_PATH, check_same_thread=False)
+    other.execute("BEGIN IMMEDIATE")
+    other.execute("UPDATE users SET zodiac_sign = 'aries' WHERE user_id = ?", (USER_ID,))
+    timer = threading.Timer(0.3, other.commit)
+    timer.start()
+
+    async def run():
+        async with db.transaction():
+            # Read, then write: with a deferred BEGIN the read pins a snapshot
+            # that is stale by the time the write lock frees up
+            before = await db.get_user_zodiac(USER_ID)
+            await db.set_zodiac(USER_ID, "leo")
+        return before, await db.get_user_zodiac(USER_ID)
+
+    try:
+        assert asyncio.run(run()) == ("aries", "leo")
+    finally:
+        timer.join()
+        other.close()
@@ -0,0 +1,57 @@
+"""
+Update processor: one user's updates in order, other users never held up by them
+"""
+import asyncio
+from datetime import datetime
+
+from telegram import Chat, Message, Update, User
+
+from update_processor import PerUserUpdateProcessor
+
+
+def _update(user_id: int, update_id: int) -> Update:
+    user = User(user_id, "Player", False)
+    message = Message(update_id, datetime.now(), Chat(user_id, Chat.PRIVATE), from_user=user, text="hi")
+    return Update(update_id, message=message)
+
+
+def test_burst_from_one_user_runs_in_order_without_taking_every_slot():
+    processor = PerUserUpdateProcessor(2)
+    order = []
+
+    async def slow(n):
+        order.append(n)
+        await asyncio.sleep(0.05)
+
+    async def run():
+        burst = [asyncio.create_task(processor.process_update(_update(1, n), slow(n)))
+                 for n in range(10)]
+        await asyncio.sleep(0)
+        # The burst waits on its user's lock, not on slots: another user runs at once
+        await asyncio.wait_for(processor.process_update(_update(2, 100), asyncio.sleep(0)), 0.04)
+        await asyncio.gather(*burst)
+
+    asyncio.run(run())
+    assert order == list(range(10))
+    stats = processor.stats()
+    assert stats["running_peak"] <= 2
+    assert stats["processed"] == 11 and stats["users_queued"] == 0
+
+
+def test_slots_cap_updates_from_different_users():
+    processor = PerUserUpdateProcessor(3)
+    running = peak = 0
+
+    async def handler():
+        nonlocal running, peak
+        running += 1
+        peak = max(peak, running)
+        await asyncio.sleep(0.01)
+        running -= 1
+
+    async def run():
+        await asyncio.gather(*(processor.process_update(_update(user_id, user_id), handler())
+                               for user_id in range(1, 21)))
+
+    asyncio.run(run())
+    assert peak == 3
@@ -0,0 +1,36 @@
+"""
+get_or_create_user: a user created by a concurrent call is still returned
+"""
+import asyncio
+
+USER_ID = 9_100_000_001
+
+
+def test_get_or_create_user_sees_a_row_committed_during_the_upsert(postgres_db):
+    import psycopg2
+    db = postgres_db
+    other = psycopg2.connect(db.config.POSTGRES_URL)
+    try:
+        other.cursor().execute("DELETE FROM users WHERE user_id = %s", (USER_ID,))
+        other.commit()
+        # A second update from the same first-time user, mid-transaction
+        other.cursor().execute(
+            "INSERT INTO users (user_id, username, first_name) VALUES (%s, 'newcomer', 'New')",
+            (USER_ID,)
+        )
+
+        async def run():
+            # Blocks on the uncommitted row, then loses the conflict
+            call = asyncio.create_task(db.get_or_create_user(USER_ID, "newcomer", "New"))
+            await asyncio.sleep(0.2)
+            assert not call.done()
+            other.commit()
+            return await call
+
+        user = asyncio.run(run())
+        assert user["user_id"] == USER_ID and user["username"] == "newcomer"
+    finally:
+        other.rollback()
+        other.cursor().execute("DELETE FROM users WHERE user_id = %s", (USER_ID,))
+        other.commit()
+        other.close()
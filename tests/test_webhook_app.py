@@ -0,0 +1,49 @@
+"""
+Webhook update handling: the dedup claim must not reorder one user's updates
+"""
+import asyncio
+import random
+from datetime import datetime
+from types import SimpleNamespace
+
+from telegram import Chat, Message, Update, User
+
+import dedup
+import webhook_app
+from update_processor import PerUserUpdateProcessor
+
+
+def _update(user_id: int, update_id: int) -> Update:
+    user = User(user_id, "Player", False)
+    message = Message(update_id, datetime.now(), Chat(user_id, Chat.PRIVATE), from_user=user, text="hi")
+    return Update(update_id, message=message)
+
+
+def test_slow_dedup_claims_keep_each_users_updates_in_order(monkeypatch):
+    handled = []
+
+    async def begin(update_id):
+        # A Postgres claim on the executor finishes in any order
+        await asyncio.sleep(random.uniform(0, 0.02))
+        return True
+
+    async def finish(update_id):
+        pass
+
+    async def process_update(update):
+        handled.append((update.effective_user.id, update.update_id))
+        await asyncio.sleep(0)
+
+    monkeypatch.setattr(dedup, "begin", begin)
+    monkeypatch.setattr(dedup, "finish", finish)
+    app = SimpleNamespace(update_processor=PerUserUpdateProcessor(8), process_update=process_update)
+    updates = [_update(1 + n % 3, n) for n in range(60)]
+
+    async def run():
+        await asyncio.gather(*(webhook_app._handle_update(app, update) for update in updates))
+
+    asyncio.run(run())
+    assert len(handled) == 60
+    for user_id in (1, 2, 3):
+        update_ids = [update_id for user, update_id in handled if user == user_id]
+        assert update_ids == sorted(update_ids)
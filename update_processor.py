@@ -0,0 +1,137 @@
+"""
+Concurrent update processing
+Updates from different users are handled in parallel (up to UPDATE_CONCURRENCY
+at a time); one user's updates run one after another in arrival order, so
+ConversationHandler state never sees two of them at once
+"""
+import asyncio
+import logging
+import sys
+import time
+
+from telegram import Update
+from telegram.ext import BaseUpdateProcessor
+
+import config
+
+logger = logging.getLogger(__name__)
+
+_processor = None
+
+
+def _order_key(update):
+    """Updates sharing a key are processed in order; None for no ordering"""
+    if not isinstance(update, Update):
+        return None
+    if update.effective_user is not None:
+        return update.effective_user.id
+    if update.effective_chat is not None:
+        return ("chat", update.effective_chat.id)
+    return None
+
+
+class _UserQueue:
+    """Lock plus the number of updates holding or waiting for it"""
+    __slots__ = ("lock", "depth")
+
+    def __init__(self):
+        self.lock = asyncio.Lock()
+        self.depth = 0
+
+
+class PerUserUpdateProcessor(BaseUpdateProcessor):
+    """Update processor with a global cap and per-user ordering
+
+    An update first waits for the same user's earlier updates (asyncio.Lock
+    wakes waiters in FIFO order), then for one of the `limit` slots. PTB's
+    own semaphore, which process_update takes before do_process_update, is
+    left unbounded: taken there, a user sending a burst would hold a slot
+    per waiting update and could stall everyone else.
+    """
+
+    def __init__(self, limit: int):
+        super().__init__(sys.maxsize)
+        self.limit = limit
+        self._slots = asyncio.Semaphore(limit)
+        self._queues = {}   # order key -> _UserQueue, only while it has updates
+        self._running = 0   # updates holding a slot
+        self._waiting = 0   # updates waiting for their user's earlier ones
+        self._stats = {"processed": 0, "running_peak": 0, "waiting_peak": 0,
+                       "user_depth_peak": 0, "wait_time_total": 0.0, "wait_time_max": 0.0}
+
+    async def do_process_update(self, update, coroutine):
+        key = _order_key(update)
+        if key is None:
+            await self._run(coroutine, time.monotonic())
+            return
+        queue = self._queues.get(key)
+        if queue is None:
+            queue = self._queues[key] = _UserQueue()
+        queue.depth += 1
+        self._stats["user_depth_peak"] = max(self._stats["user_depth_peak"], queue.depth)
+
+        started = time.monotonic()
+        self._waiting += 1
+        self._stats["waiting_peak"] = max(self._stats["waiting_peak"], self._waiting)
+        waiting = True
+        try:
+            async with queue.lock:
+                self._waiting -= 1
+                waiting = False
+                await self._run(coroutine, started)
+        finally:
+            if waiting:
+                # Cancelled before its turn
+                self._waiting -= 1
+                coroutine.close()
+            queue.depth -= 1
+            if queue.depth == 0:
+                del self._queues[key]
+
+    async def _run(self, coroutine, started: float):
+        try:
+            async with self._slots:
+                waited = time.monotonic() - started
+                self._stats["wait_time_total"] += waited
+                self._stats["wait_time_max"] = max(self._stats["wait_time_max"], waited)
+                self._running += 1
+                self._stats["running_peak"] = max(self._stats["running_peak"], self._running)
+                try:
+                    await coroutine
+                finally:
+                    self._running -= 1
+                    self._stats["processed"] += 1
+        finally:
+            # Cancelled while waiting for a slot
+            coroutine.close()
+
+    async def initialize(self):
+        pass
+
+    async def shutdown(self):
+        pass
+
+    def stats(self) -> dict:
+        """Counters plus a snapshot of the current queue depths"""
+        return {
+            **self._stats,
+            "limit": self.limit,
+            "running": self._running,
+            "waiting": self._waiting,
+            "users_queued": len(self._queues),
+        }
+
+
+def get_processor() -> PerUserUpdateProcessor:
+    """Process-wide update processor shared by every Application this process builds"""
+    global _processor
+    if _processor is None:
+        _processor = PerUserUpdateProcessor(config.UPDATE_CONCURRENCY)
+    return _processor
+
+
+def get_stats() -> dict:
+    """Update processing statistics (empty before the first Application is built)"""
+    if _processor is None:
+        return {}
+    return _processor.stats()
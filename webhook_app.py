@@ -0,0 +1,241 @@
+"""
+Webhook update processing shared by the Vercel endpoint (api/webhook.py)
+and the self-hosted server (server.py)
+Builds the Application once per process, de-duplicates updates and, with
+WEBHOOK_ACK_FIRST, spools them to the DB for a background drainer
+"""
+import asyncio
+import hmac
+import json
+import logging
+
+from telegram import Update
+from telegram.ext import Application
+
+import config
+import database as db
+import dedup
+import ratelimit
+import update_processor
+import webhook_reply
+from handlers import get_allowed_updates, register_all_handlers
+
+logger = logging.getLogger(__name__)
+
+# Global application instance (reused across warm invocations)
+_app = None
+_app_lock = asyncio.Lock()
+
+_drainer = None        # task draining update_spool
+_spool_dirty = False   # set by every enqueue, so the drainer looks once more
+_spool_wakeup = None   # set with it while the drainer waits on rows in flight
+
+
+async def get_app() -> Application:
+    """Get or create the Application instance"""
+    global _app
+    if _app is not None:
+        return _app
+    async with _app_lock:
+        if _app is not None:
+            return _app
+
+        # Check schema version (migrates once if this deploy is behind)
+        await db.init_db()
+
+        # Build application
+        builder = (
+            Application.builder()
+            .token(config.BOT_TOKEN)
+            .rate_limiter(ratelimit.get_limiter())
+            .concurrent_updates(update_processor.get_processor())
+            .updater(None)  # No updater needed for webhook mode
+        )
+        if config.BOT_API_URL:
+            builder = builder.base_url(f"{config.BOT_API_URL}/bot")
+        if config.WEBHOOK_INLINE_REPLY:
+            builder = builder.request(webhook_reply.InlineReplyRequest(
+                hold=config.WEBHOOK_INLINE_REPLY_HOLD, connection_pool_size=256
+            ))
+        app = builder.build()
+
+        # Register all handlers
+        register_all_handlers(app)
+
+        # Initialize the application
+        await app.initialize()
+
+        # Get bot info
+        bot_info = await app.bot.get_me()
+        config.BOT_USERNAME = bot_info.username
+        logger.info(f"Bot initialized: @{config.BOT_USERNAME}")
+
+        # Published only once initialized, concurrent requests wait on the lock
+        _app = app
+        return _app
+
+
+async def shutdown():
+    """Release the Application (self-hosted server only)"""
+    global _app
+    if _drainer is not None:
+        _drainer.cancel()
+    if _app is not None:
+        await _app.shutdown()
+        _app = None
+
+
+def webhook_url() -> str:
+    """Configured webhook URL, falling back to the Vercel deployment URL"""
+    if config.WEBHOOK_URL:
+        return config.WEBHOOK_URL
+    if config.VERCEL_URL:
+        return f"https://{config.VERCEL_URL}/api/webhook"
+    return ""
+
+
+async def setup_webhook(bot) -> dict:
+    """Point Telegram at our webhook URL (with the secret token, if set)"""
+    url = webhook_url()
+    if not url:
+        return {"error": "WEBHOOK_URL or VERCEL_URL not set"}
+
+    # Only the update types some handler consumes; Telegram drops the rest
+    allowed = get_allowed_updates()
+    await bot.set_webhook(
+        url=url,
+        secret_token=config.WEBHOOK_SECRET or None,
+        max_connections=config.WEBHOOK_MAX_CONNECTIONS,
+        allowed_updates=allowed
+    )
+    info = await bot.get_webhook_info()
+    return {
+        "ok": True,
+        "webhook_url": info.url,
+        "pending_update_count": info.pending_update_count,
+        "allowed_updates": info.allowed_updates,
+        "filtered_updates": [t for t in Update.ALL_TYPES if allowed is not None and t not in allowed],
+    }
+
+
+def secret_ok(header_value) -> bool:
+    """Check X-Telegram-Bot-Api-Secret-Token when WEBHOOK_SECRET is set"""
+    if not config.WEBHOOK_SECRET:
+        return True
+    return hmac.compare_digest((header_value or "").encode(), config.WEBHOOK_SECRET.encode())
+
+
+async def _handle_update(app: Application, update: Update):
+    """Run an update through the update processor: one user's updates run in order"""
+    await app.update_processor.process_update(update, _run_handlers(app, update))
+
+
+async def _run_handlers(app: Application, update: Update):
+    """Run the handlers unless this update_id was already processed
+
+    Called with the user's lock held; claiming the update_id before it would
+    let a slow claim reorder that user's updates.
+    """
+    if not await dedup.begin(update.update_id):
+        logger.info(f"Dropping duplicate update {update.update_id}")
+        return
+    try:
+        await app.process_update(update)
+    except Exception:
+        dedup.abandon(update.update_id)
+        raise
+    await dedup.finish(update.update_id)
+
+
+async def process_update(body: bytes):
+    """Process a single Telegram update, returning the inline reply if any"""
+    app = await get_app()
+    update = Update.de_json(json.loads(body), app.bot)
+    if not config.WEBHOOK_INLINE_REPLY:
+        await _handle_update(app, update)
+        return None
+    chat = update.effective_chat
+    with webhook_reply.capture(chat.id if chat else None) as slot:
+        await _handle_update(app, update)
+    return slot.body()
+
+
+async def spool_update(body: bytes):
+    """Persist an update for the background drainer (ack-first mode)"""
+    update_id = json.loads(body).get("update_id")
+    if not isinstance(update_id, int):
+        raise ValueError("update without update_id")
+    await db.init_db()
+    await db.spool_update(update_id, body.decode())
+    _kick_drainer()
+
+
+def _kick_drainer():
+    global _drainer, _spool_dirty
+    _spool_dirty = True
+    if _spool_wakeup is not None:
+        _spool_wakeup.set()
+    if _drainer is None or _drainer.done():
+        _drainer = asyncio.get_running_loop().create_task(_drain_spool())
+
+
+async def _drain_spool():
+    """Process spooled updates until the spool is empty and none are in flight
+
+    Rows run as concurrent tasks through the update processor, so one user's
+    slow update doesn't hold up anyone else's while that user's own updates
+    still run in update_id order: tasks start in row order and reach the
+    user's lock without awaiting anything first. The processor caps how many
+    run; up to UPDATE_SPOOL_BATCH_SIZE leased rows are in flight, waiting or
+    running. Also picks up updates whose lease ran out, i.e. ones a crashed
+    or frozen instance acknowledged but never finished.
+    """
+    global _spool_dirty, _spool_wakeup
+    slots = asyncio.Semaphore(config.UPDATE_SPOOL_BATCH_SIZE)
+    in_flight = set()
+    try:
+        app = await get_app()
+        while True:
+            _spool_dirty = False
+            batch = await db.claim_spooled_updates(
+                config.UPDATE_SPOOL_BATCH_SIZE, config.UPDATE_SPOOL_LEASE_SECONDS
+            )
+            for row in batch:
+                await slots.acquire()
+                task = asyncio.create_task(_process_spooled(app, row))
+                in_flight.add(task)
+                task.add_done_callback(in_flight.discard)
+                task.add_done_callback(lambda _: slots.release())
+            if batch or _spool_dirty:
+                continue
+            if not in_flight:
+                return
+            # Look again once new rows are spooled or everything in flight is done
+            _spool_wakeup = asyncio.Event()
+            waiters = {
+                asyncio.ensure_future(_spool_wakeup.wait()),
+                asyncio.ensure_future(asyncio.wait(set(in_flight))),
+            }
+            await asyncio.wait(waiters, return_when=asyncio.FIRST_COMPLETED)
+            for waiter in waiters:
+                waiter.cancel()
+            _spool_wakeup = None
+    except Exception as e:
+        # Rows in flight still finish; the rest are claimed again once their lease runs out
+        logger.error(f"Update spool drain error: {e}")
+    finally:
+        _spool_wakeup = None
+
+
+async def _process_spooled(app: Application, row):
+    """Handle one spooled update, then drop its row"""
+    try:
+        update = Update.de_json(json.loads(row['payload']), app.bot)
+        await _handle_update(app, update)
+    except Exception as e:
+        logger.error(f"Spooled update {row['update_id']} failed: {e}")
+    try:
+        await db.delete_spooled_update(row['update_id'])
+    except Exception as e:
+        # Claimed again after the lease; dedup keeps the handlers from running twice
+        logger.error(f"Spooled update {row['update_id']} not deleted: {e}")
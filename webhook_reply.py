@@ -0,0 +1,127 @@
+"""
+Inline replies for webhook mode
+Telegram accepts one Bot API call in the body of the webhook response, so the
+last reply a handler makes to the user at hand goes back that way instead of
+costing a separate HTTPS round trip
+"""
+import asyncio
+import contextvars
+import logging
+from contextlib import contextmanager
+from typing import Optional
+
+from telegram.error import TelegramError
+from telegram.request import HTTPXRequest
+
+logger = logging.getLogger(__name__)
+
+# Calls whose result no handler reads, so a plain `True` can stand in for it
+INLINE_METHODS = frozenset({
+    "answerCallbackQuery",
+    "sendMessage",
+    "editMessageText",
+    "editMessageCaption",
+    "editMessageReplyMarkup",
+    "deleteMessage",
+})
+
+_slot = contextvars.ContextVar("webhook_reply_slot", default=None)
+
+
+class ReplySlot:
+    """Holds back at most one call of the update being processed"""
+    __slots__ = ("chat_id", "pending", "closed", "timer", "flushing")
+
+    def __init__(self, chat_id: Optional[int]):
+        self.chat_id = chat_id
+        self.pending = None  # (url, method, request_data, timeouts)
+        self.closed = False
+        self.timer = None     # sends the held call if the handler keeps going
+        self.flushing = None  # task sending it
+
+    def accepts(self, method: str, request_data) -> bool:
+        if method not in INLINE_METHODS or request_data is None or request_data.contains_files:
+            return False
+        # Only replies to the user at hand: a failed send to anyone else must still raise
+        return method == "answerCallbackQuery" or (
+            self.chat_id is not None and request_data.parameters.get("chat_id") == self.chat_id
+        )
+
+    def body(self) -> Optional[dict]:
+        """Close the slot and return the held call as a webhook response body"""
+        self.closed = True
+        if self.timer is not None:
+            self.timer.cancel()
+            self.timer = None
+        if self.pending is None:
+            return None
+        _, method, request_data, _ = self.pending
+        self.pending = None
+        return {"method": method, **request_data.parameters}
+
+
+@contextmanager
+def capture(chat_id: Optional[int]):
+    """Collect the inline reply for one update; read it with slot.body()"""
+    slot = ReplySlot(chat_id)
+    token = _slot.set(slot)
+    try:
+        yield slot
+    finally:
+        _slot.reset(token)
+
+
+class InlineReplyRequest(HTTPXRequest):
+    """HTTPXRequest that holds back the latest reply while an update is captured
+
+    Each new call first sends the held one, so Telegram sees calls in the
+    order the handler made them; whatever is still held when the handler
+    returns becomes the webhook response. A call is held `hold` seconds at
+    most: a handler still busy by then (e.g. waiting on OpenAI after
+    answering the callback query) gets it sent right away, so the user isn't
+    left watching a spinner and the answer can't go stale.
+    """
+
+    def __init__(self, hold: float = 0.2, **kwargs):
+        super().__init__(**kwargs)
+        self.hold = hold
+
+    async def post(self, url, request_data=None, **timeouts):
+        slot = _slot.get()
+        if slot is None or slot.closed:
+            return await super().post(url, request_data, **timeouts)
+
+        await self._flush(slot)
+
+        method = url.rsplit("/", 1)[-1]
+        if not slot.closed and slot.accepts(method, request_data):
+            slot.pending = (url, method, request_data, timeouts)
+            slot.timer = asyncio.get_running_loop().call_later(self.hold, self._flush_later, slot)
+            return True
+        return await super().post(url, request_data, **timeouts)
+
+    def _flush_later(self, slot: ReplySlot):
+        slot.timer = None
+        if slot.pending is not None and not slot.closed:
+            slot.flushing = asyncio.get_running_loop().create_task(self._send_held(slot))
+
+    async def _flush(self, slot: ReplySlot):
+        """Send the held call now, or wait for the deadline flush sending it"""
+        if slot.timer is not None:
+            slot.timer.cancel()
+            slot.timer = None
+        if slot.flushing is not None:
+            await slot.flushing
+            slot.flushing = None
+        await self._send_held(slot)
+
+    async def _send_held(self, slot: ReplySlot):
+        held, slot.pending = slot.pending, None
+        if held is None:
+            return
+        held_url, held_method, held_data, held_timeouts = held
+        try:
+            await super().post(held_url, held_data, **held_timeouts)
+        except TelegramError as e:
+            # The handler already got its result, all we can do is log
+            logger.warning(f"Held {held_method} failed: {e}")